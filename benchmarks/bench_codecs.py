@@ -0,0 +1,98 @@
+"""
+ * Licensed to the Apache Software Foundation (ASF) under one or more
+ * contributor license agreements.  See the NOTICE file distributed with
+ * this work for additional information regarding copyright ownership.
+ * The ASF licenses this file to You under the Apache License, Version 2.0
+ * (the "License"); you may not use this file except in compliance with
+ * the License.  You may obtain a copy of the License at
+ *
+ *    http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+"""
+
+"""
+Compare the cached data codecs on size, push time and pull time.
+
+    python benchmarks/bench_codecs.py [--payload my_output.json] [--s3-url s3://bucket/prefix] [--repeat 5]
+
+Push time is encoding (+ upload if --s3-url is given), pull time is (download +) decoding.
+"""
+
+import argparse
+import json
+import random
+import string
+import time
+
+from disdat_step_function.cache_lambda import Codec, s3_client, split_s3_url
+
+
+def representative_payloads(seed: int = 0) -> dict:
+    rng = random.Random(seed)
+    words = [''.join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(3, 10))) for _ in range(500)]
+    records = [{'id': i,
+                'name': rng.choice(words),
+                'status': rng.choice(['SUCCEEDED', 'FAILED', 'RUNNING']),
+                'score': rng.random(),
+                'tags': rng.sample(words, 3)} for i in range(20000)]
+    return {
+        'records_20k': records,
+        'floats_100k': [rng.random() for _ in range(100000)],
+        'text_1mb': ' '.join(rng.choice(words) for _ in range(150000)),
+        'small_dict': {'foo': 'bar', 'list': [1, 2, 3]},
+    }
+
+
+def bench(data, codec: str, repeat: int, s3_url: str = None) -> dict:
+    push, pull = [], []
+    for i in range(repeat):
+        start = time.perf_counter()
+        raw = Codec.encode(data, codec)
+        if s3_url:
+            bucket, key = split_s3_url('{}/{}'.format(s3_url.rstrip('/'), Codec.file_name(codec)))
+            s3_client().put_object(Bucket=bucket, Key=key, Body=raw)
+        push.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        if s3_url:
+            raw = s3_client().get_object(Bucket=bucket, Key=key)['Body'].read()
+        assert Codec.decode(raw, codec) == data
+        pull.append(time.perf_counter() - start)
+    return {'size': len(raw), 'push': min(push), 'pull': min(pull)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--payload', action='append', default=[], help='json file with a representative output')
+    parser.add_argument('--s3-url', default=None, help='include upload/download to this s3 prefix in the timing')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    payloads = representative_payloads()
+    for path in args.payload:
+        with open(path, 'r') as fp:
+            payloads[path] = json.load(fp)
+
+    print('{:<16}{:<8}{:>12}{:>8}{:>12}{:>12}'.format('payload', 'codec', 'bytes', 'ratio', 'push ms', 'pull ms'))
+    for name, data in payloads.items():
+        baseline = None
+        for codec in Codec.names():
+            try:
+                result = bench(data, codec, args.repeat, args.s3_url)
+            except ImportError as e:
+                print('{:<16}{:<8} skipped: {}'.format(name, codec, e))
+                continue
+            baseline = baseline or result['size']
+            print('{:<16}{:<8}{:>12}{:>8.2f}{:>12.1f}{:>12.1f}'.format(name, codec, result['size'],
+                                                                       baseline / result['size'],
+                                                                       result['push'] * 1000,
+                                                                       result['pull'] * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+"""
+ * Licensed to the Apache Software Foundation (ASF) under one or more
+ * contributor license agreements.  See the NOTICE file distributed with
+ * this work for additional information regarding copyright ownership.
+ * The ASF licenses this file to You under the Apache License, Version 2.0
+ * (the "License"); you may not use this file except in compliance with
+ * the License.  You may obtain a copy of the License at
+ *
+ *    http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+"""
+
+"""
+Compare the disdat init time of a cold container with and without the config baked into the layer.
+
+    python benchmarks/bench_cold_init.py [--repeat 10]
+
+Each run is a fresh interpreter with an empty HOME, like a cold lambda container. The time of the disdat import is
+reported separately, it is the same in both modes.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+from disdat_step_function.caching_wrapper import LambdaGenerator
+
+COLD_INIT = """
+import json, os, sys, time
+start = time.perf_counter()
+from disdat.common import DisdatConfig
+imported = time.perf_counter()
+config_dir = sys.argv[1]
+if config_dir:
+    DisdatConfig.instance(meta_dir_root=os.environ['HOME'], config_dir=config_dir)
+else:
+    DisdatConfig.init()
+    DisdatConfig.instance()
+done = time.perf_counter()
+print(json.dumps({'import': imported - start, 'init': done - imported}))
+"""
+
+
+def cold_init(config_dir: str) -> dict:
+    with tempfile.TemporaryDirectory() as home:
+        env = dict(os.environ, HOME=home)
+        output = subprocess.run([sys.executable, '-c', COLD_INIT, config_dir], env=env, check=True,
+                                capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=10)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as layer:
+        config_dir = os.path.dirname(LambdaGenerator.bake_config(layer))
+        print('{:<10}{:>14}{:>14}'.format('config', 'import ms', 'init ms'))
+        for mode, path in [('init', ''), ('baked', config_dir)]:
+            runs = [cold_init(path) for _ in range(args.repeat)]
+            print('{:<10}{:>14.1f}{:>14.2f}'.format(mode,
+                                                    statistics.median(r['import'] for r in runs) * 1000,
+                                                    statistics.median(r['init'] for r in runs) * 1000))
+
+
+if __name__ == '__main__':
+    main()
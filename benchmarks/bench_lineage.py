@@ -0,0 +1,104 @@
+"""
+ * Licensed to the Apache Software Foundation (ASF) under one or more
+ * contributor license agreements.  See the NOTICE file distributed with
+ * this work for additional information regarding copyright ownership.
+ * The ASF licenses this file to You under the Apache License, Version 2.0
+ * (the "License"); you may not use this file except in compliance with
+ * the License.  You may obtain a copy of the License at
+ *
+ *    http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+"""
+
+"""
+Time Cache.lineage_tracer on synthetic execution histories.
+
+    python benchmarks/bench_lineage.py [--events 1000 10000 25000] [--repeat 5]
+
+Each history is a chain of cached states followed by uncached states. 'near' traces the last cached state, whose parent
+is a few events away; 'far' traces a cached state whose only cached ancestor is at the start of the execution.
+Pages hold 1000 events, newest first, like get_execution_history(reverseOrder=True).
+"""
+
+import argparse
+import time
+
+from disdat_step_function.cache_lambda import Cache
+
+PAGE_SIZE = 1000
+# events of one cached state with the default wrapper: cache pull, choice, parallel with 3 passes, cache push
+WRAPPER_EVENTS = ['TaskStateEntered', 'TaskScheduled', 'TaskStarted', 'TaskSucceeded', 'TaskStateExited',
+                  'ChoiceStateEntered', 'ChoiceStateExited', 'ParallelStateEntered', 'ParallelStateStarted',
+                  'PassStateEntered', 'PassStateExited', 'PassStateEntered', 'PassStateExited',
+                  'PassStateEntered', 'PassStateExited', 'ParallelStateSucceeded', 'ParallelStateExited',
+                  'TaskStateEntered', 'TaskScheduled', 'TaskStarted', 'TaskSucceeded', 'TaskStateExited']
+
+
+def synthetic_history(size: int, far: bool) -> list:
+    """
+    :return: list, events oldest first. With far, the history is 2 cached states around a long uncached section
+    """
+    events = [{'id': 1, 'previousEventId': 0, 'type': 'ExecutionStarted'}]
+
+    def add(event_type: str, name: str = None):
+        event = {'id': len(events) + 1, 'previousEventId': len(events), 'type': event_type}
+        if name is not None:
+            event['stateExitedEventDetails'] = {'name': name, 'output': '{}'}
+        events.append(event)
+
+    def add_cached(idx: int):
+        for pos, event_type in enumerate(WRAPPER_EVENTS):
+            add(event_type, 'cache_pull_bd_{}'.format(idx) if pos == 4 else None)
+
+    steps = size // len(WRAPPER_EVENTS)
+    add_cached(0)
+    while len(events) < size - len(WRAPPER_EVENTS):
+        if far:
+            add('PassStateEntered')
+            add('PassStateExited')
+        else:
+            add_cached(len(events))
+    add_cached(steps)
+    return events
+
+
+def pages(events: list, read: list):
+    newest_first = events[::-1]
+    for start in range(0, len(newest_first), PAGE_SIZE):
+        read.append(start)
+        yield newest_first[start:start + PAGE_SIZE]
+
+
+def bench(size: int, far: bool, repeat: int) -> dict:
+    events = synthetic_history(size, far)
+    target = 'bd_{}'.format(size // len(WRAPPER_EVENTS))
+    timing, read = [], []
+    for _ in range(repeat):
+        read = []
+        start = time.perf_counter()
+        parent = Cache.lineage_tracer(pages(events, read), target)
+        timing.append(time.perf_counter() - start)
+        assert parent is not None
+    return {'events': len(events), 'pages': len(read), 'ms': min(timing) * 1000}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--events', type=int, nargs='+', default=[1000, 10000, 25000])
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    print('{:<8}{:>10}{:>8}{:>12}'.format('case', 'events', 'pages', 'trace ms'))
+    for size in args.events:
+        for case in ['near', 'far']:
+            result = bench(size, case == 'far', args.repeat)
+            print('{:<8}{:>10}{:>8}{:>12.2f}'.format(case, result['events'], result['pages'], result['ms']))
+
+
+if __name__ == '__main__':
+    main()
@@ -17,16 +17,25 @@
 
 
 import collections
+import concurrent.futures
+import contextlib
+import gzip
+import hashlib
+import importlib
+import io
 import json
+import math
+import os
+import threading
+import time
+import unicodedata
 
-import boto3
-from disdat import api
 import logging
 from typing import Any, Union
-import json
 
 
 LOG_LEVEL = logging.INFO + 1
+CACHED_DATA_FILE = 'cached_data.json'
 
 
 class PathParam:
@@ -36,6 +45,31 @@ class PathParam:
     DSDT_ONLY_ARGS = '_dsdt_only_args'
     USE_CACHE = '_use_cache'
     CACHE_DATA = '_data'
+    POINTER_DIR = '_dsdt_pointers'
+    LEASE_DIR = '_dsdt_leases'
+    REFRESH_DIR = '_dsdt_refresh'
+    DEAD_LETTER_DIR = '_dsdt_dead_letters'
+    ASYNC = '_dsdt_async'
+    REPLAY = '_dsdt_replay'
+    REFERENCE = '_dsdt_ref'
+    BATCH = '_dsdt_batch'
+    MAP = '_dsdt_map'
+    MAP_RESULTS = '_dsdt_map_results'
+    OUTPUT = '_dsdt_output'
+    PULL = '_dsdt_pull'
+    LINEAGE = '_dsdt_lineage'
+
+    MAP_SUFFIX = '{}.$'.format(MAP)
+    MAP_PREFIX = '$.{}'.format(MAP)
+    MAP_RESULTS_SUFFIX = '{}.$'.format(MAP_RESULTS)
+    MAP_RESULTS_PREFIX = '$.{}'.format(MAP_RESULTS)
+
+    HIT_DIR = '_dsdt_hits'
+    HIT_KEY = '_dsdt_hit_key'
+    HIT = '_dsdt_hit'
+    HIT_KEY_SUFFIX = '{}.$'.format(HIT_KEY)
+    HIT_KEY_PREFIX = '$.{}'.format(HIT_KEY)
+    HIT_PREFIX = '$.{}'.format(HIT)
 
     DSDT_PASS_PARAM_SUFFIX = '{}.$'.format(DSDT_PASS_PARAM)
     DSDT_ONLY_ARGS_SUFFIX = '{}.$'.format(DSDT_ONLY_ARGS)
@@ -48,8 +82,803 @@ class PathParam:
 
     USE_CACHE_PREFIX = '$.{}'.format(USE_CACHE)
 
+    CACHE_DATA_PREFIX = '$.{}'.format(CACHE_DATA)
+    OUTPUT_SUFFIX = '{}.$'.format(OUTPUT)
+    PULL_PREFIX = '$.{}'.format(PULL)
+    PUSH_PREFIX = '$._dsdt_push'
+
+
+class ColdStartProfile:
+    """
+    Container-level breakdown of the cold start: import and init steps are recorded as they happen, and the
+    breakdown is logged once, after the first request of the container
+    """
+    _steps = collections.OrderedDict()
+    _emitted = False
+    _lock = threading.Lock()
+
+    @classmethod
+    def record(cls, step: str, start: float):
+        """
+        :param step: str, name of the step
+        :param start: float, time.perf_counter() at the beginning of the step
+        """
+        with cls._lock:
+            cls._steps[step] = round((time.perf_counter() - start) * 1000, 2)
+
+    @classmethod
+    @contextlib.contextmanager
+    def measure(cls, step: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            cls.record(step, start)
+
+    @classmethod
+    def emit(cls) -> Union[None, dict]:
+        """
+        log the breakdown in ms, only the first call of a container logs it
+        :return: dict, step -> ms, None if already emitted
+        """
+        with cls._lock:
+            if cls._emitted:
+                return None
+            cls._emitted = True
+            steps = dict(cls._steps)
+        # logged whether verbose or not, see setup_logging
+        logging.log(level=LOG_LEVEL + 1, msg='cold start (ms): {}'.format(json.dumps(steps)))
+        return steps
+
+
+class LazyModule:
+    """
+    module imported on first attribute access, the import time is recorded by ColdStartProfile.
+    disdat (and pandas) make up most of the import time of this module, code that only needs PathParam or the
+    codecs does not import it, and neither does a container that has not served a request yet
+    """
+
+    def __init__(self, name: str):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr: str):
+        if self._module is None:
+            with ColdStartProfile.measure('import {}'.format(self._name)):
+                self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+
+api = LazyModule('disdat.api')
+
+
+class ContextRegistry:
+    """
+    Container-level registry of disdat contexts that are already created and bound to a remote.
+    AWS keeps a lambda container warm between invocations, so module-level state survives and
+    api.context()/api.remote() only need to run once per (context, s3_bucket_url) pair.
+
+    The whole registry is dropped if the disdat configuration (HOME or disdat.cfg) changes, and binding
+    a context to a different remote url evicts the stale binding of the same context.
+    """
+    DISDAT_CFG = os.path.join('.config', 'disdat', 'disdat.cfg')
+
+    _entries = {}
+    _fingerprint = None
+    _lock = threading.Lock()
+
+    @classmethod
+    def bind(cls, context: str, s3_url: str) -> dict:
+        """
+        make sure the local context exists and is bound to the remote context, reuse the binding if possible
+        :param context: str, name of the local (and remote) context
+        :param s3_url: str, url of the s3 bucket, in the format of 's3://BUCKET_NAME'
+        :return: dict, the registry entry {'context', 's3_bucket_url', 'created', 'hits'}
+        """
+        key = (context, s3_url)
+        with cls._lock:
+            fingerprint = cls._config_fingerprint()
+            if fingerprint != cls._fingerprint:
+                if len(cls._entries) > 0:
+                    logging.log(level=LOG_LEVEL, msg='disdat config changed, dropping {} context(s)'
+                                .format(len(cls._entries)))
+                cls._entries.clear()
+                cls._fingerprint = fingerprint
+
+            entry = cls._entries.get(key, None)
+            if entry is not None:
+                entry['hits'] += 1
+                return entry
+            # the same local context can only be bound to one remote
+            for stale in [k for k in cls._entries if k[0] == context]:
+                del cls._entries[stale]
+            # set up local context
+            api.context(context)
+            # set up and bind with the remote context
+            api.remote(context, remote_context=context, remote_url=s3_url)
+            entry = {'context': context, 's3_bucket_url': s3_url, 'created': time.time(), 'hits': 0}
+            cls._entries[key] = entry
+            return entry
+
+    @classmethod
+    def invalidate(cls, context: str = None, s3_url: str = None):
+        """
+        drop registry entries, the next Cache object will set up the context again
+        :param context: str, only drop entries of this context. None matches all contexts
+        :param s3_url: str, only drop entries bound to this url. None matches all urls
+        :return: None
+        """
+        with cls._lock:
+            for key in list(cls._entries):
+                if (context is None or key[0] == context) and (s3_url is None or key[1] == s3_url):
+                    del cls._entries[key]
+
+    @classmethod
+    def stats(cls) -> dict:
+        """
+        :return: dict, '{context}@{s3_bucket_url}' -> number of times the binding is reused
+        """
+        with cls._lock:
+            return {'{}@{}'.format(*key): entry['hits'] for key, entry in cls._entries.items()}
+
+    @classmethod
+    def _config_fingerprint(cls) -> tuple:
+        home = os.path.expanduser('~')
+        cfg = os.path.join(home, cls.DISDAT_CFG)
+        return home, os.path.getmtime(cfg) if os.path.isfile(cfg) else None
+
+
+class MetadataSync:
+    """
+    Incremental pull of bundle metadata on warm containers. api.pull(context, bundle_name) lists every object of the
+    remote context and downloads the hyperframe of every bundle that is not local, including the bundles of other
+    names, which are downloaded again on every call.
+
+    The first sync of a bundle name is a full api.pull. Later syncs list the remote context and only pull the
+    bundles committed after the high-water mark of the bundle name, and no sync runs at all within max_staleness
+    seconds of the last one. Marks are kept in the ContextRegistry entry, they are dropped with the binding
+    """
+    # disdat.common.DISDAT_CONTEXT_DIR and the remote object dir of disdat.data_context, bundles are stored under
+    # {s3_url}/context/{context}/objects/{uuid}/{uuid}_hframe.pb
+    REMOTE_CONTEXT_DIR = 'context'
+    REMOTE_OBJECT_DIR = 'objects'
+    HFRAME_SUFFIX = '_hframe.pb'
+    # bundles committed this many seconds before the last sync are listed again, covers clock skew with s3
+    MARGIN = 60
+
+    _stats = collections.Counter()
+    _lock = threading.Lock()
+
+    @classmethod
+    def sync(cls, entry: dict, bundle_name: str, max_staleness: float) -> str:
+        """
+        make sure the local context holds the metadata of bundle_name committed up to max_staleness seconds ago
+        :param entry: dict, ContextRegistry entry of the local context
+        :param bundle_name: str, name of the bundle
+        :param max_staleness: float, seconds, bundles committed since the last sync may be missed for this long
+        :return: str, 'skipped', 'full' or 'incremental'
+        """
+        with cls._lock:
+            marks = entry.setdefault('synced', {})
+            now = time.time()
+            mark = marks.get(bundle_name, None)
+            if mark is not None and now - mark['synced'] < max_staleness:
+                mode = 'skipped'
+            elif mark is None:
+                mode = 'full'
+                api.pull(entry['context'], bundle_name)
+            else:
+                mode = 'incremental'
+                new = cls.committed_since(entry['s3_bucket_url'], entry['context'], mark['synced'] - cls.MARGIN)
+                for uuid in new:
+                    # bundles already in the local context return without any s3 call
+                    api.pull(entry['context'], uuid=uuid)
+                cls._stats['pulled'] += len(new)
+            if mode != 'skipped':
+                marks[bundle_name] = {'synced': now}
+            cls._stats[mode] += 1
+        logging.log(level=LOG_LEVEL, msg='metadata sync of {} - {}'.format(bundle_name, mode))
+        return mode
+
+    @classmethod
+    def committed_since(cls, s3_url: str, context: str, since: float) -> list:
+        """
+        :return: list, uuids of the bundles of the remote context whose hyperframe was written after since
+        """
+        bucket, prefix = split_s3_url('{}/{}/{}/{}/'.format(s3_url.rstrip('/'), cls.REMOTE_CONTEXT_DIR, context,
+                                                         cls.REMOTE_OBJECT_DIR))
+        uuids = []
+        for page in s3_client().get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=prefix):
+            for obj in page.get('Contents', []):
+                if obj['Key'].endswith(cls.HFRAME_SUFFIX) and obj['LastModified'].timestamp() > since:
+                    uuids.append(os.path.basename(obj['Key'])[:-len(cls.HFRAME_SUFFIX)])
+        return uuids
+
+    @classmethod
+    def stats(cls) -> dict:
+        """
+        :return: dict, number of 'full', 'incremental' and 'skipped' syncs, and of bundles 'pulled' incrementally
+        """
+        with cls._lock:
+            return dict(cls._stats)
+
+
+class LocalBundleStore:
+    """
+    Container-level LRU of the bundle data files localized in /tmp. Bundles hit again while their files are local
+    are read without any s3 call, and the least recently used bundles are delocalized (their data files removed,
+    the metadata stays) once the local data exceeds the byte budget. disdat reads the data from s3 again if a
+    delocalized bundle is hit later
+    """
+    _entries = collections.OrderedDict()
+    _stats = collections.Counter()
+    _lock = threading.Lock()
+
+    @classmethod
+    def localize(cls, context: str, bundle: 'api.Bundle', budget: Union[None, int] = None) -> str:
+        """
+        :param context: str, local context of the bundle
+        :param bundle: api.Bundle, bundle with a single data file
+        :param budget: int, bytes of bundle data to keep in /tmp, None for no limit
+        :return: str, local path of the data file
+        """
+        with cls._lock:
+            entry = cls._entries.get(bundle.uuid, None)
+            if entry is not None and os.path.isfile(entry['file']):
+                cls._entries.move_to_end(bundle.uuid)
+                cls._stats['hits'] += 1
+                return entry['file']
+            cls._stats['misses'] += 1
+        api.pull(context, uuid=bundle.uuid, localize=True)
+        file = bundle.data
+        cls.add(bundle.uuid, file, budget)
+        return file
+
+    @classmethod
+    def add(cls, uuid: str, file: str, budget: Union[None, int] = None):
+        """
+        record a local data file as the most recently used one, and evict the others beyond the budget
+        """
+        with cls._lock:
+            cls._entries[uuid] = {'file': file, 'size': os.path.getsize(file)}
+            cls._entries.move_to_end(uuid)
+            if budget is None:
+                return
+            size = sum(entry['size'] for entry in cls._entries.values())
+            # the latest bundle is kept even if it exceeds the budget on its own
+            while size > budget and len(cls._entries) > 1:
+                stale, entry = cls._entries.popitem(last=False)
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(entry['file'])
+                size -= entry['size']
+                cls._stats['evictions'] += 1
+                logging.log(level=LOG_LEVEL, msg='delocalized bundle {}, {} bytes'.format(stale, entry['size']))
+
+    @classmethod
+    def stats(cls) -> dict:
+        """
+        :return: dict, 'hits', 'misses' and 'evictions' of the container, 'bundles' and 'bytes' held in /tmp
+        """
+        with cls._lock:
+            stats = {key: cls._stats[key] for key in ['hits', 'misses', 'evictions']}
+            stats.update(bundles=len(cls._entries), bytes=sum(entry['size'] for entry in cls._entries.values()))
+            return stats
+
+
+class ResultCache:
+    """
+    Container-level LRU of parsed cache hits, keyed by (context, bundle_name, processing_name). Map fan-outs look up
+    the same signature many times on a warm container, a hit in memory skips the metadata pull, the search and the
+    parsing of the cached data. Results expire after a TTL, bundles pushed by other containers are seen after it at
+    the latest, and a push from this container drops the result of its processing name. The creation time of the
+    bundle is kept with its result, the freshness policy of the step (max_age) applies to hits in memory as well.
+    Results are shared between lookups and must not be modified
+    """
+    _entries = collections.OrderedDict()
+    _stats = collections.Counter()
+    _lock = threading.Lock()
+
+    @classmethod
+    def get(cls, key: tuple, ttl: float) -> tuple:
+        """
+        :param key: tuple, (context, bundle_name, processing_name)
+        :param ttl: float, seconds a result is served from memory
+        :return: tuple, (found, cached_data, creation time of the bundle)
+        """
+        with cls._lock:
+            entry = cls._entries.get(key, None)
+            if entry is not None and time.time() - entry['created'] < ttl:
+                cls._entries.move_to_end(key)
+                cls._stats['hits'] += 1
+                return True, entry['data'], entry['bundle_created']
+            if entry is not None:
+                del cls._entries[key]
+                cls._stats['expired'] += 1
+            cls._stats['misses'] += 1
+            return False, None, None
+
+    @classmethod
+    def put(cls, key: tuple, data: Any, max_size: int, bundle_created: float = None):
+        """
+        :param key: tuple, (context, bundle_name, processing_name)
+        :param data: Any, parsed cached data of a hit
+        :param max_size: int, number of results kept, the least recently used ones are evicted
+        :param bundle_created: float, creation time of the bundle of the hit
+        """
+        with cls._lock:
+            cls._entries[key] = {'data': data, 'created': time.time(), 'bundle_created': bundle_created}
+            cls._entries.move_to_end(key)
+            while len(cls._entries) > max_size:
+                cls._entries.popitem(last=False)
+                cls._stats['evictions'] += 1
+
+    @classmethod
+    def invalidate(cls, key: tuple = None):
+        """
+        :param key: tuple, drop the result of this key, None to drop all results
+        """
+        with cls._lock:
+            if key is None:
+                cls._entries.clear()
+            else:
+                cls._entries.pop(key, None)
+
+    @classmethod
+    def stats(cls) -> dict:
+        """
+        :return: dict, 'hits', 'misses', 'expired' and 'evictions' of the container, 'results' held in memory
+        """
+        with cls._lock:
+            stats = {key: cls._stats[key] for key in ['hits', 'misses', 'expired', 'evictions']}
+            stats['results'] = len(cls._entries)
+            return stats
+
+
+class Signature:
+    """
+    Encode the cache params of a step into the bundle signature, from which the processing name is derived.
+
+    The legacy encoding is json.dumps(cache_params), so the same input with a different key order gets a different
+    processing name. The canonical encoding sorts keys, NFC-normalizes strings, writes integral floats as ints,
+    drops ignored fields and replaces inputs longer than DIGEST_THRESHOLD chars with their sha256 digest so that
+    large inputs are not embedded in bundle params.
+    """
+    PARAM_KEY = 'input_params'
+    DIGEST_KEY = 'input_digest'
+    DIGEST_THRESHOLD = 4096
+
+    @classmethod
+    def legacy(cls, cache_params: Any) -> dict:
+        return {cls.PARAM_KEY: json.dumps(cache_params)}
+
+    @classmethod
+    def canonical(cls, cache_params: Any, ignore_fields: list = ()) -> dict:
+        """
+        :param cache_params: Any, json serializable params of the user step
+        :param ignore_fields: list, dot separated paths of dict fields that are left out, e.g 'meta.request_id'
+        :return: dict, the bundle signature
+        """
+        params = cls.normalize(cache_params)
+        for field in ignore_fields:
+            cls._drop(params, field.split('.'))
+        encoded = json.dumps(params, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+        if len(encoded) > cls.DIGEST_THRESHOLD:
+            return {cls.DIGEST_KEY: 'sha256:' + hashlib.sha256(encoded.encode('utf-8')).hexdigest()}
+        return {cls.PARAM_KEY: encoded}
+
+    @classmethod
+    def candidates(cls, cache_params: Any, canonical: bool, ignore_fields: list = ()) -> list:
+        """
+        signatures to look up, in order of preference. In canonical mode the legacy signature comes second
+        so that bundles created before the switch stay addressable
+        """
+        if not canonical:
+            return [cls.legacy(cache_params)]
+        return [cls.canonical(cache_params, ignore_fields), cls.legacy(cache_params)]
+
+    @classmethod
+    def normalize(cls, value: Any) -> Any:
+        if isinstance(value, dict):
+            return {cls.normalize(str(k)): cls.normalize(v) for k, v in value.items()}
+        if isinstance(value, (list, tuple)):
+            return [cls.normalize(v) for v in value]
+        if isinstance(value, str):
+            return unicodedata.normalize('NFC', value)
+        if isinstance(value, float) and math.isfinite(value) and value.is_integer():
+            # 1.0 and 1 are the same json number; this also folds -0.0 into 0
+            return int(value)
+        return value
+
+    @classmethod
+    def _drop(cls, params: Any, path: list):
+        if not isinstance(params, dict) or path[0] not in params:
+            return
+        if len(path) == 1:
+            del params[path[0]]
+        else:
+            cls._drop(params[path[0]], path[1:])
+
+
+class Codec:
+    """
+    Compression and layout of the cached data file. The codec and format are recorded in the bundle params
+    (and in pointers/references), bundles without them were written as plain json.
+    New codecs can be added with Codec.register
+
+    Files are written and read through streams, so the encoded output is never held in memory next to the data.
+    The ndjson format stores one list item per line, readers can then go through a large list item by item
+    """
+    NONE = 'none'
+    GZIP = 'gzip'
+    ZSTD = 'zstd'
+    PARAM_KEY = 'codec'
+
+    JSON = 'json'
+    NDJSON = 'ndjson'
+    FORMAT_KEY = 'format'
+
+    CHUNK_SIZE = 1 << 16
+
+    # name -> (file extension, writer, reader)
+    _codecs = {}
+
+    @classmethod
+    def register(cls, name: str, extension: str, writer, reader):
+        """
+        :param name: str, codec name recorded in bundle params
+        :param extension: str, appended to the cached data file name, e.g '.gz'
+        :param writer: callable, binary file object -> writable stream. Closing the stream must flush it
+            without closing the file object
+        :param reader: callable, binary file object -> readable stream
+        """
+        cls._codecs[name] = (extension, writer, reader)
+
+    @classmethod
+    def names(cls) -> list:
+        return list(cls._codecs)
+
+    @classmethod
+    def file_name(cls, name: Union[None, str], fmt: str = JSON) -> str:
+        base = CACHED_DATA_FILE if fmt != cls.NDJSON else CACHED_DATA_FILE.replace('.json', '.ndjson')
+        return base + cls._get(name)[0]
+
+    @classmethod
+    def dump(cls, data: Any, fp, name: Union[None, str], fmt: str = JSON, streaming: bool = False):
+        """
+        :param data: Any, data to write. Must be a list if fmt is ndjson
+        :param fp: binary file object
+        :param streaming: bool, encode the json incrementally instead of in one shot. Slower, but peak memory
+            does not grow with an extra copy of the encoded output
+        """
+        stream = cls._get(name)[1](fp)
+        if fmt == cls.NDJSON:
+            cls._write_chunks(stream, (json.dumps(item) + '\n' for item in data))
+        elif streaming:
+            cls._write_chunks(stream, json.JSONEncoder().iterencode(data))
+        else:
+            stream.write(json.dumps(data).encode('utf-8'))
+        stream.close()
+
+    @classmethod
+    def load(cls, fp, name: Union[None, str], fmt: str = JSON) -> Any:
+        if fmt == cls.NDJSON:
+            return list(cls.iter_load(fp, name, fmt))
+        return json.loads(cls._get(name)[2](fp).read())
+
+    @classmethod
+    def iter_load(cls, fp, name: Union[None, str], fmt: str = JSON):
+        """
+        yield the items of a list-shaped output. Only ndjson files are read incrementally
+        """
+        if fmt != cls.NDJSON:
+            yield from cls.load(fp, name, fmt)
+            return
+        stream, tail = cls._get(name)[2](fp), b''
+        while True:
+            chunk = stream.read(cls.CHUNK_SIZE)
+            if not chunk:
+                break
+            *lines, tail = (tail + chunk).split(b'\n')
+            for line in lines:
+                yield json.loads(line)
+        if tail.strip():
+            yield json.loads(tail)
+
+    @classmethod
+    def encode(cls, data: Any, name: Union[None, str], fmt: str = JSON) -> bytes:
+        buffer = io.BytesIO()
+        cls.dump(data, buffer, name, fmt)
+        return buffer.getvalue()
+
+    @classmethod
+    def decode(cls, raw: bytes, name: Union[None, str], fmt: str = JSON) -> Any:
+        return cls.load(io.BytesIO(raw), name, fmt)
+
+    @classmethod
+    def _write_chunks(cls, stream, chunks):
+        # json.JSONEncoder.iterencode yields tiny chunks, batch them before they reach the compressor
+        batch, size = [], 0
+        for chunk in chunks:
+            batch.append(chunk)
+            size += len(chunk)
+            if size >= cls.CHUNK_SIZE:
+                stream.write(''.join(batch).encode('utf-8'))
+                batch, size = [], 0
+        stream.write(''.join(batch).encode('utf-8'))
+
+    @classmethod
+    def _get(cls, name: Union[None, str]) -> tuple:
+        name = name or cls.NONE
+        if name not in cls._codecs:
+            raise ValueError('unknown codec {}; choose from {}'.format(name, list(cls._codecs)))
+        return cls._codecs[name]
+
+
+class _Uncompressed:
+    """
+    writer of the 'none' codec, closing it leaves the file object open like the other codecs do
+    """
+    def __init__(self, fp):
+        self.fp = fp
+
+    def write(self, data: bytes):
+        return self.fp.write(data)
+
+    def close(self):
+        self.fp.flush()
+
+
+def _zstd_writer(fp):
+    # zstandard is an optional dependency, pip install disdat_step_function[zstd]
+    import zstandard
+    return zstandard.ZstdCompressor().stream_writer(fp, closefd=False)
+
+
+def _zstd_reader(fp):
+    import zstandard
+    return zstandard.ZstdDecompressor().stream_reader(fp)
+
+
+Codec.register(Codec.NONE, '', _Uncompressed, lambda fp: fp)
+Codec.register(Codec.GZIP, '.gz', lambda fp: gzip.GzipFile(fileobj=fp, mode='wb', compresslevel=6),
+               lambda fp: gzip.GzipFile(fileobj=fp, mode='rb'))
+Codec.register(Codec.ZSTD, '.zst', _zstd_writer, _zstd_reader)
+
+
+_S3_CLIENT = None
+_SFN_CLIENT = None
+# boto3.client() on the default session is not thread safe, and the lookup threads of a cold container create the
+# clients concurrently
+_CLIENT_LOCK = threading.Lock()
+
+
+def s3_client():
+    """
+    boto3 clients are expensive to create, share one per container
+    """
+    global _S3_CLIENT
+    if _S3_CLIENT is None:
+        with _CLIENT_LOCK:
+            if _S3_CLIENT is None:
+                import boto3
+                _S3_CLIENT = boto3.client('s3')
+    return _S3_CLIENT
+
+
+def sfn_client():
+    """
+    stepfunctions client shared by the lineage code of a container
+    """
+    global _SFN_CLIENT
+    if _SFN_CLIENT is None:
+        with _CLIENT_LOCK:
+            if _SFN_CLIENT is None:
+                # only lineage tracing talks to stepfunctions
+                import boto3
+                _SFN_CLIENT = boto3.client('stepfunctions')
+    return _SFN_CLIENT
+
+
+def error_code(e: Exception) -> Union[None, str]:
+    """
+    :return: str, error code of a botocore ClientError, None for other exceptions
+    """
+    return getattr(e, 'response', {}).get('Error', {}).get('Code', None)
+
+
+def split_s3_url(url: str) -> tuple:
+    """
+    :param url: str, in the format of 's3://BUCKET_NAME/KEY'
+    :return: tuple, (bucket, key)
+    """
+    assert url.startswith('s3://'), 's3 url invalid format: {}'.format(url)
+    bucket, _, key = url[len('s3://'):].partition('/')
+    return bucket, key
+
+
+def make_reference(data_url: str, uuid: str, size: int, codec: str = Codec.NONE, fmt: str = Codec.JSON) -> dict:
+    """
+    claim check for cached data that is too large to travel in the state payload
+    :param data_url: str, s3 url of the cached data file
+    :param uuid: str, uuid of the bundle that holds the file
+    :param size: int, size of the file in bytes
+    :param codec: str, compression of the file
+    :param fmt: str, json or ndjson
+    :return: dict, {PathParam.REFERENCE: {'bucket', 'key', 'uuid', 'size', 'codec', 'format'}}
+    """
+    bucket, key = split_s3_url(data_url)
+    return {PathParam.REFERENCE: {'bucket': bucket, 'key': key, 'uuid': uuid, 'size': size,
+                                  'codec': codec, 'format': fmt}}
+
+
+def is_reference(data: Any) -> bool:
+    return isinstance(data, dict) and set(data) - {PathParam.LINEAGE} == {PathParam.REFERENCE}
+
+
+def resolve_reference(data: Any) -> Any:
+    """
+    dereference the output of a cached step. Downstream tasks call this on their input, it is a no-op
+    if the cached step returned its data inline
+    :param data: Any, output of a cached step
+    :return: Any, data output by the user step
+    """
+    if not is_reference(data):
+        return data
+    ref = data[PathParam.REFERENCE]
+    body = s3_client().get_object(Bucket=ref['bucket'], Key=ref['key'])['Body']
+    return Codec.load(body, ref.get('codec'), ref.get('format', Codec.JSON))
+
+
+def iter_reference(data: Any):
+    """
+    iterate over a list-shaped output of a cached step. If the output is a reference to an ndjson file,
+    items are streamed from s3 one at a time and the list is never fully materialized
+    :param data: Any, output of a cached step
+    :return: generator of list items
+    """
+    if not is_reference(data):
+        yield from data
+        return
+    ref = data[PathParam.REFERENCE]
+    body = s3_client().get_object(Bucket=ref['bucket'], Key=ref['key'])['Body']
+    yield from Codec.iter_load(body, ref.get('codec'), ref.get('format', Codec.JSON))
+
+
+class Dependency(collections.namedtuple('Dependency', ['processing_name', 'uuid'])):
+    """
+    upstream bundle as carried in the state payload, it has the attributes that api.Bundle.add_dependencies reads
+    """
+
+    def to_dict(self) -> dict:
+        return {'processing_name': self.processing_name, 'uuid': self.uuid}
+
+
+def split_lineage(data: Any) -> tuple:
+    """
+    collect the lineage fields at any depth, e.g. the outputs of the branches of a Parallel state or the items of a
+    Map state after the join, so that a cached step records all of its upstream bundles at once
+    :param data: Any, output of a cached step, or parameters of a user step
+    :return: tuple, (data without the lineage fields, list of Dependency, without duplicates)
+    """
+    dependencies = collections.OrderedDict()
+
+    def strip(value: Any) -> Any:
+        if isinstance(value, list):
+            return [strip(v) for v in value]
+        if not isinstance(value, dict):
+            return value
+        for dep in value.get(PathParam.LINEAGE, []):
+            dependencies.setdefault(dep['uuid'], Dependency(**dep))
+        return {k: strip(v) for k, v in value.items() if k != PathParam.LINEAGE}
+
+    data = strip(data)
+    return data, list(dependencies.values())
+
+
+def attach_lineage(data: Any, dependencies: list) -> Any:
+    """
+    record the bundles that produced data in its lineage field. Only dict outputs can carry lineage
+    :param data: Any, output of a cached step
+    :param dependencies: list of Dependency
+    :return: Any, data with the lineage field
+    """
+    if not isinstance(data, dict):
+        return data
+    data = dict(data)
+    data[PathParam.LINEAGE] = [dep.to_dict() for dep in dependencies]
+    return data
+
+
+def hit_key_prefix(s3_url: str, context: str, bundle_name: str) -> str:
+    """
+    s3 key prefix of the hit objects of a bundle. A hit object holds the cached output of one set of cache params,
+    under '{prefix}/{sha256 of the params}.json', so the state machine can read it without the caching lambda
+    """
+    _, key = split_s3_url(s3_url)
+    return '/'.join([part for part in [key.strip('/'), context, PathParam.HIT_DIR, bundle_name] if part != ''])
+
+
+def get_path(data: Any, path: str) -> Any:
+    """
+    :param data: Any, state input
+    :param path: str, a reference path such as '$' or '$.foo.bar'
+    :return: Any, the selected field
+    """
+    for field in _split_path(path):
+        data = data[field]
+    return data
+
+
+def set_path(data: Any, path: str, value: Any) -> Any:
+    """
+    :return: Any, data with the field at path replaced by value. data is modified in place unless path is '$'
+    """
+    fields = _split_path(path)
+    if len(fields) == 0:
+        return value
+    get_path(data, '.'.join(['$'] + fields[:-1]))[fields[-1]] = value
+    return data
+
+
+def _split_path(path: str) -> list:
+    assert path == '$' or path.startswith('$.'), 'only simple reference paths are supported: {}'.format(path)
+    return [field for field in path[1:].split('.') if field != '']
+
+
+class StateMachineRegistry:
+    """
+    Container-level cache of state machine name -> arn. Only used when the arn is not passed by the state machine
+    (see Caching, which sends $$.StateMachine.Id and $$.Execution.Id), as resolving a name lists every state machine
+    of the account
+    """
+    _arns = {}
+    _lock = threading.Lock()
+
+    @classmethod
+    def arn(cls, name: str) -> str:
+        """
+        :param name: str, name of the state machine
+        :return: str, arn of the state machine
+        """
+        with cls._lock:
+            if name not in cls._arns:
+                paginator = sfn_client().get_paginator('list_state_machines')
+                for page in paginator.paginate():
+                    for machine in page['stateMachines']:
+                        cls._arns[machine['name']] = machine['stateMachineArn']
+                    if name in cls._arns:
+                        break
+            return cls._arns[name]
+
+    @classmethod
+    def invalidate(cls):
+        with cls._lock:
+            cls._arns.clear()
+
+
+def setup_logging(verbose: bool):
+    """
+    set the root logger level according to verbose. Lambda installs its own handler on the root logger,
+    so basicConfig only takes effect when running locally
+    """
+    level = LOG_LEVEL if verbose else LOG_LEVEL + 1
+    root = logging.getLogger()
+    if len(root.handlers) == 0:
+        logging.basicConfig(format='%(asctime)s %(message)s', level=level)
+    elif root.level != level:
+        root.setLevel(level=level)
+
 
 class Cache:
+    BATCH_WORKERS = 16
+    # seconds between two checks of the lease while waiting for its holder to push
+    LEASE_POLL = 1
+    # conditional writes of the lease before failing open, when the lease is released between the write and the read
+    LEASE_ATTEMPTS = 3
+    # error codes of a failed conditional write or delete of the lease
+    LEASE_CONFLICTS = ['PreconditionFailed', 'ConditionalRequestConflict']
+    # name prefix of the executions started to refresh stale hits
+    REFRESH_PREFIX = 'dsdt-refresh-'
 
     def __init__(self, dsdt_args):
         """
@@ -65,19 +894,40 @@ class Cache:
         self.verbose = dsdt_args.get('verbose', False)
         self.delocalize = dsdt_args.get('delocalized', False)
         self.state_machine_name = dsdt_args.get('state_machine_name', '')
+        # ids from the context object of the state machine, lineage tracing does not need to look them up
+        self.execution_arn = dsdt_args.get('execution_arn', None)
+        self.state_machine_arn = dsdt_args.get('state_machine_arn', None)
+        self.pointer_lookup = dsdt_args.get('pointer_lookup', False)
+        self.canonical_signature = dsdt_args.get('canonical_signature', False)
+        self.ignore_fields = dsdt_args.get('ignore_fields', None) or []
+        # cached outputs larger than this many bytes are returned as a s3 reference, None to always return inline
+        self.offload_threshold = dsdt_args.get('offload_threshold', None)
+        self.codec = dsdt_args.get('codec', Codec.NONE)
+        # stream the output to disk, list-shaped outputs are written as ndjson
+        self.streaming = dsdt_args.get('streaming', False)
+        # outputs carry the uuid of their bundle, the next cached step records it as a dependency
+        self.payload_lineage = dsdt_args.get('payload_lineage', False)
+        # seconds a warm container may miss new bundles, None to pull all metadata on every lookup
+        self.metadata_staleness = dsdt_args.get('metadata_staleness', None)
+        # bytes of bundle data kept in /tmp, least recently used bundles are delocalized beyond it
+        self.local_budget = dsdt_args.get('local_budget', None)
+        # seconds a hit is served from memory by a warm container, None to look up every time
+        self.result_ttl = dsdt_args.get('result_ttl', None)
+        self.result_cache_size = dsdt_args.get('result_cache_size', 128)
+        # single flight: the first miss of a signature holds a lease for lease_ttl seconds while it computes,
+        # other misses wait up to lease_wait seconds for its push. None to disable
+        self.lease_ttl = dsdt_args.get('lease_ttl', None)
+        self.lease_wait = dsdt_args.get('lease_wait', 10)
+        # seconds, hits older than max_age are returned while a refresh execution recomputes them, and are misses
+        # once older than max_age + stale_while_revalidate. None to use hits of any age
+        self.max_age = dsdt_args.get('max_age', None)
+        self.stale_while_revalidate = dsdt_args.get('stale_while_revalidate', 0)
+        # stale hits start a refresh execution of the whole state machine, only if the user opted in
+        self.replay_refresh = dsdt_args.get('replay_refresh', False)
 
-        if self.verbose:
-            level = LOG_LEVEL
-        else:
-            level = LOG_LEVEL + 1
-        if len(logging.getLogger().handlers) > 0:
-            logging.getLogger().setLevel(level=level)
-        else:
-            logging.basicConfig(format='%(asctime)s %(message)s', level=level)
-        # set up local context
-        api.context(self.context)
-        # set up and bind with the remote context
-        api.remote(self.context, remote_context=self.context, remote_url=self.s3_url)
+        setup_logging(self.verbose)
+        # set up the local context and bind it with the remote context, warm containers reuse the binding
+        self.registry_entry = ContextRegistry.bind(self.context, self.s3_url)
 
     def cache_pull(self, event: Any) -> dict:
         """
@@ -87,48 +937,462 @@ class Cache:
                         PathParam.CACHE_PARAM: Any, what parameters to cache ,
                         PathParam.CACHE_DATA: Any, not null if a cache hit,
                         PathParam.USE_CACHE: bool, flag for the choice state }
+            without PathParam.FULL_PARAM in the event (see Caching(project_input=True)), only
+            {PathParam.CACHE_DATA, PathParam.USE_CACHE} is returned, the state machine keeps the rest
         """
-        full_params = event[PathParam.FULL_PARAM]
         cache_params = event[PathParam.CACHE_PARAM]
-        use_cache, cached_data = False, None
         # since all states share the same lambda, we need a better identifier for the logs
         func_name = 'cache_pull_4_{}'.format(self.bundle_name)
         logging.log(level=LOG_LEVEL, msg='{} - received input event {}'.format(func_name, event))
-
-        if not self.force_rerun:
-            signature = {'input_params': json.dumps(cache_params)}
-            # uniquely determine a proc name based on bundle name and signature
-            proc_name = api.Bundle.calc_default_processing_name(self.bundle_name, signature, dep_proc_ids={})
-            # pull bundle meta data from s3
-            api.pull(self.context, self.bundle_name)
-            # search if the proc name exists
-            bundle = api.search(self.context, processing_name=proc_name)
-            # could have multiple hits because of forced reruns
-            if len(bundle) > 0:
-                # use the latest cache data
-                latest_bundle = bundle[0]
-                # check if the signature match
-                logging.log(level=LOG_LEVEL, msg='{} - {} bundles found with name {}'.format(func_name,
-                                                                                              len(bundle),
-                                                                                              self.bundle_name))
-                use_cache = True not in [v != latest_bundle.params.get(k, None)
-                                         for k, v in signature.items()]
-                # if use cache is true, pulls the actual data (the json file that holds the cached data) from s3
-                if use_cache:
-                    api.pull(self.context, uuid=latest_bundle.uuid, localize=True)
-                    file = latest_bundle.data
-                    with open(file, 'r') as fp:
-                        cached_data = json.load(fp)
+        use_cache, cached_data = self.lookup(cache_params)
+        if not use_cache and not self.force_rerun and self.lease_ttl is not None:
+            try:
+                use_cache, cached_data = self.single_flight(cache_params)
+            except Exception as e:
+                # the lease only saves compute, never fail the step because of it
+                logging.log(level=LOG_LEVEL, msg='{} - single flight failed, computing: {}'.format(func_name, e))
         # return the result, full param is what the user step expects to receive, so we need to forward it
         # cache_params is needed by cache push to create bundles
         # cached_data is needed by cache push if use_cache is true
         # use_cache is needed by the choice state
-        data = {PathParam.FULL_PARAM: full_params, PathParam.CACHE_PARAM: cache_params,
-                PathParam.CACHE_DATA: cached_data, PathParam.USE_CACHE: use_cache}
+        data = {PathParam.CACHE_DATA: cached_data, PathParam.USE_CACHE: use_cache}
+        if PathParam.FULL_PARAM in event:
+            data.update({PathParam.FULL_PARAM: event[PathParam.FULL_PARAM], PathParam.CACHE_PARAM: cache_params})
         logging.log(level=LOG_LEVEL, msg='{} - outputs - {}'.format(func_name, data))
         return data
 
-    def cache_push(self, event: Any, parent: Union[None, api.Bundle] = None) -> Any:
+    def lookup(self, cache_params: Any, pull_metadata: bool = True) -> tuple:
+        """
+        find the cached output of the user step for cache_params
+        :param cache_params: Any, parameters consumed by the user step
+        :param pull_metadata: bool, pull bundle metadata from s3 first. Only used without pointer lookup
+        :return: tuple, (use_cache, cached_data)
+        """
+        use_cache, cached_data = False, None
+        func_name = 'cache_pull_4_{}'.format(self.bundle_name)
+        if self.force_rerun:
+            return use_cache, cached_data
+        # the uuids of upstream bundles are not part of the signature
+        cache_params, _ = split_lineage(cache_params)
+        # uniquely determine a proc name based on bundle name and signature
+        candidates = [(signature, api.Bundle.calc_default_processing_name(self.bundle_name, signature,
+                                                                          dep_proc_ids={}))
+                      for signature in Signature.candidates(cache_params, self.canonical_signature, self.ignore_fields)]
+        # stale results in memory must not hide the bundles that a refresh execution recomputes
+        if self.result_ttl is not None and not self.is_refresh():
+            for _, proc_name in candidates:
+                use_cache, cached_data, created = ResultCache.get(self.result_key(proc_name), self.result_ttl)
+                if not use_cache:
+                    continue
+                # results put without the creation time of their bundle cannot be checked against max_age
+                if self.max_age is None or (created is not None and self.fresh_enough(func_name, proc_name, created)):
+                    logging.log(level=LOG_LEVEL, msg='{} - hit in memory {}'.format(func_name, proc_name))
+                    return use_cache, cached_data
+                # expired by max_age, the bundle on s3 may have been refreshed since
+                ResultCache.invalidate(self.result_key(proc_name))
+            use_cache, cached_data = False, None
+        if not self.pointer_lookup and pull_metadata:
+            # pull bundle meta data from s3
+            self.pull_metadata()
+        for signature, proc_name in candidates:
+            if self.pointer_lookup:
+                use_cache, cached_data, created = self._pointer_pull(func_name, proc_name, signature)
+            else:
+                use_cache, cached_data, created = self._search_pull(func_name, proc_name, signature)
+            if use_cache:
+                if self.result_ttl is not None:
+                    ResultCache.put(self.result_key(proc_name), cached_data, self.result_cache_size, created)
+                break
+        return use_cache, cached_data
+
+    def single_flight(self, cache_params: Any) -> tuple:
+        """
+        called on a miss: take the lease of the signature and compute, or wait for the push of the lease holder.
+        Fails open, the step is computed if the lease cannot be used, expires or is not released within lease_wait
+        :return: tuple, (use_cache, cached_data) of the lookup once the lease is released, (False, None) to compute
+        """
+        func_name = 'cache_pull_4_{}'.format(self.bundle_name)
+        cache_params, _ = split_lineage(cache_params)
+        signature = Signature.candidates(cache_params, self.canonical_signature, self.ignore_fields)[0]
+        # the processing name of the bundle that cache push creates
+        proc_name = api.Bundle.calc_default_processing_name(self.bundle_name, signature, dep_proc_ids={})
+        deadline = time.time() + self.lease_wait
+        held = self._acquire_lease(proc_name)
+        while held is not None:
+            if held['expires'] < time.time():
+                # the holder died without pushing
+                logging.log(level=LOG_LEVEL, msg='{} - lease of {} expired, taking over'.format(func_name, proc_name))
+                if not self._break_lease(proc_name, held['etag']):
+                    return False, None
+                held = self._acquire_lease(proc_name)
+                continue
+            if time.time() >= deadline:
+                logging.log(level=LOG_LEVEL, msg='{} - lease of {} still held by {}, computing'
+                            .format(func_name, proc_name, held.get('owner')))
+                return False, None
+            time.sleep(self.LEASE_POLL)
+            held = self._read_lease(proc_name)
+            if held is None:
+                logging.log(level=LOG_LEVEL, msg='{} - lease of {} released'.format(func_name, proc_name))
+                if not self.pointer_lookup:
+                    # the incremental sync may not see the new bundle yet
+                    api.pull(self.context, self.bundle_name)
+                return self.lookup(cache_params, pull_metadata=False)
+        return False, None
+
+    def lease_url(self, proc_name: str) -> str:
+        """
+        :param proc_name: str, processing name of the bundle
+        :return: str, s3 url of the lease object of proc_name
+        """
+        return '{}/{}/{}/{}.json'.format(self.s3_url.rstrip('/'), self.context, PathParam.LEASE_DIR, proc_name)
+
+    def _acquire_lease(self, proc_name: str) -> Union[None, dict]:
+        """
+        create the lease object with a conditional write
+        :return: dict, the lease of another holder. None if this execution holds the lease now, or if the lease
+            cannot be used (fail open)
+        """
+        bucket, key = split_s3_url(self.lease_url(proc_name))
+        for _ in range(self.LEASE_ATTEMPTS):
+            lease = {'owner': self.execution_arn, 'expires': time.time() + self.lease_ttl}
+            try:
+                s3_client().put_object(Bucket=bucket, Key=key, Body=json.dumps(lease).encode('utf-8'),
+                                       IfNoneMatch='*')
+                return None
+            except Exception as e:
+                if error_code(e) not in self.LEASE_CONFLICTS:
+                    logging.log(level=LOG_LEVEL, msg='lease of {} not available, computing: {}'.format(proc_name, e))
+                    return None
+            held = self._read_lease(proc_name)
+            if held is not None:
+                return held
+            # released in the meantime, try again
+        logging.log(level=LOG_LEVEL, msg='lease of {} not acquired after {} attempts, computing'
+                    .format(proc_name, self.LEASE_ATTEMPTS))
+        return None
+
+    def _read_lease(self, proc_name: str) -> Union[None, dict]:
+        """
+        :return: dict, the lease and the 'etag' of the lease object, None if nobody holds the lease
+        """
+        bucket, key = split_s3_url(self.lease_url(proc_name))
+        try:
+            obj = s3_client().get_object(Bucket=bucket, Key=key)
+        except s3_client().exceptions.NoSuchKey:
+            return None
+        return dict(json.load(obj['Body']), etag=obj['ETag'])
+
+    def _break_lease(self, proc_name: str, etag: str) -> bool:
+        """
+        delete an expired lease, only if it is still the lease that was read. Waiters that read the same expired
+        lease race for it, the others find the lease of the winner
+        :param etag: str, ETag of the expired lease object
+        :return: bool, False if the lease cannot be broken (fail open)
+        """
+        bucket, key = split_s3_url(self.lease_url(proc_name))
+        try:
+            s3_client().delete_object(Bucket=bucket, Key=key, IfMatch=etag)
+        except Exception as e:
+            if error_code(e) in self.LEASE_CONFLICTS + ['NoSuchKey']:
+                # taken over or released by another execution
+                return True
+            logging.log(level=LOG_LEVEL, msg='lease of {} not broken, computing: {}'.format(proc_name, e))
+            return False
+        return True
+
+    def _release_lease(self, proc_name: str):
+        bucket, key = split_s3_url(self.lease_url(proc_name))
+        try:
+            s3_client().delete_object(Bucket=bucket, Key=key)
+        except Exception as e:
+            # waiting misses compute once the lease expires
+            logging.log(level=LOG_LEVEL, msg='lease of {} not released: {}'.format(proc_name, e))
+
+    def result_key(self, proc_name: str) -> tuple:
+        """
+        :return: tuple, key of the results of proc_name in ResultCache
+        """
+        return self.context, self.bundle_name, proc_name
+
+    def pull_metadata(self):
+        """
+        pull the metadata of the bundles of bundle_name into the local context, incrementally with metadata_staleness
+        """
+        if self.metadata_staleness is None:
+            api.pull(self.context, self.bundle_name)
+        else:
+            MetadataSync.sync(self.registry_entry, self.bundle_name, self.metadata_staleness)
+
+    @classmethod
+    def batch_pull(cls, event: dict) -> dict:
+        """
+        cache pull for several (bundle_name, cache_params) pairs in one invocation
+        Lookups run concurrently with pointer_lookup. Without it they run one by one, because the local disdat
+        context is not safe to share between threads
+        :param event: dict, {PathParam.BATCH: [{'bundle_name', PathParam.CACHE_PARAM, 'force_rerun'(optional)}]
+                                              or the same items keyed by their position,
+                             PathParam.FULL_PARAM: Any, optional, echoed back,
+                             PathParam.DSDT_ONLY_ARGS: dict, shared by all items}
+        :return: dict, {PathParam.FULL_PARAM: Any,
+                        PathParam.BATCH: [{PathParam.CACHE_PARAM, PathParam.CACHE_DATA, PathParam.USE_CACHE}],
+                                         in input order}
+        """
+        dsdt_args = event[PathParam.DSDT_ONLY_ARGS]
+        items = event[PathParam.BATCH]
+        if isinstance(items, dict):
+            items = [items[k] for k in sorted(items, key=int)]
+        caches = []
+        for item in items:
+            args = dict(dsdt_args, bundle_name=item['bundle_name'])
+            if item.get('force_rerun', None) is not None:
+                args['force_rerun'] = item['force_rerun']
+            caches.append(cls(args))
+        results = cls._lookup_all(caches, [item[PathParam.CACHE_PARAM] for item in items],
+                                  dsdt_args.get('pointer_lookup', False))
+        batch = [{PathParam.CACHE_PARAM: item[PathParam.CACHE_PARAM],
+                  PathParam.CACHE_DATA: cached_data,
+                  PathParam.USE_CACHE: use_cache} for item, (use_cache, cached_data) in zip(items, results)]
+        logging.log(level=LOG_LEVEL, msg='batch_pull - {}/{} hits'.format(sum(r[0] for r in results), len(items)))
+        return {PathParam.FULL_PARAM: event.get(PathParam.FULL_PARAM, None), PathParam.BATCH: batch}
+
+    @classmethod
+    def map_pull(cls, event: dict) -> dict:
+        """
+        look up every item of a Map state at once and keep only the missed items for the Map to run over
+        :param event: dict, {PathParam.FULL_PARAM: Any, input of the Map state,
+                             PathParam.MAP: {'items_path': str, ItemsPath of the Map state},
+                             PathParam.DSDT_ONLY_ARGS: dict}
+        :return: dict, {PathParam.FULL_PARAM: Any, the Map input with only the missed items at items_path,
+                        PathParam.MAP: {'items_path': str,
+                                        'size': int, number of items,
+                                        'miss_idx': list, positions of the missed items,
+                                        'cached': list, cached data of each item, None if missed}}
+        """
+        cache = cls(event[PathParam.DSDT_ONLY_ARGS])
+        items_path = event[PathParam.MAP]['items_path']
+        full_params = event[PathParam.FULL_PARAM]
+        items = get_path(full_params, items_path)
+        if not cache.pointer_lookup and not cache.force_rerun:
+            # all items share the bundle name, metadata only needs to be pulled once
+            cache.pull_metadata()
+        results = cls._lookup_all([cache] * len(items), items, cache.pointer_lookup, pull_metadata=False)
+        miss_idx = [idx for idx, (use_cache, _) in enumerate(results) if not use_cache]
+        logging.log(level=LOG_LEVEL, msg='map_pull_4_{} - {}/{} hits'.format(cache.bundle_name,
+                                                                            len(items) - len(miss_idx), len(items)))
+        return {PathParam.FULL_PARAM: set_path(full_params, items_path, [items[idx] for idx in miss_idx]),
+                PathParam.MAP: {'items_path': items_path,
+                                'size': len(items),
+                                'miss_idx': miss_idx,
+                                'cached': [cached_data for _, cached_data in results]}}
+
+    @classmethod
+    def map_push(cls, event: dict) -> list:
+        """
+        merge the outputs of the missed items with the cached ones in the original item order. The outputs were
+        pushed by the iterations of the Map state, see Caching.cache_map
+        :param event: dict, {PathParam.FULL_PARAM: Any, the Map input returned by map_pull,
+                             PathParam.MAP: dict, returned by map_pull,
+                             PathParam.MAP_RESULTS: list, output of the Map state over the missed items,
+                             PathParam.DSDT_ONLY_ARGS: dict}
+        :return: list, output of every item, as the Map state would have returned it
+        """
+        map_args = event[PathParam.MAP]
+        missed = get_path(event[PathParam.FULL_PARAM], map_args['items_path'])
+        outputs = event[PathParam.MAP_RESULTS]
+        assert len(missed) == len(outputs) == len(map_args['miss_idx']), 'Map output does not match missed items'
+        merged = list(map_args['cached'])
+        for idx, output in zip(map_args['miss_idx'], outputs):
+            merged[idx] = output
+        logging.log(level=LOG_LEVEL, msg='map_push_4_{} - {} items merged'.format(
+            event[PathParam.DSDT_ONLY_ARGS]['bundle_name'], len(outputs)))
+        return merged
+
+    @classmethod
+    def _lookup_all(cls, caches: list, params: list, concurrent_lookup: bool, pull_metadata: bool = True) -> list:
+        """
+        :return: list, (use_cache, cached_data) of caches[i].lookup(params[i]), in input order
+        """
+        workers = min(cls.BATCH_WORKERS, len(params)) if concurrent_lookup else 1
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(workers, 1)) as pool:
+            return list(pool.map(lambda c, p: c.lookup(p, pull_metadata), caches, params))
+
+    def _search_pull(self, func_name: str, proc_name: str, signature: dict) -> tuple:
+        """
+        find the latest bundle with proc_name in the local context, bundle metadata must have been pulled
+        :return: tuple, (use_cache, cached_data, creation time of the bundle, None on a miss)
+        """
+        use_cache, cached_data, created = False, None, None
+        # search if the proc name exists
+        bundle = api.search(self.context, processing_name=proc_name)
+        # could have multiple hits because of forced reruns
+        if len(bundle) > 0:
+            # use the latest cache data
+            latest_bundle = bundle[0]
+            # check if the signature match
+            logging.log(level=LOG_LEVEL, msg='{} - {} bundles found with name {}'.format(func_name,
+                                                                                          len(bundle),
+                                                                                          self.bundle_name))
+            use_cache = True not in [v != latest_bundle.params.get(k, None)
+                                     for k, v in signature.items()]
+            use_cache = use_cache and self.fresh_enough(func_name, proc_name, latest_bundle.creation_date)
+            # if use cache is true, pulls the actual data (the json file that holds the cached data) from s3
+            codec = latest_bundle.params.get(Codec.PARAM_KEY, Codec.NONE)
+            fmt = latest_bundle.params.get(Codec.FORMAT_KEY, Codec.JSON)
+            if use_cache and self.offload_threshold is not None:
+                # the data stays on s3 if it is too large for the state payload
+                data_url = os.path.join(latest_bundle.remote_dir, Codec.file_name(codec, fmt))
+                cached_data = self._remote_cached_data(data_url, latest_bundle.uuid, codec, fmt)
+            elif use_cache:
+                file = LocalBundleStore.localize(self.context, latest_bundle, self.local_budget)
+                with open(file, 'rb') as fp:
+                    cached_data = Codec.load(fp, codec, fmt)
+            if use_cache and self.payload_lineage:
+                cached_data = attach_lineage(cached_data, [Dependency(proc_name, latest_bundle.uuid)])
+            if use_cache:
+                created = latest_bundle.creation_date
+        return use_cache, cached_data, created
+
+    def _pointer_pull(self, func_name: str, proc_name: str, signature: dict) -> tuple:
+        """
+        resolve a hit or miss with a single GET on the pointer object written by cache_push,
+        the cost does not depend on how many versions the bundle has
+        :return: tuple, (use_cache, cached_data, creation time of the bundle, None on a miss)
+        """
+        pointer = self._read_pointer(proc_name)
+        if pointer is None:
+            logging.log(level=LOG_LEVEL, msg='{} - no pointer found for {}'.format(func_name, proc_name))
+            return False, None, None
+        use_cache = True not in [v != pointer['params'].get(k, None) for k, v in signature.items()]
+        use_cache = use_cache and self.fresh_enough(func_name, proc_name, pointer['created'])
+        if not use_cache:
+            return False, None, None
+        logging.log(level=LOG_LEVEL, msg='{} - pointer hit, bundle {}'.format(func_name, pointer['uuid']))
+        cached_data = self._remote_cached_data(pointer['data'], pointer['uuid'], pointer.get('codec'),
+                                               pointer.get('format', Codec.JSON))
+        if self.payload_lineage:
+            cached_data = attach_lineage(cached_data, [Dependency(proc_name, pointer['uuid'])])
+        return use_cache, cached_data, pointer['created']
+
+    def _remote_cached_data(self, data_url: str, uuid: str, codec: str, fmt: str) -> Any:
+        """
+        read the cached data file from s3, or only HEAD it and return a reference if it exceeds the offload threshold
+        """
+        bucket, key = split_s3_url(data_url)
+        if self.offload_threshold is not None:
+            size = s3_client().head_object(Bucket=bucket, Key=key)['ContentLength']
+            if size > self.offload_threshold:
+                return make_reference(data_url, uuid, size, codec, fmt)
+        return Codec.load(s3_client().get_object(Bucket=bucket, Key=key)['Body'], codec, fmt)
+
+    def fresh_enough(self, func_name: str, proc_name: str, created: float) -> bool:
+        """
+        freshness policy of a hit: fresh hits are used, stale hits (within the stale_while_revalidate window) are used
+        and trigger a refresh, older hits are not used
+        :param created: float, creation time of the bundle
+        :return: bool, True if the hit can be used
+        """
+        if self.max_age is None:
+            return True
+        if self.refreshing(proc_name):
+            logging.log(level=LOG_LEVEL, msg='{} - refreshing {}'.format(func_name, proc_name))
+            return False
+        age = time.time() - created
+        if age <= self.max_age:
+            return True
+        if age > self.max_age + self.stale_while_revalidate:
+            logging.log(level=LOG_LEVEL, msg='{} - hit expired, {:.0f}s old'.format(func_name, age))
+            return False
+        logging.log(level=LOG_LEVEL, msg='{} - stale hit, {:.0f}s old'.format(func_name, age))
+        try:
+            self.trigger_refresh(proc_name)
+        except Exception as e:
+            # the stale hit is still used, the next one tries again
+            logging.log(level=LOG_LEVEL, msg='{} - refresh of {} not started: {}'.format(func_name, proc_name, e))
+        return True
+
+    def trigger_refresh(self, proc_name: str) -> Union[None, str]:
+        """
+        start an execution of the state machine with the input of this execution, in which cache pull treats the
+        stale hit of proc_name as a miss. Stale steps of the same execution share the refresh execution, and a
+        refresh does not trigger another one. The refresh replays every step that is not cached, it only starts with
+        replay_refresh
+        :return: str, arn of the refresh execution, None if no refresh was started
+        """
+        if not self.replay_refresh:
+            return None
+        if self.execution_arn is None or self.state_machine_arn is None or self.is_refresh():
+            return None
+        marker = self._read_refresh(proc_name)
+        if marker is not None and marker['expires'] > time.time():
+            # a refresh is already running
+            return None
+        name = self.REFRESH_PREFIX + hashlib.sha256(self.execution_arn.encode('utf-8')).hexdigest()[:32]
+        refresh_arn = '{}:{}'.format(self.state_machine_arn.replace(':stateMachine:', ':execution:'), name)
+        # a failed refresh is tried again once the marker expires
+        marker = {'execution': refresh_arn, 'expires': time.time() + max(self.stale_while_revalidate, 60)}
+        bucket, key = split_s3_url(self.refresh_url(proc_name))
+        s3_client().put_object(Bucket=bucket, Key=key, Body=json.dumps(marker).encode('utf-8'))
+        execution_input = sfn_client().describe_execution(executionArn=self.execution_arn)['input']
+        try:
+            sfn_client().start_execution(stateMachineArn=self.state_machine_arn, name=name, input=execution_input)
+        except sfn_client().exceptions.ExecutionAlreadyExists:
+            # started by another stale step of this execution
+            pass
+        logging.log(level=LOG_LEVEL, msg='refresh of {} in {}'.format(proc_name, refresh_arn))
+        return refresh_arn
+
+    def refreshing(self, proc_name: str) -> bool:
+        """
+        :return: bool, True if this execution was started to refresh proc_name
+        """
+        if not self.is_refresh():
+            return False
+        marker = self._read_refresh(proc_name)
+        return marker is not None and marker['execution'] == self.execution_arn
+
+    def is_refresh(self) -> bool:
+        """
+        :return: bool, True if this execution was started by trigger_refresh
+        """
+        return self.execution_arn is not None and self.execution_arn.split(':')[-1].startswith(self.REFRESH_PREFIX)
+
+    def refresh_url(self, proc_name: str) -> str:
+        """
+        :param proc_name: str, processing name of the bundle
+        :return: str, s3 url of the refresh marker of proc_name
+        """
+        return '{}/{}/{}/{}.json'.format(self.s3_url.rstrip('/'), self.context, PathParam.REFRESH_DIR, proc_name)
+
+    def _read_refresh(self, proc_name: str) -> Union[None, dict]:
+        bucket, key = split_s3_url(self.refresh_url(proc_name))
+        try:
+            return json.load(s3_client().get_object(Bucket=bucket, Key=key)['Body'])
+        except s3_client().exceptions.NoSuchKey:
+            return None
+
+    def pointer_url(self, proc_name: str) -> str:
+        """
+        :param proc_name: str, processing name of the bundle
+        :return: str, deterministic s3 url of the pointer object of proc_name
+        """
+        return '{}/{}/{}/{}.json'.format(self.s3_url.rstrip('/'), self.context, PathParam.POINTER_DIR, proc_name)
+
+    def _read_pointer(self, proc_name: str) -> Union[None, dict]:
+        bucket, key = split_s3_url(self.pointer_url(proc_name))
+        try:
+            return json.load(s3_client().get_object(Bucket=bucket, Key=key)['Body'])
+        except s3_client().exceptions.NoSuchKey:
+            return None
+
+    def _write_pointer(self, proc_name: str, signature: dict, uuid: str, data_url: str, fmt: str):
+        pointer = {'uuid': uuid, 'bundle_name': self.bundle_name, 'processing_name': proc_name,
+                   'params': signature, 'data': data_url, 'codec': self.codec, 'format': fmt,
+                   'created': time.time()}
+        bucket, key = split_s3_url(self.pointer_url(proc_name))
+        s3_client().put_object(Bucket=bucket, Key=key, Body=json.dumps(pointer).encode('utf-8'))
+
+    def cache_push(self, event: Any, parent: Union[None, 'api.Bundle'] = None) -> Any:
         """
         pushes data to the remote context is use cache is false
         otherwise simply parse the input event and return the cached data
@@ -152,77 +1416,197 @@ class Cache:
         elif isinstance(full_params, list):
             # get the parameters that the user step used to generate output
             if PathParam.CACHE_PARAM in full_params[0]:
-                cache_params = full_params[0][PathParam.CACHE_PARAM]
-                params_to_save = full_params[1]
+                passed, params_to_save = full_params
             elif PathParam.CACHE_PARAM in full_params[1]:
-                cache_params = full_params[1][PathParam.CACHE_PARAM]
-                params_to_save = full_params[0]
+                params_to_save, passed = full_params
             else:
                 raise ValueError('Key _cache_params is expected but not present')
-            # create bundle signature
-            signature = {'input_params': json.dumps(cache_params)}
-            proc_name = api.Bundle.calc_default_processing_name(self.bundle_name, signature, dep_proc_ids={})
-            with api.Bundle(self.context, name=self.bundle_name, processing_name=proc_name) as b:
-                # write the output data to a json file. This will speed up caching pull
-                # because we only pull the actual data after a signature match
-                file = b.get_file('cached_data.json')
-                with open(file, 'w') as f:
-                    json.dump(params_to_save, f)
-                b.add_params(signature)
-                b.add_data(file)
-                if parent is not None:
-                    b.add_dependencies(parent)
-
-            # commit and push the data to the remote context
-            api.commit(self.context, self.bundle_name)
-            api.push(self.context, bundle_name=self.bundle_name, delocalize=self.delocalize)
-            logging.log(level=LOG_LEVEL,
-                        msg='{} - data pushed. Cached parameters: {}, cached data: {}'\
-                        .format(func_name, cache_params, params_to_save))
-            return params_to_save
+            output = self.push(passed[PathParam.CACHE_PARAM], params_to_save, parent)
+            if PathParam.HIT_KEY in passed:
+                # the state machine computed the key of the hit object, see Caching.cache_step_sdk
+                self.write_hit(passed[PathParam.HIT_KEY], output)
+            return output
 
         else:
             raise TypeError("field {} must have type dict or list; {} is provided".format(
                 PathParam.FULL_PARAM, type(full_params)))
 
+    def cache_push_lean(self, event: dict, parent: Union[None, 'api.Bundle'] = None) -> dict:
+        """
+        cache push of the lean wrapper, only called on a cache miss, see Caching(lean_wrapper=True)
+        :param event: dict, {PathParam.CACHE_PARAM: Any, PathParam.OUTPUT: Any, output of the user step}
+        :param parent: api.Bundle, parent bundle
+        :return: dict, {PathParam.CACHE_DATA: Any}, the same output format as a cache hit
+        """
+        logging.log(level=LOG_LEVEL, msg='cache_push_4_{} - received input event {}'.format(self.bundle_name, event))
+        if not event.get(PathParam.ASYNC, False):
+            return {PathParam.CACHE_DATA: self.push(event[PathParam.CACHE_PARAM], event[PathParam.OUTPUT], parent)}
+        # invoked with InvocationType=Event, nobody waits for the result. A failed push leaves a dead letter
+        # before lambda retries it, see replay_dead_letters
+        try:
+            self.push(event[PathParam.CACHE_PARAM], event[PathParam.OUTPUT], parent)
+        except Exception as e:
+            bucket, key = split_s3_url(self.dead_letter_url(event))
+            letter = {'event': event, 'error': repr(e), 'created': time.time()}
+            s3_client().put_object(Bucket=bucket, Key=key, Body=json.dumps(letter).encode('utf-8'))
+            logging.log(level=LOG_LEVEL, msg='cache_push_4_{} - push failed, dead letter {}'.format(self.bundle_name,
+                                                                                                   key))
+            raise
+        return {}
+
+    def dead_letter_url(self, event: dict) -> str:
+        """
+        :param event: dict, event of an asynchronous cache push
+        :return: str, s3 url of the dead letter of event, retries of the same event share it
+        """
+        digest = hashlib.sha256(json.dumps(event, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+        return '{}/{}/{}/{}/{}.json'.format(self.s3_url.rstrip('/'), self.context, PathParam.DEAD_LETTER_DIR,
+                                            self.bundle_name, digest)
+
+    @classmethod
+    def replay_dead_letters(cls, dsdt_args: dict, push: bool = True) -> dict:
+        """
+        verify the asynchronous pushes that failed: a dead letter whose bundle exists (a retry succeeded) is durable,
+        the others are pushed again if push is set. Dead letters are deleted once their bundle exists
+        :param dsdt_args: dict, {'context', 's3_bucket_url', 'bundle_name'(optional, all bundles if not set)}
+        :param push: bool, push the missing bundles again, otherwise only report them
+        :return: dict, {'durable': list, 'pushed': list, 'missing': list, 'failed': list} of dead letter keys
+        """
+        prefix = '{}/{}/{}/'.format(dsdt_args['s3_bucket_url'].rstrip('/'), dsdt_args['context'],
+                                    PathParam.DEAD_LETTER_DIR)
+        if dsdt_args.get('bundle_name', None) is not None:
+            prefix += dsdt_args['bundle_name'] + '/'
+        bucket, prefix = split_s3_url(prefix)
+        report = {'durable': [], 'pushed': [], 'missing': [], 'failed': []}
+        for page in s3_client().get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=prefix):
+            for obj in page.get('Contents', []):
+                event = json.load(s3_client().get_object(Bucket=bucket, Key=obj['Key'])['Body'])['event']
+                # the freshness and lease settings do not apply to the replay
+                args = dict(event[PathParam.DSDT_ONLY_ARGS], force_rerun=False, result_ttl=None, max_age=None)
+                cache = cls(args)
+                try:
+                    use_cache, _ = cache.lookup(event[PathParam.CACHE_PARAM])
+                    if use_cache:
+                        report['durable'].append(obj['Key'])
+                    elif push:
+                        cache.push(event[PathParam.CACHE_PARAM], event[PathParam.OUTPUT])
+                        report['pushed'].append(obj['Key'])
+                    else:
+                        report['missing'].append(obj['Key'])
+                        continue
+                except Exception as e:
+                    logging.log(level=LOG_LEVEL, msg='replay of {} failed: {}'.format(obj['Key'], e))
+                    report['failed'].append(obj['Key'])
+                    continue
+                s3_client().delete_object(Bucket=bucket, Key=obj['Key'])
+        logging.log(level=LOG_LEVEL, msg='dead letters - {}'.format({k: len(v) for k, v in report.items()}))
+        return report
+
+    def push(self, cache_params: Any, params_to_save: Any, parent: Union[None, 'api.Bundle'] = None) -> Any:
+        """
+        create a bundle that holds the output of the user step and push it to the remote context
+        :param cache_params: Any, parameters consumed by the user step
+        :param params_to_save: Any, data output by the user step
+        :param parent: api.Bundle, upstream bundle to record as a dependency
+        :return: Any, params_to_save, or a reference to it if it exceeds the offload threshold
+        """
+        func_name = 'cache_push_4_{}'.format(self.bundle_name)
+        # lineage fields are never cached, the inputs give the upstream bundles with payload lineage
+        cache_params, upstream = split_lineage(cache_params)
+        params_to_save, _ = split_lineage(params_to_save)
+        dependencies = [parent] if parent is not None else []
+        if self.payload_lineage:
+            dependencies += upstream
+        # create bundle signature
+        signature = Signature.candidates(cache_params, self.canonical_signature, self.ignore_fields)[0]
+        proc_name = api.Bundle.calc_default_processing_name(self.bundle_name, signature, dep_proc_ids={})
+        with api.Bundle(self.context, name=self.bundle_name, processing_name=proc_name) as b:
+            # write the output data to a json file. This will speed up caching pull
+            # because we only pull the actual data after a signature match
+            fmt = Codec.NDJSON if self.streaming and isinstance(params_to_save, list) else Codec.JSON
+            file = b.get_file(Codec.file_name(self.codec, fmt))
+            with open(file, 'wb') as f:
+                Codec.dump(params_to_save, f, self.codec, fmt, streaming=self.streaming)
+            b.add_params(signature)
+            # readers pick the decoder from the bundle params
+            if self.codec != Codec.NONE:
+                b.add_params({Codec.PARAM_KEY: self.codec})
+            if fmt != Codec.JSON:
+                b.add_params({Codec.FORMAT_KEY: fmt})
+            b.add_data(file)
+            if len(dependencies) > 0:
+                b.add_dependencies(dependencies)
+            data_url = b.get_remote_file(Codec.file_name(self.codec, fmt))
+            data_size = os.path.getsize(file)
+
+        # the result in memory is superseded by the new bundle
+        ResultCache.invalidate(self.result_key(proc_name))
+        # commit and push the data to the remote context
+        api.commit(self.context, self.bundle_name)
+        api.push(self.context, bundle_name=self.bundle_name, delocalize=self.delocalize)
+        if not self.delocalize:
+            LocalBundleStore.add(b.uuid, file, self.local_budget)
+        # the pointer is written after the push so that it never refers to data missing on s3
+        if self.pointer_lookup:
+            self._write_pointer(proc_name, signature, b.uuid, data_url, fmt)
+        if self.lease_ttl is not None:
+            # misses waiting for this push look up again
+            self._release_lease(proc_name)
+        if self.refreshing(proc_name):
+            bucket, key = split_s3_url(self.refresh_url(proc_name))
+            s3_client().delete_object(Bucket=bucket, Key=key)
+        logging.log(level=LOG_LEVEL,
+                    msg='{} - data pushed. Cached parameters: {}, cached data: {}'\
+                    .format(func_name, cache_params, params_to_save))
+        output = params_to_save
+        if self.offload_threshold is not None and data_size > self.offload_threshold:
+            output = make_reference(data_url, b.uuid, data_size, self.codec, fmt)
+        if self.payload_lineage:
+            output = attach_lineage(output, [Dependency(proc_name, b.uuid)])
+        return output
+
+    def write_hit(self, key: str, output: Any):
+        """
+        write the output of the user step to a hit object that the state machine reads with a s3 GetObject
+        integration on later executions. The object is plain json, state machines cannot decompress
+        :param key: str, key of the hit object in the bucket of the remote context
+        :param output: Any, output of cache push (data or a reference to it)
+        """
+        bucket, _ = split_s3_url(self.s3_url)
+        s3_client().put_object(Bucket=bucket, Key=key, Body=json.dumps({'data': output}).encode('utf-8'),
+                               ContentType='application/json')
+        logging.log(level=LOG_LEVEL, msg='cache_push_4_{} - hit object written to {}'.format(self.bundle_name, key))
+
     def get_lineage(self):
         logging.log(level=LOG_LEVEL, msg='run lineage tracing for {}'.format(self.state_machine_name))
-        logs = self._get_execution_history_by_name(self.state_machine_name)
+        logs = self._get_execution_history()
         parent_exec = self.lineage_tracer(logs, self.bundle_name)
         return self._get_bundle(parent_exec)
 
-    def _get_execution_history_by_name(self, workflow_name):
-        client = boto3.client('stepfunctions')
-        workflow = []
+    def _get_execution_arn(self) -> str:
+        """
+        :return: str, arn of the current execution, looked up if the state machine did not pass it
+        """
+        if self.execution_arn is not None:
+            return self.execution_arn
+        sm_arn = self.state_machine_arn or StateMachineRegistry.arn(self.state_machine_name)
+        curr_execs = sfn_client().list_executions(stateMachineArn=sm_arn, statusFilter='RUNNING')['executions']
+        assert len(curr_execs) <= 1, 'lineage capture may be incorrect if you have ' \
+                                     'current executions, disabling lineage'
+        return curr_execs[0]['executionArn']
+
+    def _get_execution_history(self):
+        """
+        :return: generator of event pages, newest first. Yields None if the history cannot be read
+        """
         try:
-            response = client.list_state_machines(maxResults=100)
-            workflow += response['stateMachines']
-            while 'nextToken' in response:
-                response = client.list_state_machines(maxResults=100, nextToken=response['nextToken'])
-                workflow += response['stateMachines']
-
-            state_machine = [w for w in workflow if w['name'] == workflow_name]
-            sm_arn = state_machine[0]['stateMachineArn']
-
-            curr_execs = client.list_executions(stateMachineArn=sm_arn, statusFilter='RUNNING')['executions']
-            assert len(curr_execs) <= 1, 'lineage capture may be incorrect if you have ' \
-                                         'current executions, disabling lineage'
-            logs = client.get_execution_history(executionArn=curr_execs[0]['executionArn'],
-                                                maxResults=1000,
-                                                reverseOrder=True)
-            start = True
-            while 'nextToken' in logs or start:
-                if start:
-                    logs = client.get_execution_history(executionArn=curr_execs[0]['executionArn'],
-                                                        maxResults=1000,
-                                                        reverseOrder=True)
-                else:
-                    logs = client.get_execution_history(executionArn=curr_execs[0]['executionArn'],
-                                                        maxResults=1000,
-                                                        reverseOrder=True,
-                                                        nextToken=logs['nextToken'])
-                start = False
+            kwargs = {'executionArn': self._get_execution_arn(), 'maxResults': 1000, 'reverseOrder': True}
+            while True:
+                logs = sfn_client().get_execution_history(**kwargs)
                 yield logs['events']
+                if 'nextToken' not in logs:
+                    break
+                kwargs['nextToken'] = logs['nextToken']
 
         except Exception as e:
             logging.warning('lambda failed to retrieve execution log. Check your lambda permission!')
@@ -231,90 +1615,72 @@ class Cache:
 
     @classmethod
     def lineage_tracer(cls, logs, bundle_name: str) -> Union[None, 'ExecutionEvent']:
+        """
+        find the closest cached ancestor of the latest cache pull of bundle_name in a single pass over the history
+        :param logs: iterable of event pages, newest first (as returned by get_execution_history with reverseOrder)
+        :param bundle_name: str, bundle name of the cached state being pushed
+        :return: ExecutionEvent, the cache pull exit of the parent bundle; None if there is none
+        """
         target_name = 'cache_pull_{}'.format(bundle_name)
-        target_node = None
         events_by_id = {}
-        children_by_id = collections.defaultdict(set)
+        # deepest ancestor of the target resolved so far, the walk resumes there after each page
+        cursor = None
 
         for page in logs:
             if page is None:
                 return None
-            # build partial DAG
             for event in page:
-                event_id, parent_id = event['id'], event['previousEventId']
-                children_by_id[parent_id].add(event_id)
-
-                if event_id not in event:
-                    events_by_id[event_id] = ExecutionEvent(event)
-                event_obj = events_by_id[event_id]
-                if event_id in children_by_id:
-                    for child_id in children_by_id[event_id]:
-                        if events_by_id[child_id].parent is None:
-                            events_by_id[child_id].parent = event_obj
-                            print(events_by_id[child_id])
-            # find the target node
-            for node in events_by_id.values():
-                if node.name is not None and node.name == target_name:
-                    target_node = node
-                    break
-            # target node not found in this page, go to the next page
-            if target_node is None:
+                node = ExecutionEvent(event)
+                events_by_id[node.id] = node
+                if cursor is None and node.name == target_name:
+                    cursor = node
+            # target node not found yet, go to the next page
+            if cursor is None:
                 continue
-
-            parent_id = target_node.find_prev_bundle()
-            if parent_id is None:
-                continue
-            else:
-                return events_by_id[parent_id]
+            # events point to older events, which come in the same or later pages
+            while cursor.parent_id in events_by_id:
+                cursor = events_by_id[cursor.parent_id]
+                if cursor.bundle_name is not None:
+                    return cursor
+            if not cursor.parent_id:
+                # reached the start of the execution
+                return None
         # parent bundle not found
-        # print([str(event_obj) for event_obj in events_by_id.values()])
         return None
 
-    def _get_bundle(self, execution) -> Union[None, api.Bundle]:
+    def _get_bundle(self, execution) -> Union[None, 'api.Bundle']:
         if execution is None:
             return None
         parent_bundle_name = execution.bundle_name
-        output_params = json.loads(execution.full_event['stateExitedEventDetails']['output'])
+        output_params = json.loads(execution.output)
         cache_params = output_params[PathParam.CACHE_PARAM]
-        signature = {'input_params': json.dumps(cache_params)}
-        proc_name = api.Bundle.calc_default_processing_name(parent_bundle_name, signature, dep_proc_ids={})
         api.pull(self.context, parent_bundle_name)
-        bundles = api.search(self.context, parent_bundle_name, processing_name=proc_name)
-        return bundles[0] if len(bundles) > 0 else None
+        for signature in Signature.candidates(cache_params, self.canonical_signature, self.ignore_fields):
+            proc_name = api.Bundle.calc_default_processing_name(parent_bundle_name, signature, dep_proc_ids={})
+            bundles = api.search(self.context, parent_bundle_name, processing_name=proc_name)
+            if len(bundles) > 0:
+                return bundles[0]
+        return None
 
 
 class ExecutionEvent:
+    """
+    compact view of an execution history event. Only the exits of cache pull states keep a name and their output
+    """
+    __slots__ = ('id', 'parent_id', 'name', 'bundle_name', 'output')
+
     def __init__(self, event: dict):
-        self.full_event = event
-        self.id = self.full_event['id']
+        self.id = event['id']
+        self.parent_id = event.get('previousEventId', None)
         self.name = None
-        self.parent = None
         self.bundle_name = None
-        # self.children = None
-
-        if 'stateExitedEventDetails' in self.full_event and 'name' in self.full_event['stateExitedEventDetails']:
-            name = self.full_event['stateExitedEventDetails']['name']
-            if name.startswith('cache_pull'):
-                self.name = name
-                self.bundle_name = self.name[len('cache_pull_'):]
-
-    def find_prev_bundle(self) -> Union[None, str]:
-        parent = self.parent
-        counter = 0
-        while parent is not None:
-
-            if parent.bundle_name is not None:
-                counter += 1
-                if counter > 1:
-                    return parent.id
-            else:
-                parent = parent.parent
-        return None
+        self.output = None
 
-    # def find_next_bundle(self) -> Union[None, set]:
-    #
-    #     children = self.children
+        details = event.get('stateExitedEventDetails', None)
+        if details is not None and details.get('name', '').startswith('cache_pull'):
+            self.name = details['name']
+            self.bundle_name = self.name[len('cache_pull_'):]
+            self.output = details.get('output', None)
 
     def __str__(self):
-        return '{} -> {}; Name={}; bundle={}'.format(self.id, self.parent.id if self.parent else None,
-                                                     self.name, self.bundle_name)
\ No newline at end of file
+        return '{} -> {}; Name={}; bundle={}'.format(self.id, self.parent_id, self.name, self.bundle_name)
\ No newline at end of file
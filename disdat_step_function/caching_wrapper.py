@@ -16,15 +16,22 @@
 """
 
 
+import ast
+import collections
+import fnmatch
+import hashlib
+import json
 import pathlib
+import subprocess
 import time
 from typing import Union
 from stepfunctions import steps, inputs
 from stepfunctions.steps import states
 from stepfunctions.steps.fields import Field
 import os
+import shlex
 import shutil
-from disdat_step_function.cache_lambda import PathParam as pp
+from disdat_step_function.cache_lambda import PathParam as pp, Codec, hit_key_prefix, split_s3_url
 import logging
 
 
@@ -36,7 +43,23 @@ class Caching:
                  context_name: str,
                  state_machine_name: str = '',
                  force_rerun: bool = False,
-                 verbose: bool = False):
+                 verbose: bool = False,
+                 pointer_lookup: bool = False,
+                 canonical_signature: bool = False,
+                 ignore_fields: list = None,
+                 offload_threshold: int = None,
+                 codec: str = Codec.NONE,
+                 streaming: bool = False,
+                 lean_wrapper: bool = False,
+                 project_input: bool = False,
+                 payload_lineage: bool = False,
+                 metadata_staleness: float = None,
+                 local_budget: int = None,
+                 result_ttl: float = None,
+                 result_cache_size: int = 128,
+                 lease_ttl: float = None,
+                 lease_wait: float = 10,
+                 async_push: bool = False):
         """
         This class initializes a caching object that contains basic specs of the caching layer
         :param caching_lambda_name: str, name of the lambda function. For instance 'caching-lambda'
@@ -44,6 +67,41 @@ class Caching:
         :param context_name: str, the name of the context in which data versions are managed
         :param force_rerun: bool, rerun states by force
         :param verbose: bool, true to see detailed logs from the caching code
+        :param pointer_lookup: bool, resolve cache hits with a single GET on a pointer object written by cache push,
+            instead of pulling the metadata of every version of the bundle
+        :param canonical_signature: bool, derive the processing name from a key-order independent encoding of the
+            cache params. Bundles created with the legacy encoding are still found by cache pull
+        :param ignore_fields: list, dot separated fields of the cache params that do not affect the output,
+            e.g ['meta.request_id']. Only used with canonical_signature
+        :param offload_threshold: int, cached outputs larger than this many bytes are returned as a s3 reference
+            instead of inline data, see cache_lambda.resolve_reference. None to always return data inline
+        :param codec: str, compression of the cached data file, 'none', 'gzip' or 'zstd' (needs the zstandard package
+            in the lambda layer). Readers pick the decoder from the bundle, so the codec can be changed at any time
+        :param streaming: bool, stream cached outputs to disk instead of encoding them in one shot. List outputs are
+            stored as ndjson, so readers (see cache_lambda.iter_reference) can go through them item by item
+        :param lean_wrapper: bool, run the user step directly after the choice state and carry the cache params with
+            ResultPath instead of a Parallel state. Steps with a custom ResultPath or OutputPath keep the full wrapper
+        :param project_input: bool, only send the cache params to the caching lambda and merge its result into the
+            state input with ResultPath, instead of a round trip of the full state input. Requires lean_wrapper
+        :param payload_lineage: bool, dict outputs of cached steps carry the uuid of their bundle in a _dsdt_lineage
+            field, and cached steps that consume it record the bundle as a dependency, without reading the history
+        :param metadata_staleness: float, seconds. Warm caching lambdas pull the bundle metadata incrementally and at
+            most once in this window, so hits on bundles pushed by other containers may be missed for this long.
+            None to pull the metadata of every version of the bundle on every lookup. Not used with pointer_lookup
+        :param local_budget: int, bytes of bundle data a warm caching lambda keeps in /tmp. Hits on local bundles
+            skip s3, the least recently used bundles are delocalized beyond the budget. None for no limit
+        :param result_ttl: float, seconds a warm caching lambda serves a hit from memory, without pulling metadata or
+            reading the cached data again. Bundles pushed by other containers are seen after it. None to disable
+        :param result_cache_size: int, number of hits a caching lambda keeps in memory
+        :param lease_ttl: float, seconds. The first miss of a signature holds a lease (an s3 object created with a
+            conditional write) while the user step runs, concurrent misses wait for its push instead of computing
+            a duplicate bundle. Set it above the run time of the user steps, a lease that is not released after it
+            is taken over. None to disable
+        :param lease_wait: float, seconds a miss waits for the lease holder before computing anyway. Keep it below
+            the timeout of the caching lambda
+        :param async_push: bool, invoke cache push with InvocationType=Event, the user step output goes to the next
+            state without waiting for the push. Failed pushes leave a dead letter, see Cache.replay_dead_letters.
+            Requires lean_wrapper, and cannot be combined with payload_lineage (the bundle is not known yet)
         """
         self.caching_lambda = caching_lambda_name
         self.s3_bucket = s3_bucket_url
@@ -51,17 +109,77 @@ class Caching:
         self.force_rerun = force_rerun
         self.state_machine_name = state_machine_name
         self.verbose = verbose
+        self.pointer_lookup = pointer_lookup
+        self.canonical_signature = canonical_signature
+        self.ignore_fields = ignore_fields or []
+        self.offload_threshold = offload_threshold
+        self.codec = codec
+        self.streaming = streaming
+        self.lean_wrapper = lean_wrapper
+        self.project_input = project_input
+        self.payload_lineage = payload_lineage
+        self.metadata_staleness = metadata_staleness
+        self.local_budget = local_budget
+        self.result_ttl = result_ttl
+        self.result_cache_size = result_cache_size
+        self.lease_ttl = lease_ttl
+        self.lease_wait = lease_wait
+        self.async_push = async_push
         # kwargs passed to the caching lambda, users don't need to worry about this
         self.disdat_args = {'s3_bucket_url': self.s3_bucket,
                             'context': self.context_name,
                             'force_rerun': self.force_rerun,
                             'verbose': self.verbose,
-                            'state_machine_name': self.state_machine_name}
+                            'state_machine_name': self.state_machine_name,
+                            'pointer_lookup': self.pointer_lookup,
+                            'canonical_signature': self.canonical_signature,
+                            'ignore_fields': self.ignore_fields,
+                            'offload_threshold': self.offload_threshold,
+                            'codec': self.codec,
+                            'streaming': self.streaming,
+                            'payload_lineage': self.payload_lineage,
+                            'metadata_staleness': self.metadata_staleness,
+                            'local_budget': self.local_budget,
+                            'result_ttl': self.result_ttl,
+                            'result_cache_size': self.result_cache_size,
+                            'lease_ttl': self.lease_ttl,
+                            'lease_wait': self.lease_wait,
+                            # resolved from the context object, lineage tracing does not list state machines
+                            'execution_arn.$': '$$.Execution.Id',
+                            'state_machine_arn.$': '$$.StateMachine.Id'}
         assert self.s3_bucket.startswith('s3://'), 's3 bucket url invalid format'
         assert isinstance(self.verbose, bool), 'verbose has the wrong type, bool expected'
         assert isinstance(self.force_rerun, bool), 'force_rerun has the wrong type, bool expected'
+        assert isinstance(self.pointer_lookup, bool), 'pointer_lookup has the wrong type, bool expected'
+        assert isinstance(self.canonical_signature, bool), 'canonical_signature has the wrong type, bool expected'
+        assert self.offload_threshold is None or isinstance(self.offload_threshold, int), \
+            'offload_threshold has the wrong type, int expected'
+        assert isinstance(self.streaming, bool), 'streaming has the wrong type, bool expected'
+        assert isinstance(self.lean_wrapper, bool), 'lean_wrapper has the wrong type, bool expected'
+        assert isinstance(self.project_input, bool), 'project_input has the wrong type, bool expected'
+        assert self.lean_wrapper or not self.project_input, 'project_input requires lean_wrapper'
+        assert isinstance(self.payload_lineage, bool), 'payload_lineage has the wrong type, bool expected'
+        assert self.metadata_staleness is None or \
+            (isinstance(self.metadata_staleness, (int, float)) and self.metadata_staleness >= 0), \
+            'metadata_staleness has the wrong type, non-negative number expected'
+        assert self.local_budget is None or isinstance(self.local_budget, int), \
+            'local_budget has the wrong type, int expected'
+        assert self.result_ttl is None or (isinstance(self.result_ttl, (int, float)) and self.result_ttl >= 0), \
+            'result_ttl has the wrong type, non-negative number expected'
+        assert isinstance(self.result_cache_size, int) and self.result_cache_size > 0, \
+            'result_cache_size has the wrong type, positive int expected'
+        assert self.lease_ttl is None or (isinstance(self.lease_ttl, (int, float)) and self.lease_ttl > 0), \
+            'lease_ttl has the wrong type, positive number expected'
+        assert isinstance(self.lease_wait, (int, float)) and self.lease_wait >= 0, \
+            'lease_wait has the wrong type, non-negative number expected'
+        assert isinstance(self.async_push, bool), 'async_push has the wrong type, bool expected'
+        assert self.lean_wrapper or not self.async_push, 'async_push requires lean_wrapper'
+        assert not (self.async_push and self.payload_lineage), 'async_push cannot be combined with payload_lineage'
+        assert self.codec in Codec.names(), 'codec {} not supported, choose from {}'.format(self.codec, Codec.names())
 
-    def cache_step(self, user_step: steps.states, bundle_name: str = None, force_rerun: bool = None) -> steps.Chain:
+    def cache_step(self, user_step: steps.states, bundle_name: str = None, force_rerun: bool = None,
+                   max_age: float = None, stale_while_revalidate: float = None,
+                   replay_refresh: bool = False) -> steps.Chain:
         """
         enable caching for the input user step by wrapping the user step in a chain of generated caching states
         for instance:
@@ -72,22 +190,29 @@ class Caching:
         :param user_step: steps.states, a stepfunction state object
         :param bundle_name: str, the unified bundle name for all data generated by this user step
         :param force_rerun: bool, override the object-level force rerun setting
+        :param max_age: float, seconds a hit is fresh. None to use hits of any age
+        :param stale_while_revalidate: float, seconds after max_age during which a stale hit is still returned.
+            Older hits are misses, and the step is computed again by the execution that finds them. Requires max_age
+        :param replay_refresh: bool, a stale hit starts a new execution of the state machine with the input of this
+            execution, in which the stale steps are recomputed. Every step that is not cached runs again in it, only
+            set it if the whole state machine is safe to replay. Requires stale_while_revalidate
         :return: steps.Chain, a mini DAG that implements the caching logic
         """
-        task_name = user_step.state_id.replace(' ', '_').lower()
-        # bundle name is automatically assigned if not set
-        if bundle_name is None:
-            bundle_name = task_name
-        self.disdat_args['bundle_name'] = bundle_name
-        # copy the dict parameters because it is shared by potentially many cache_step calls.
-        disdat_args = self.disdat_args.copy()
-        # override the force_rerun logic if specified
-        if force_rerun is not None:
-            disdat_args['force_rerun'] = force_rerun
-        disdat_args['time'] = time.time()
+        task_name, disdat_args = self._step_args(user_step, bundle_name, force_rerun)
+        assert max_age is None or (isinstance(max_age, (int, float)) and max_age >= 0), \
+            'max_age has the wrong type, non-negative number expected'
+        assert stale_while_revalidate is None or (max_age is not None and stale_while_revalidate >= 0), \
+            'stale_while_revalidate requires max_age and must be non-negative'
+        assert isinstance(replay_refresh, bool) and (not replay_refresh or stale_while_revalidate), \
+            'replay_refresh requires stale_while_revalidate'
+        if max_age is not None:
+            disdat_args.update(max_age=max_age, stale_while_revalidate=stale_while_revalidate or 0,
+                               replay_refresh=replay_refresh)
         # set the caching pull input path to match user step's input path, we do this to avoid
         # caching unnecessary params that are not consumed by user step
         user_inputs = user_step.fields.get(Field.InputPath.value, '$')
+        if self.project_input and self.supports_lean(user_step):
+            return self._wrap_projected(user_step, task_name, disdat_args)
         # define caching pull state
         cache_pull = steps.LambdaStep(state_id='cache_pull_{}'.format(task_name),
                                       output_path='$.Payload',
@@ -99,18 +224,290 @@ class Caching:
                                                       }
                                         }
                                       )
-        # define caching push state
-        # note that the two states share the same lambda function!
-        # as a matter of fact, this one lambda is called repeated by all cached states
-        cache_push = steps.LambdaStep(state_id='cache_push_{}'.format(task_name),
-                                      output_path='$.Payload',
+        return self._wrap(user_step, task_name, disdat_args, cache_pull)
+
+    def _wrap_projected(self, user_step: steps.states, task_name: str, disdat_args: dict) -> steps.Chain:
+        """
+        lean wrapper where the caching lambda only receives the cache params. Results of the caching lambda are
+        merged into the state input with ResultPath, under $._dsdt_pull.Payload
+        for instance:
+            input: task A
+            output: chain that contains caching pull -> choice ->(rerun)-> run task A -> caching push -> caching output
+                                                               |-> (no rerun) -----------------------------|
+        If task A reads the whole state input, a pass state first moves it to $._full_params so that the results
+        of the caching lambda stay invisible to task A
+        :return: steps.Chain
+        """
+        wrapper = []
+        user_inputs = user_step.fields.get(Field.InputPath.value, '$')
+        if user_inputs == '$':
+            wrapper.append(steps.Pass('cache_input_{}'.format(task_name), parameters={pp.FULL_PARAM_SUFFIX: '$'}))
+            user_inputs = pp.FULL_PARAM_PREFIX
+            user_step.fields[Field.InputPath.value] = user_inputs
+        cache_pull = steps.LambdaStep(state_id='cache_pull_{}'.format(task_name),
+                                      result_path=pp.PULL_PREFIX,
                                       parameters={
                                           'FunctionName': self.caching_lambda,
-                                          'Payload': {pp.FULL_PARAM_SUFFIX: '$',
+                                          'Payload': {pp.CACHE_PARAM_SUFFIX: user_inputs,
                                                       pp.DSDT_ONLY_ARGS: disdat_args
                                                       }
-                                        }
-                                      )
+                                      })
+        # the user step output is kept next to its input, the cache params are read from the input again
+        user_step.fields[Field.ResultPath.value] = pp.CACHE_DATA_PREFIX
+        push_payload = {pp.CACHE_PARAM_SUFFIX: user_inputs,
+                        pp.OUTPUT_SUFFIX: pp.CACHE_DATA_PREFIX,
+                        pp.DSDT_ONLY_ARGS: disdat_args}
+        # both lambda calls output {PathParam.CACHE_DATA: output, ...}, merged at the same path
+        payload = '{}.Payload'.format(pp.PULL_PREFIX)
+        if self.async_push:
+            # nothing comes back from the push, the user step output is moved where the pushed one would be
+            miss_branch = [user_step, self._async_push(task_name, push_payload),
+                           steps.Pass('cache_result_{}'.format(task_name), input_path=pp.CACHE_DATA_PREFIX,
+                                      result_path='{}.{}'.format(payload, pp.CACHE_DATA))]
+        else:
+            miss_branch = [user_step, steps.LambdaStep(state_id='cache_push_{}'.format(task_name),
+                                                       result_path=pp.PULL_PREFIX,
+                                                       parameters={'FunctionName': self.caching_lambda,
+                                                                   'Payload': push_payload})]
+        cache_output = steps.Pass('cache_output_{}'.format(task_name),
+                                  output_path='{}.{}'.format(payload, pp.CACHE_DATA))
+        cache_condition = steps.Choice(state_id='use_cache?_{}'.format(task_name))
+        cache_condition.add_choice(rule=steps.ChoiceRule.BooleanEquals('{}.{}'.format(payload, pp.USE_CACHE),
+                                                                       value=False),
+                                   next_step=steps.Chain(miss_branch + [cache_output]))
+        return steps.Chain(wrapper + [cache_pull, cache_condition, cache_output])
+
+    def cache_step_sdk(self, user_step: steps.states, bundle_name: str = None, force_rerun: bool = None) \
+            -> steps.Chain:
+        """
+        enable caching for the input user step without calling the caching lambda on a cache hit. The state machine
+        hashes the cache params into the key of a hit object and reads it with the S3 GetObject SDK integration,
+        the lambda only runs on a miss to push the output and write the hit object.
+        for instance:
+            input: task A
+            output: chain that contains caching key -> s3 GetObject -> cache hit -> done
+                                                                   |-> (NoSuchKey) -> run task A -> caching push -|
+
+        The state machine role needs s3:GetObject on the objects and s3:ListBucket on the bucket: without ListBucket,
+        s3 answers AccessDenied instead of NoSuchKey for a missing hit object and every miss fails the execution.
+        Cache params longer than 10000 characters are not supported by States.Hash, and cached outputs should stay
+        below 256KB (see offload_threshold)
+
+        :param user_step: steps.states, a stepfunction state object
+        :param bundle_name: str, the unified bundle name for all data generated by this user step
+        :param force_rerun: bool, override the object-level force rerun setting
+        :return: steps.Chain, a mini DAG that implements the caching logic
+        """
+        task_name, disdat_args = self._step_args(user_step, bundle_name, force_rerun)
+        user_inputs = user_step.fields.get(Field.InputPath.value, '$')
+        bucket, _ = split_s3_url(self.s3_bucket)
+        prefix = hit_key_prefix(self.s3_bucket, self.context_name, disdat_args['bundle_name'])
+        # hit objects are content addressed, the key only depends on the cache params
+        cache_key = steps.Pass('cache_key_{}'.format(task_name),
+                               parameters={pp.FULL_PARAM_SUFFIX: '$',
+                                           pp.CACHE_PARAM_SUFFIX: user_inputs,
+                                           pp.HIT_KEY_SUFFIX: "States.Format('{}/{{}}.json', States.Hash("
+                                                              "States.JsonToString({}), 'SHA-256'))"
+                                                              .format(prefix, user_inputs)})
+        cache_check = steps.Task('cache_check_{}'.format(task_name),
+                                 resource='arn:aws:states:::aws-sdk:s3:getObject',
+                                 parameters={'Bucket': bucket, 'Key.$': pp.HIT_KEY_PREFIX},
+                                 result_path=pp.HIT_PREFIX)
+        cache_hit = steps.Pass('cache_hit_{}'.format(task_name),
+                               parameters={pp.HIT + '.$': 'States.StringToJson({}.Body)'.format(pp.HIT_PREFIX)},
+                               output_path='{}.data'.format(pp.HIT_PREFIX))
+        cache_done = steps.Pass('cache_done_{}'.format(task_name))
+
+        execution_branch = steps.Parallel(state_id='execute_{}'.format(task_name))
+        # the hit key is passed along with the cache params, cache push writes the hit object there
+        execution_branch.add_branch(steps.Pass('param_pass_{}'.format(task_name),
+                                               parameters={pp.CACHE_PARAM_SUFFIX: pp.CACHE_PARAM_PREFIX,
+                                                           pp.HIT_KEY_SUFFIX: pp.HIT_KEY_PREFIX}))
+        param_resolve = steps.Pass('param_resolve_{}'.format(task_name), input_path=pp.FULL_PARAM_PREFIX)
+        execution_branch.add_branch(steps.Chain([param_resolve, user_step]))
+        cache_push = self._cache_push(task_name, disdat_args)
+        cache_push.next(cache_done)
+        execution_branch = steps.Chain([execution_branch, cache_push])
+
+        if disdat_args['force_rerun']:
+            return steps.Chain([cache_key, execution_branch, cache_done])
+        # a missing hit object is a cache miss, other errors (e.g. AccessDenied) fail the execution
+        cache_check.add_catch(steps.Catch(error_equals=['S3.NoSuchKeyException'],
+                                          next_step=execution_branch,
+                                          result_path='$._dsdt_error'))
+        return steps.Chain([cache_key, cache_check, cache_hit, cache_done])
+
+    def cache_batch(self, user_steps: list, bundle_names: list = None, force_rerun: bool = None) -> tuple:
+        """
+        enable caching for several user steps that share the same input, e.g the branches of a Parallel state,
+        with a single lookup: one caching lambda invocation resolves the cache for all steps at once.
+        for instance:
+            input: task A, task B
+            output: cache_lookup_batch -> Parallel(branch A: cache_select -> choice -> ... -> caching push,
+                                                   branch B: cache_select -> choice -> ... -> caching push)
+            cache_lookup_batch has to be placed right before the Parallel state, in which each branch
+            runs one of the returned chains
+
+        :param user_steps: list, stepfunction state objects
+        :param bundle_names: list, bundle name of each user step, default to state names
+        :param force_rerun: bool, override the object-level force rerun setting
+        :return: tuple, (steps.LambdaStep, the batch lookup state; list of steps.Chain, one per user step)
+        """
+        if bundle_names is None:
+            bundle_names = [None] * len(user_steps)
+        assert len(bundle_names) == len(user_steps), 'one bundle name per user step is expected'
+        wrappers, items, task_names = [], {}, []
+        for idx, (user_step, bundle_name) in enumerate(zip(user_steps, bundle_names)):
+            task_name, disdat_args = self._step_args(user_step, bundle_name, force_rerun)
+            task_names.append(task_name)
+            items[str(idx)] = {'bundle_name': disdat_args['bundle_name'],
+                               'force_rerun': disdat_args['force_rerun'],
+                               pp.CACHE_PARAM_SUFFIX: user_step.fields.get(Field.InputPath.value, '$')}
+            # reshape the i-th lookup result into the output format of cache pull
+            result = '$.{}[{}]'.format(pp.BATCH, idx)
+            cache_select = steps.Pass('cache_select_{}'.format(task_name),
+                                      parameters={pp.FULL_PARAM_SUFFIX: pp.FULL_PARAM_PREFIX,
+                                                  pp.CACHE_PARAM_SUFFIX: '{}.{}'.format(result, pp.CACHE_PARAM),
+                                                  pp.CACHE_DATA + '.$': '{}.{}'.format(result, pp.CACHE_DATA),
+                                                  pp.USE_CACHE + '.$': '{}.{}'.format(result, pp.USE_CACHE)})
+            wrappers.append(self._wrap(user_step, task_name, disdat_args, cache_select))
+        # items are keyed by position, as paths inside arrays are not resolved by Parameters
+        # state names are limited to 80 characters
+        lookup = steps.LambdaStep(state_id='cache_lookup_batch_{}'.format('_'.join(task_names))[:80],
+                                  output_path='$.Payload',
+                                  parameters={
+                                      'FunctionName': self.caching_lambda,
+                                      'Payload': {pp.FULL_PARAM_SUFFIX: '$',
+                                                  pp.BATCH: items,
+                                                  pp.DSDT_ONLY_ARGS: self.disdat_args.copy()}
+                                  })
+        return lookup, wrappers
+
+    def cache_map(self, map_state: states.Map, bundle_name: str = None, force_rerun: bool = None) -> steps.Chain:
+        """
+        enable caching for a Map state at the item level: the output of the whole iterator is cached per item.
+        for instance:
+            input: Map over n items
+            output: chain that contains caching lookup (all n items at once)
+                    -> Map (over the missed items only, each iteration pushes its own output)
+                    -> caching merge (reassemble all outputs in the original order)
+
+        The Map state is modified in place. Its InputPath, ResultPath, OutputPath and Parameters must be left to
+        default, items are cached on their raw value, and note that $$.Map.Item.Index is now the index among the
+        missed items
+
+        :param map_state: states.Map, a stepfunction Map state
+        :param bundle_name: str, the unified bundle name for all data generated by the iterator
+        :param force_rerun: bool, override the object-level force rerun setting
+        :return: steps.Chain, a mini DAG that implements the caching logic
+        """
+        assert self.supports_map(map_state), \
+            'Map-level caching does not support InputPath, ResultPath, OutputPath or Parameters on {}'.format(
+                map_state.state_id)
+        task_name, disdat_args = self._step_args(map_state, bundle_name, force_rerun)
+        cache_lookup = steps.LambdaStep(state_id='cache_lookup_map_{}'.format(task_name),
+                                        output_path='$.Payload',
+                                        parameters={
+                                            'FunctionName': self.caching_lambda,
+                                            'Payload': {pp.FULL_PARAM_SUFFIX: '$',
+                                                        pp.MAP: {'items_path': map_state.fields.get(
+                                                            Field.ItemsPath.value, '$')},
+                                                        pp.DSDT_ONLY_ARGS: disdat_args}
+                                        })
+        # the Map only sees the original input (with the missed items), and its output is kept next to
+        # the lookup results for the merge step
+        map_state.fields[Field.InputPath.value] = pp.FULL_PARAM_PREFIX
+        map_state.fields[Field.ResultPath.value] = pp.MAP_RESULTS_PREFIX
+        # each iteration pushes the output of its item, the pushes run with the concurrency of the Map instead of
+        # one after another in the merge step, which would not fit in a lambda invocation for large fan-outs
+        execution_branch = steps.Parallel(state_id='execute_map_{}'.format(task_name))
+        execution_branch.add_branch(steps.Pass('param_pass_map_{}'.format(task_name),
+                                               parameters={pp.CACHE_PARAM_SUFFIX: '$'}))
+        execution_branch.add_branch(map_state.iterator)
+        map_state.attach_iterator(steps.Chain([execution_branch, self._cache_push('map_{}'.format(task_name),
+                                                                                  disdat_args)]))
+        cache_merge = steps.LambdaStep(state_id='cache_merge_map_{}'.format(task_name),
+                                       output_path='$.Payload',
+                                       parameters={
+                                           'FunctionName': self.caching_lambda,
+                                           'Payload': {pp.FULL_PARAM_SUFFIX: pp.FULL_PARAM_PREFIX,
+                                                       pp.MAP_SUFFIX: pp.MAP_PREFIX,
+                                                       pp.MAP_RESULTS_SUFFIX: pp.MAP_RESULTS_PREFIX,
+                                                       pp.DSDT_ONLY_ARGS: disdat_args}
+                                       })
+        return steps.Chain([cache_lookup, map_state, cache_merge])
+
+    @classmethod
+    def supports_lean(cls, user_step: steps.states) -> bool:
+        """
+        :return: bool, whether the user step can run without the Parallel state of the wrapper
+        """
+        input_path = user_step.fields.get(Field.InputPath.value, '$')
+        return isinstance(input_path, str) and input_path.startswith('$') and \
+            all(field.value not in user_step.fields for field in [Field.ResultPath, Field.OutputPath])
+
+    @classmethod
+    def supports_map(cls, map_state: states.Map) -> bool:
+        """
+        :return: bool, whether cache_map can wrap the Map state. Parameters select the iterator input from the
+            context ($$.Map.Item.Value, $$.Map.Item.Index) or the state input, while items are cached on their raw value
+        """
+        return all(field.value not in map_state.fields
+                   for field in [Field.InputPath, Field.ResultPath, Field.OutputPath, Field.Parameters])
+
+    def _step_args(self, user_step: steps.states, bundle_name: str = None, force_rerun: bool = None) -> tuple:
+        """
+        :return: tuple, (task name, disdat args passed to the caching lambda for this user step)
+        """
+        task_name = user_step.state_id.replace(' ', '_').lower()
+        # bundle name is automatically assigned if not set
+        if bundle_name is None:
+            bundle_name = task_name
+        self.disdat_args['bundle_name'] = bundle_name
+        # copy the dict parameters because it is shared by potentially many cache_step calls.
+        disdat_args = self.disdat_args.copy()
+        # override the force_rerun logic if specified
+        if force_rerun is not None:
+            disdat_args['force_rerun'] = force_rerun
+        disdat_args['time'] = time.time()
+        return task_name, disdat_args
+
+    def _cache_push(self, task_name: str, disdat_args: dict) -> steps.LambdaStep:
+        # define caching push state
+        # note that the two states share the same lambda function!
+        # as a matter of fact, this one lambda is called repeated by all cached states
+        return steps.LambdaStep(state_id='cache_push_{}'.format(task_name),
+                                output_path='$.Payload',
+                                parameters={
+                                    'FunctionName': self.caching_lambda,
+                                    'Payload': {pp.FULL_PARAM_SUFFIX: '$',
+                                                pp.DSDT_ONLY_ARGS: disdat_args
+                                                }
+                                }
+                                )
+
+    def _async_push(self, task_name: str, push_payload: dict) -> steps.LambdaStep:
+        """
+        cache push of the lean wrappers invoked with InvocationType=Event, the state only waits for lambda to queue
+        the event. Its result (the status code of the invocation) is kept out of the way under $._dsdt_push
+        """
+        return steps.LambdaStep(state_id='cache_push_{}'.format(task_name),
+                                result_path=pp.PUSH_PREFIX,
+                                parameters={'FunctionName': self.caching_lambda,
+                                            'InvocationType': 'Event',
+                                            'Payload': dict(push_payload, **{pp.ASYNC: True})})
+
+    def _wrap(self, user_step: steps.states, task_name: str, disdat_args: dict, cache_pull: states.State) \
+            -> steps.Chain:
+        """
+        build choice -> execution branch -> caching push around the user step
+        :param cache_pull: steps.State, the state that outputs
+            {PathParam.FULL_PARAM, PathParam.CACHE_PARAM, PathParam.CACHE_DATA, PathParam.USE_CACHE}
+        :return: steps.Chain
+        """
+        if self.lean_wrapper and self.supports_lean(user_step):
+            return self._wrap_lean(user_step, task_name, disdat_args, cache_pull)
+        cache_push = self._cache_push(task_name, disdat_args)
 
         cache_condition = steps.Choice(state_id='use_cache?_{}'.format(task_name))
         # define the execution branch (run when input param signature does not match cache)
@@ -135,22 +532,60 @@ class Caching:
 
         return steps.Chain([cache_pull, cache_condition, cache_push])
 
+    def _wrap_lean(self, user_step: steps.states, task_name: str, disdat_args: dict, cache_pull: states.State) \
+            -> steps.Chain:
+        """
+        build choice -> user step -> caching push -> caching output around the user step, without a Parallel state.
+        The user step reads the full params through its InputPath and writes its output next to the cache params,
+        so cache push only receives what it saves. A cache hit goes from the choice state to the output state
+        directly, the caching lambda is not invoked a second time
+        :param cache_pull: steps.State, the state that outputs
+            {PathParam.FULL_PARAM, PathParam.CACHE_PARAM, PathParam.CACHE_DATA, PathParam.USE_CACHE}
+        :return: steps.Chain
+        """
+        # the user step is modified in place, '$.a' becomes '$._full_params.a'
+        user_inputs = user_step.fields.get(Field.InputPath.value, '$')
+        user_step.fields[Field.InputPath.value] = pp.FULL_PARAM_PREFIX + user_inputs[1:]
+        user_step.fields[Field.ResultPath.value] = pp.CACHE_DATA_PREFIX
+        push_payload = {pp.CACHE_PARAM_SUFFIX: pp.CACHE_PARAM_PREFIX,
+                        pp.OUTPUT_SUFFIX: pp.CACHE_DATA_PREFIX,
+                        pp.DSDT_ONLY_ARGS: disdat_args}
+        if self.async_push:
+            # the user step output stays at $._data
+            cache_push = self._async_push(task_name, push_payload)
+        else:
+            cache_push = steps.LambdaStep(state_id='cache_push_{}'.format(task_name),
+                                          output_path='$.Payload',
+                                          parameters={'FunctionName': self.caching_lambda, 'Payload': push_payload})
+        # both branches join here, cache push returns {PathParam.CACHE_DATA: output}
+        cache_output = steps.Pass('cache_output_{}'.format(task_name), output_path=pp.CACHE_DATA_PREFIX)
+        cache_condition = steps.Choice(state_id='use_cache?_{}'.format(task_name))
+        cache_condition.add_choice(rule=steps.ChoiceRule.BooleanEquals(pp.USE_CACHE_PREFIX, value=False),
+                                   next_step=steps.Chain([user_step, cache_push, cache_output]))
+        return steps.Chain([cache_pull, cache_condition, cache_output])
+
 
 class PipelineCaching:
 
-    def __init__(self, definition: Union[states.Chain, states.State], caching: Caching):
+    def __init__(self, definition: Union[states.Chain, states.State], caching: Caching, cache_maps: bool = False):
         """
         Cache all tasks in a pre-existing state machine
         :param definition: states.Chain, the state machine that the user wants to cache
         :param caching: Caching, the caching utility object used for caching individual states
+        :param cache_maps: bool, cache Map states at the item level with Caching.cache_map instead of caching
+            every task inside their iterators. Maps with a custom InputPath/ResultPath/OutputPath/Parameters are left
+            as is
         """
-        visitor = StateVisitor(caching)
+        visitor = StateVisitor(caching, cache_maps)
         definition.accept(visitor)
 
         self.definition = definition
+        self.caching = caching
         self.states = visitor.states
         # to replace keeps track of tasks to replace (determined by StateVisitor on the fly)
         self.to_replace = visitor.to_replace
+        # Map states to cache at the item level, wrapped during the traversal as the wrapper rewires next_step
+        self.maps_to_cache = visitor.maps_to_cache
         self.visited = {}
 
         if len(logging.getLogger().handlers) > 0:
@@ -212,6 +647,15 @@ class PipelineCaching:
             # modify the subsequent state, otherwise it still points to the old state
             state.next_step = self._overwrite(state.next_step)
 
+        elif isinstance(state, states.Map) and state.state_id in self.maps_to_cache:
+            # keep the original next state, chaining the wrapper makes the Map point to the merge step
+            next_step = state.next_step
+            state.next_step = None
+            replacement = self.caching.cache_map(state)
+            replacement.steps[-1].next_step = self._overwrite(next_step)
+            self.visited[state.state_id] = replacement
+            return replacement
+
         elif isinstance(state, states.Map):
             # logging.warning('Be careful that states inside any map state are ' +
             #                 'not cached because of a stepfunction bug')
@@ -228,12 +672,14 @@ class PipelineCaching:
                 state.next_step = self._overwrite(state.next_step)
 
             else:
-                # note that replacement is the caching wrapper, hence it is a chain
-                replacement = self.to_replace[state.state_id]
-                # make sure caching_push_xxx points to the subsequent state of the input state
-                replacement.steps[-1].next_step = self._overwrite(state.next_step)
                 # state is inside replacement, it should not point to the original next_step
+                # the wrapper is built afterwards, as the lean wrapper links the user step to caching push
+                next_step = state.next_step
                 state.next_step = None
+                # note that replacement is the caching wrapper, hence it is a chain
+                replacement = self.caching.cache_step(state)
+                # make sure the last caching state points to the subsequent state of the input state
+                replacement.steps[-1].next_step = self._overwrite(next_step)
                 # mark the node as visited
                 self.visited[state.state_id] = replacement
                 return replacement
@@ -247,11 +693,22 @@ class LambdaGenerator:
     CACHING_LAMBDA_DIR = 'cache_lambda'
     DEPENDENCY = 'dependency'
     DISDAT_LAYER = 'disdat_caching_layer'
+    # extracted to /opt/disdat_config by lambda, see lambda_for_user.init_disdat
+    BAKED_CONFIG_DIR = 'disdat_config'
     CACHING_LAMBDA_SR_PY = 'cache_lambda.py'
     LAMBDA_STUB_PY = 'lambda_for_user.py'
+    DOCKERFILE = 'Dockerfile'
+    # boto3 and botocore are provided by the lambda runtime
+    REQUIREMENTS = ['disdat', 'stepfunctions==2.2.0']
+    UNINSTALL = ['boto3', 'botocore', 's3transfer']
+    # layer zips keyed by their inputs, and the pip cache of the docker builds, shared by all generated lambdas
+    CACHE_DIR = os.environ.get('DISDAT_LAYER_CACHE',
+                               os.path.join(os.path.expanduser('~'), '.cache', 'disdat_step_function'))
+    CACHED_LAYERS = 5
 
     @classmethod
-    def generate(cls, root: Union[str, pathlib.Path] = 'generated_lambda', force_rerun: bool = False):
+    def generate(cls, root: Union[str, pathlib.Path] = 'generated_lambda', force_rerun: bool = False,
+                 builder: 'LayerBuilder' = None, requirements: list = None):
         """
         generate the lambda src code and a layer that users can use to create the lambda function.
         The lambda function will need access to the disdat package, which is provided as a lambda layer
@@ -267,7 +724,10 @@ class LambdaGenerator:
                 - /dependency
                 - disdat_caching_layer.zip
         :param root: str, where do you want to save the code
-        :param force_rerun: bool, force rerun docker pip install even if the dependency folder is present
+        :param force_rerun: bool, force rerun docker pip install even if a layer was built from the same inputs
+        :param builder: LayerBuilder, prunes, precompiles and zips the layer. Default to LayerBuilder()
+        :param requirements: list, pip requirements of the layer, default to LambdaGenerator.REQUIREMENTS. Add the
+            optional packages the caching lambda needs, e.g. zstandard for codec='zstd'
         :return: None
         """
         root = os.path.abspath(root)
@@ -282,43 +742,342 @@ class LambdaGenerator:
         shutil.copyfile(src=src, dst=dst)
         print('lambda code generated! find it in {}'.format(dst))
         # run docker pip install
-        cls.install_dep(root, force_rerun)
+        cls.install_dep(root, force_rerun, builder, requirements)
         print("\nINSTRUCTIONS:\nPlease create a lambda function with from the generated .py file" +
               "and a lambda layer from the generated zip!\n" +
               "IMPORTANT TIPS: \nGive the lambda function proper S3 bucket permissions and timeout of at least 20s")
 
     @classmethod
-    def install_dep(cls, root_dir: Union[str, pathlib.Path], force_rerun: bool = False):
+    def install_dep(cls, root_dir: Union[str, pathlib.Path], force_rerun: bool = False,
+                    builder: 'LayerBuilder' = None, requirements: list = None):
         """
         docker pip install. Run docker build, docker run with volume mount and zip the output dependencies into a zip
         Because AWS set a size cap of 50MB for lambda layers, we did some size control by removing redundant packages
         like boto3(available by default for any lambda) as well as some dist-info folders
 
+        Layers are keyed by a hash of their inputs (see layer_key). A layer built from the same inputs is reused
+        without running docker, and the pip cache of the builds is kept so that a rebuild only downloads and builds
+        the packages that changed
+
         :param root_dir: str, folder that is mounted with docker
-        :param force_rerun: bool, re execute if true, otherwise skip if the folder already exists
-        :return: None
+        :param force_rerun: bool, rebuild even if a layer was built from the same inputs
+        :param builder: LayerBuilder, prunes, precompiles and zips the layer. Default to LayerBuilder()
+        :param requirements: list, pip requirements of the layer, default to REQUIREMENTS. Pin versions to
+            make the key reproducible, 'disdat' alone does not change when a new version is released
+        :return: str, the layer key
         """
+        builder = builder or LayerBuilder()
+        requirements = list(requirements or cls.REQUIREMENTS)
+        root_dir = os.path.abspath(root_dir)
         from_folder = os.path.join(root_dir, cls.DEPENDENCY)
         to_file = os.path.join(root_dir, cls.DISDAT_LAYER)
-        if not os.path.isdir(from_folder) or force_rerun:
-            os.makedirs(from_folder, exist_ok=True)
-            # build image from dockerfile, see the dockerfile for more details
-            os.system('docker build -t docker_pip:latest {}'.format(os.path.dirname(__file__)))
-            # exec container with mounted volume
-            os.system('docker run -v {}:/lib/dependency docker_pip:latest'.format(from_folder))
-            # zip all dependencies into a zip file
-            shutil.make_archive(to_file, format='zip', root_dir=os.path.join(root_dir, cls.DEPENDENCY))
+        key = cls.layer_key(requirements, builder)
+        cached = os.path.join(cls.CACHE_DIR, 'layers', '{}.zip'.format(key))
+        if os.path.isfile(cached) and not force_rerun:
+            shutil.copyfile(src=cached, dst=to_file + '.zip')
+            # mark the layer as used for the eviction of the least recently used layers
+            os.utime(cached)
+            print('layer {} unchanged, reusing {}'.format(key, cached))
+            return key
+
+        os.makedirs(from_folder, exist_ok=True)
+        pip_cache = os.path.join(cls.CACHE_DIR, 'pip')
+        os.makedirs(pip_cache, exist_ok=True)
+        python = 'python{}'.format(builder.python_version)
+        # the previous build is removed by the container user that wrote it
+        install = 'find /lib/dependency -mindepth 1 -delete && mkdir -p /lib/dependency/python && ' \
+                  'cd /lib/dependency/python && ' \
+                  '{0} -m pip install {1} -t . && {0} -m pip uninstall {2} -y && ' \
+                  'find . -name "__pycache__" -prune -exec rm -rf {{}} +'.format(
+                      python, ' '.join(shlex.quote(r) for r in requirements),
+                      ' '.join(shlex.quote(p) for p in cls.UNINSTALL))
+        # build image from dockerfile, see the dockerfile for more details
+        subprocess.run(['docker', 'build', '-t', LayerBuilder.IMAGE, os.path.dirname(__file__)], check=True)
+        # exec container with mounted volume, the pip cache survives between builds. The container runs as the
+        # current user so that the layer builder can prune and rewrite the installed files on the host
+        subprocess.run(['docker', 'run', '--rm'] + LayerBuilder.docker_user() +
+                       ['-v', '{}:/lib/dependency'.format(from_folder),
+                        '-v', '{}:{}'.format(pip_cache, LayerBuilder.PIP_CACHE), '-e',
+                        'PIP_CACHE_DIR={}'.format(LayerBuilder.PIP_CACHE), LayerBuilder.IMAGE, 'sh', '-c', install],
+                       check=True)
+        cls.bake_config(from_folder)
+        # prune, precompile and zip all dependencies into a zip file
+        builder.build(from_folder, to_file)
+        cls._cache_layer(to_file + '.zip', cached)
         print('layer zip generated! find it in {}'.format(to_file + '.zip'))
+        return key
+
+    @classmethod
+    def layer_key(cls, requirements: list, builder: 'LayerBuilder') -> str:
+        """
+        :return: str, hash of everything that goes into the layer: requirements, python version, version of this
+            package (it bakes the disdat config), docker image and build settings
+        """
+        with open(os.path.join(os.path.dirname(__file__), cls.DOCKERFILE), 'rb') as fp:
+            dockerfile = hashlib.sha256(fp.read()).hexdigest()
+        inputs = {'requirements': sorted(requirements),
+                  'uninstall': sorted(cls.UNINSTALL),
+                  'python': builder.python_version,
+                  'package': cls._package_version(),
+                  'dockerfile': dockerfile,
+                  'builder': builder.settings()}
+        return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+    @classmethod
+    def _package_version(cls) -> str:
+        try:
+            from importlib import metadata
+            return metadata.version('disdat_step_function')
+        except Exception:
+            # running from a source tree, the cache lambda and layer code are part of the key then
+            digest = hashlib.sha256()
+            for name in [cls.CACHING_LAMBDA_SR_PY, cls.LAMBDA_STUB_PY, 'caching_wrapper.py']:
+                with open(os.path.join(os.path.dirname(__file__), name), 'rb') as fp:
+                    digest.update(fp.read())
+            return 'src-{}'.format(digest.hexdigest()[:16])
+
+    @classmethod
+    def _cache_layer(cls, layer_zip: str, cached: str):
+        """
+        keep a copy of the layer, and evict the least recently used layers beyond CACHED_LAYERS
+        """
+        os.makedirs(os.path.dirname(cached), exist_ok=True)
+        shutil.copyfile(src=layer_zip, dst=cached)
+        layers = sorted(pathlib.Path(os.path.dirname(cached)).glob('*.zip'), key=lambda p: p.stat().st_mtime)
+        for stale in layers[:-cls.CACHED_LAYERS]:
+            stale.unlink()
+
+    @classmethod
+    def bake_config(cls, layer_dir: Union[str, pathlib.Path]) -> str:
+        """
+        write a read-only disdat config into the layer, so that cold containers do not run DisdatConfig.init().
+        Contexts are still stored under the writable HOME of the lambda, as the config does not set meta_dir_root
+
+        The config comes from the disdat installed in the layer, the disdat of the host may be another version
+
+        :param layer_dir: str, root of the layer content, with the packages under python/
+        :return: str, path of the config file
+        """
+        src = os.path.join(layer_dir, 'python', 'disdat', 'config', 'disdat', 'disdat.cfg')
+        if not os.path.isfile(src):
+            raise FileNotFoundError('disdat is not installed in the layer, {} not found'.format(src))
+        dst_dir = os.path.join(layer_dir, cls.BAKED_CONFIG_DIR)
+        dst = os.path.join(dst_dir, 'disdat.cfg')
+        os.makedirs(dst_dir, exist_ok=True)
+        if os.path.exists(dst):
+            os.chmod(dst, 0o644)
+        shutil.copyfile(src=src, dst=dst)
+        os.chmod(dst, 0o444)
+        return dst
+
+
+class LayerBuilder:
+    """
+    Turn the pip install output into a lambda layer zip:
+        prune files that are not needed at runtime -> strip docstrings (optional) -> precompile .pyc
+        -> zip -> report the size of each package and fail if the layer exceeds the size budget
+
+    The layer is extracted to the read-only /opt, so the lambda runtime cannot cache the bytecode it compiles.
+    Without precompiled .pyc files every cold container compiles all the modules it imports
+    """
+    # glob patterns matched against paths relative to the layer, on files and folders
+    PRUNE_RULES = ['*/__pycache__', '*.pyc', '*/tests', '*.pyi', '*.pyx', '*.pxd',
+                   '*.c', '*.cpp', '*.h', '*/docs', '*/examples', '*.md', '*.dist-info/RECORD']
+    # the layer content is extracted to /opt by lambda, tracebacks point there
+    RUNTIME_ROOT = '/opt'
+    IMAGE = 'docker_pip:latest'
+    # pip cache of the docker builds, mounted from LambdaGenerator.CACHE_DIR
+    PIP_CACHE = '/pip_cache'
+    # lambda size limits: 50MB for an uploaded zip, 250MB unzipped for the function and its layers
+    ZIP_BUDGET = 50 * 1024 * 1024
+    UNZIPPED_BUDGET = 250 * 1024 * 1024
+
+    def __init__(self,
+                 prune_rules: list = None,
+                 extra_prune_rules: list = None,
+                 precompile: bool = True,
+                 python_version: str = '3.8',
+                 python: str = None,
+                 strip_docstrings: list = None,
+                 zip_budget: int = ZIP_BUDGET,
+                 unzipped_budget: int = UNZIPPED_BUDGET):
+        """
+        :param prune_rules: list, glob patterns of the files and folders to delete, default to PRUNE_RULES
+        :param extra_prune_rules: list, glob patterns deleted on top of prune_rules, e.g. ['python/pandas/io/*']
+        :param precompile: bool, compile .pyc files for the lambda python version
+        :param python_version: str, python version of the lambda runtime
+        :param python: str, interpreter used to precompile, it must match the lambda runtime. Default to
+            python{python_version} in the docker image that installed the dependencies
+        :param strip_docstrings: list, top level packages whose docstrings are removed, e.g. ['disdat', 'luigi'].
+            Some packages (pandas, numpy) format their docstrings at import time and must not be stripped
+        :param zip_budget: int, fail the build if the zip is larger than this many bytes
+        :param unzipped_budget: int, fail the build if the layer is larger than this many bytes once extracted
+        """
+        self.prune_rules = list(self.PRUNE_RULES if prune_rules is None else prune_rules) + \
+            list(extra_prune_rules or [])
+        self.precompile = precompile
+        self.python_version = python_version
+        self.python = python
+        self.strip_docstrings = list(strip_docstrings or [])
+        self.zip_budget = zip_budget
+        self.unzipped_budget = unzipped_budget
+        assert isinstance(self.precompile, bool), 'precompile has the wrong type, bool expected'
+
+    def settings(self) -> dict:
+        """
+        :return: dict, the settings that change the content of the layer (the budgets do not)
+        """
+        return {'prune_rules': self.prune_rules, 'precompile': self.precompile,
+                'python_version': self.python_version, 'python': self.python,
+                'strip_docstrings': sorted(self.strip_docstrings)}
+
+    def build(self, layer_dir: Union[str, pathlib.Path], to_file: Union[str, pathlib.Path]) -> dict:
+        """
+        :param layer_dir: str, content of the layer (python/ and disdat_config/)
+        :param to_file: str, path of the zip, without the .zip extension
+        :return: dict, {'pruned': int, bytes removed, 'packages': dict, package -> bytes,
+                        'unzipped': int, bytes, 'zip': int, bytes}
+        """
+        layer_dir = os.path.abspath(layer_dir)
+        pruned = self.prune(layer_dir)
+        for package in self.strip_docstrings:
+            for path in pathlib.Path(layer_dir, 'python', package).rglob('*.py'):
+                self.strip_file_docstrings(str(path))
+        if self.precompile:
+            self.compile(layer_dir)
+        report = {'pruned': pruned, 'packages': self.package_sizes(layer_dir)}
+        report['unzipped'] = sum(report['packages'].values())
+        report['zip'] = os.path.getsize(shutil.make_archive(str(to_file), format='zip', root_dir=layer_dir))
+        print(self.format_report(report))
+        if report['zip'] > self.zip_budget or report['unzipped'] > self.unzipped_budget:
+            raise RuntimeError('layer {}.zip exceeds its size budget: {:.1f}MB zipped (budget {:.1f}MB), '
+                               '{:.1f}MB unzipped (budget {:.1f}MB)'.format(to_file, report['zip'] / 2 ** 20,
+                                                                           self.zip_budget / 2 ** 20,
+                                                                           report['unzipped'] / 2 ** 20,
+                                                                           self.unzipped_budget / 2 ** 20))
+        return report
+
+    def prune(self, layer_dir: str) -> int:
+        """
+        :return: int, bytes removed
+        """
+        removed = 0
+        for root, dirs, files in os.walk(layer_dir, topdown=True):
+            rel_root = os.path.relpath(root, layer_dir)
+            for name in list(dirs):
+                path = os.path.join(root, name)
+                if self._match(os.path.join(rel_root, name)):
+                    removed += self._size(path)
+                    shutil.rmtree(path)
+                    # do not walk into deleted folders
+                    dirs.remove(name)
+            for name in files:
+                if self._match(os.path.join(rel_root, name)):
+                    path = os.path.join(root, name)
+                    removed += os.path.getsize(path)
+                    os.remove(path)
+        return removed
+
+    @classmethod
+    def strip_file_docstrings(cls, path: str):
+        """
+        replace the module, class and function docstrings of a source file with empty strings, line numbers are
+        kept. Empty strings rather than pass, as a module docstring may precede a __future__ import
+        """
+        with open(path, 'rb') as fp:
+            source = fp.read()
+        try:
+            tree = ast.parse(source)
+        except (SyntaxError, ValueError):
+            return
+        spans = []
+        for node in ast.walk(tree):
+            if isinstance(node, (ast.Module, ast.ClassDef, ast.FunctionDef, ast.AsyncFunctionDef)) and node.body:
+                first = node.body[0]
+                if isinstance(first, ast.Expr) and isinstance(first.value, ast.Constant) \
+                        and isinstance(first.value.value, str):
+                    spans.append(first)
+        if len(spans) == 0:
+            return
+        # column offsets are in bytes, and bytes only break lines on \n, \r and \r\n like the parser
+        lines = source.splitlines(keepends=True)
+        for node in sorted(spans, key=lambda n: (n.lineno, n.col_offset), reverse=True):
+            start, end = node.lineno - 1, node.end_lineno - 1
+            replacement = b'""' + b'\n' * (end - start)
+            lines[start:end + 1] = [lines[start][:node.col_offset] + replacement + lines[end][node.end_col_offset:]]
+        with open(path, 'wb') as fp:
+            fp.write(b''.join(lines))
+
+    def compile(self, layer_dir: str):
+        """
+        precompile with the interpreter of the lambda runtime. Hashes of the sources are not checked at import
+        time, the layer is read-only so sources cannot change
+        """
+        args = ['-m', 'compileall', '-q', '-j', '0', '--invalidation-mode', 'unchecked-hash', '-d']
+        if self.python is None:
+            command = ['docker', 'run', '--rm'] + self.docker_user() + \
+                ['-v', '{}:/layer'.format(layer_dir), self.IMAGE, 'python{}'.format(self.python_version)] + \
+                args + [self.RUNTIME_ROOT, '/layer']
+        else:
+            command = [self.python] + args + [self.RUNTIME_ROOT, layer_dir]
+        subprocess.run(command, check=True)
+
+    @classmethod
+    def docker_user(cls) -> list:
+        """
+        with rootful docker, the files written by the container in a mounted folder are owned by root and cannot be
+        pruned or stripped on the host. The container runs as the current user instead, with a writable HOME
+        :return: list, arguments of docker run, empty where the user id is not available (Windows)
+        """
+        if not hasattr(os, 'getuid'):
+            return []
+        return ['--user', '{}:{}'.format(os.getuid(), os.getgid()), '-e', 'HOME=/tmp']
+
+    @classmethod
+    def package_sizes(cls, layer_dir: str) -> dict:
+        """
+        :return: dict, top level package (or folder of the layer) -> bytes, largest first
+        """
+        sizes = collections.Counter()
+        for root, _, files in os.walk(layer_dir):
+            for name in files:
+                path = os.path.join(root, name)
+                parts = pathlib.PurePath(os.path.relpath(path, layer_dir)).parts
+                # python/pandas/core/frame.py -> pandas, python/six.py -> six.py, disdat_config/... -> disdat_config
+                package = parts[1] if len(parts) > 1 and parts[0] == 'python' else parts[0]
+                sizes[package] += os.path.getsize(path)
+        return dict(sizes.most_common())
+
+    @classmethod
+    def format_report(cls, report: dict, top: int = 15) -> str:
+        lines = ['layer size: {:.1f}MB unzipped, {:.1f}MB zipped, {:.1f}MB pruned'.format(
+            report['unzipped'] / 2 ** 20, report['zip'] / 2 ** 20, report['pruned'] / 2 ** 20)]
+        for package, size in list(report['packages'].items())[:top]:
+            lines.append('    {:<40}{:>8.2f}MB{:>7.1%}'.format(package, size / 2 ** 20,
+                                                              size / max(report['unzipped'], 1)))
+        return '\n'.join(lines)
+
+    def _match(self, rel_path: str) -> bool:
+        rel_path = rel_path.replace(os.sep, '/')
+        return any(fnmatch.fnmatch(rel_path, rule) or fnmatch.fnmatch('/' + rel_path, rule)
+                   for rule in self.prune_rules)
+
+    @classmethod
+    def _size(cls, path: str) -> int:
+        return sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(path) for f in files)
 
 
 class StateVisitor(states.GraphVisitor):
-    def __init__(self, caching: Caching):
+    def __init__(self, caching: Caching, cache_maps: bool = False):
         """
         specialized children class of GraphVisitor that determines states to replace on the fly
-        :param caching: Caching, we call caching.cache_step() on selected states
+        :param caching: Caching, PipelineCaching calls caching.cache_step() on the selected states
+        :param cache_maps: bool, mark supported Map states for item-level caching instead of entering their iterators
         """
-        self.to_replace = {}
+        self.to_replace = set()
+        self.maps_to_cache = set()
         self.caching = caching
+        self.cache_maps = cache_maps
         super().__init__()
 
     def visit(self, state):
@@ -329,11 +1088,12 @@ class StateVisitor(states.GraphVisitor):
         """
         self.states[state.state_id] = state
         if isinstance(state, states.Task):
-            wrapper = self.caching.cache_step(state)
-            self.to_replace[state.state_id] = wrapper
+            self.to_replace.add(state.state_id)
         elif isinstance(state, states.Parallel):
             for b in state.branches:
                 b.accept(self)
+        elif isinstance(state, states.Map) and self.cache_maps and Caching.supports_map(state):
+            self.maps_to_cache.add(state.state_id)
         elif isinstance(state, states.Map):
             state.iterator.accept(self)
 
@@ -16,22 +16,20 @@
 """
 
 
-from disdat.common import DisdatConfig
+import time
+_IMPORT_START = time.perf_counter()
+
 import os
 import logging
 # TODO FIX THIS IMPORT ONCE THIS PLUGIN IS MERGED INTO disdat
-from cache_lambda import PathParam, Cache
-
-
-try:
-    HOME = '/tmp/home'
-    os.makedirs(HOME, exist_ok=True)
-    os.environ["HOME"] = HOME
-    DisdatConfig.init()
-except:
-    logging.warning("disdat already initialized; home overriding failed")
+from cache_lambda import PathParam, Cache, ContextRegistry, ColdStartProfile
 
+ColdStartProfile.record('import handler', _IMPORT_START)
+HOME = '/tmp/home'
+# read-only disdat config baked into the layer by LambdaGenerator, layers are extracted to /opt
+BAKED_CONFIG_DIR = os.environ.get('DISDAT_BAKED_CONFIG_DIR', '/opt/disdat_config')
 LOG_LEVEL = logging.INFO + 1
+_DISDAT_READY = False
 
 
 """
@@ -41,9 +39,63 @@ with the zip file and attach it to this lambda function
 """
 
 
+def init_disdat():
+    """
+    point disdat to a writable home and its config, once per container. Deferred to the first request
+    so that the import of disdat is part of the cold start breakdown
+    The config baked into the layer is used as is, otherwise a fresh one is created under HOME
+    """
+    global _DISDAT_READY
+    if _DISDAT_READY:
+        return
+    try:
+        os.makedirs(HOME, exist_ok=True)
+        os.environ["HOME"] = HOME
+        with ColdStartProfile.measure('import disdat.common'):
+            from disdat.common import DisdatConfig
+        if os.path.isfile(os.path.join(BAKED_CONFIG_DIR, 'disdat.cfg')):
+            with ColdStartProfile.measure('disdat config (baked)'):
+                DisdatConfig.instance(meta_dir_root=HOME, config_dir=BAKED_CONFIG_DIR)
+        else:
+            with ColdStartProfile.measure('disdat config init'):
+                DisdatConfig.init()
+    except:
+        logging.warning("disdat already initialized; home overriding failed")
+    _DISDAT_READY = True
+
+
 def lambda_handler(event, context):
+    if _DISDAT_READY:
+        return dispatch(event)
+    init_disdat()
+    with ColdStartProfile.measure('first request'):
+        output = dispatch(event)
+    ColdStartProfile.emit()
+    return output
+
+
+def dispatch(event):
     logging.log(level=LOG_LEVEL, msg=event)
+    if PathParam.BATCH in event:
+        # batch lookup for several cached steps, each item carries its own bundle name
+        return Cache.batch_pull(event)
+    if PathParam.MAP_RESULTS in event:
+        # merge step of a Map-level cached state
+        return Cache.map_push(event)
+    if PathParam.MAP in event:
+        # lookup step of a Map-level cached state
+        return Cache.map_pull(event)
+    if PathParam.REPLAY in event:
+        # verify or replay the asynchronous pushes that failed, invoked by the user
+        return Cache.replay_dead_letters(event[PathParam.DSDT_ONLY_ARGS], push=event[PathParam.REPLAY])
     cache = Cache(event[PathParam.DSDT_ONLY_ARGS])
+    logging.log(level=LOG_LEVEL, msg='context registry reuse: {}'.format(ContextRegistry.stats()))
+    if PathParam.OUTPUT in event:
+        # cache push of the lean wrapper, the event only has the cache params and the output
+        return cache.cache_push_lean(event, parent=None)
+    if PathParam.FULL_PARAM not in event:
+        # cache pull of a projected wrapper, the event only has the cache params
+        return cache.cache_pull(event)
     if len(event) == 2:
         # if the input event is a dict of length 2, it's meant for cache_push
         # parent = cache.get_lineage()
@@ -38,6 +38,9 @@ setup(
             'twine',
             'build'
         ],
+        'zstd': [
+            'zstandard'
+        ],
     },
 
     classifiers=[
@@ -0,0 +1,107 @@
+import collections
+import datetime
+import hashlib
+import io
+import time
+
+import pytest
+from botocore.exceptions import ClientError
+from disdat import api
+from disdat_step_function import cache_lambda
+
+
+@pytest.fixture
+def no_context(monkeypatch):
+    """
+    Cache objects neither create nor bind disdat contexts, and metadata pulls do nothing
+    """
+    monkeypatch.setattr(api, 'context', lambda context: None)
+    monkeypatch.setattr(api, 'remote', lambda context, remote_context, remote_url: None)
+    monkeypatch.setattr(api, 'pull', lambda *args, **kwargs: None)
+
+
+class FakeS3:
+    """
+    dict-backed s3 client, objects are keyed by (bucket, key). Conditional puts and deletes fail like s3 does,
+    with a PreconditionFailed ClientError, and every call is counted in calls
+    """
+    class exceptions:
+        class NoSuchKey(Exception):
+            pass
+
+    def __init__(self, page_size: int = 1000, error: str = None):
+        """
+        :param page_size: int, keys per page of list_objects_v2
+        :param error: str, error code raised by every put_object, e.g. 'AccessDenied'
+        """
+        self.objects = {}
+        self.page_size = page_size
+        self.error = error
+        self.calls = collections.Counter()
+
+    def add(self, bucket: str, key: str, body: bytes, last_modified: float = None) -> str:
+        last_modified = time.time() if last_modified is None else last_modified
+        etag = '"{}"'.format(hashlib.md5(body + str(last_modified).encode()).hexdigest())
+        self.objects[(bucket, key)] = {'Body': body, 'ETag': etag, 'LastModified':
+                                       datetime.datetime.fromtimestamp(last_modified, tz=datetime.timezone.utc)}
+        return etag
+
+    def keys(self, bucket: str = None) -> list:
+        return sorted(key for b, key in self.objects if bucket is None or b == bucket)
+
+    def put_object(self, Bucket, Key, Body, IfNoneMatch=None, IfMatch=None):
+        self.calls['put_object'] += 1
+        if self.error is not None:
+            raise ClientError({'Error': {'Code': self.error}}, 'PutObject')
+        self._check(Bucket, Key, IfNoneMatch, IfMatch, 'PutObject')
+        return {'ETag': self.add(Bucket, Key, Body)}
+
+    def get_object(self, Bucket, Key):
+        self.calls['get_object'] += 1
+        obj = self._get(Bucket, Key)
+        return {'Body': io.BytesIO(obj['Body']), 'ETag': obj['ETag'], 'ContentLength': len(obj['Body'])}
+
+    def head_object(self, Bucket, Key):
+        self.calls['head_object'] += 1
+        obj = self._get(Bucket, Key)
+        return {'ETag': obj['ETag'], 'ContentLength': len(obj['Body'])}
+
+    def delete_object(self, Bucket, Key, IfMatch=None):
+        self.calls['delete_object'] += 1
+        if IfMatch is not None:
+            self._check(Bucket, Key, None, IfMatch, 'DeleteObject')
+        self.objects.pop((Bucket, Key), None)
+        return {}
+
+    def get_paginator(self, name):
+        assert name == 'list_objects_v2'
+        return self
+
+    def paginate(self, Bucket, Prefix=''):
+        self.calls['list_objects_v2'] += 1
+        keys = [key for key in self.keys(Bucket) if key.startswith(Prefix)]
+        for start in range(0, max(len(keys), 1), self.page_size):
+            yield {'Contents': [{'Key': key, 'LastModified': self.objects[(Bucket, key)]['LastModified'],
+                                 'ETag': self.objects[(Bucket, key)]['ETag']}
+                                for key in keys[start:start + self.page_size]]}
+
+    def _get(self, bucket, key):
+        if (bucket, key) not in self.objects:
+            raise self.exceptions.NoSuchKey(key)
+        return self.objects[(bucket, key)]
+
+    def _check(self, bucket, key, if_none_match, if_match, operation):
+        obj = self.objects.get((bucket, key), None)
+        if (if_none_match == '*' and obj is not None) or \
+                (if_match is not None and (obj is None or obj['ETag'] != if_match)):
+            raise ClientError({'Error': {'Code': 'PreconditionFailed'}}, operation)
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    """
+    FakeS3 used by the caching lambda
+    """
+    client = FakeS3()
+    monkeypatch.setattr(cache_lambda, '_S3_CLIENT', client)
+    return client
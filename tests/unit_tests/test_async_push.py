@@ -0,0 +1,65 @@
+import json
+
+import pytest
+from stepfunctions.steps import states
+
+from disdat_step_function.cache_lambda import Cache, PathParam as pp
+from disdat_step_function.caching_wrapper import Caching, ExtensiveGraphVisitor
+
+DSDT_ARGS = {'context': 'ctxt', 's3_bucket_url': 's3://bucket', 'bundle_name': 'bd'}
+
+
+@pytest.mark.parametrize('project_input', [False, True])
+def test_async_push_graph(project_input):
+    caching = Caching(caching_lambda_name='lambda', s3_bucket_url='s3://...', context_name='', lean_wrapper=True,
+                      project_input=project_input, async_push=True)
+    visitor = ExtensiveGraphVisitor()
+    states.Chain([caching.cache_step(states.Task(state_id='task', input_path='$.a')),
+                  states.Pass(state_id='after')]).accept(visitor)
+    push = visitor.states['cache_push_task']
+    assert push['Parameters']['InvocationType'] == 'Event'
+    assert push['Parameters']['Payload'][pp.ASYNC] is True
+    assert push['ResultPath'] == pp.PUSH_PREFIX
+    if project_input:
+        assert push['Next'] == 'cache_result_task'
+        assert visitor.states['cache_result_task']['InputPath'] == pp.CACHE_DATA_PREFIX
+        assert visitor.states['cache_result_task']['ResultPath'] == '$._dsdt_pull.Payload._data'
+    else:
+        assert push['Next'] == 'cache_output_task'
+        assert visitor.states['cache_output_task']['OutputPath'] == pp.CACHE_DATA_PREFIX
+
+
+def test_async_push_requires_lean():
+    with pytest.raises(AssertionError):
+        Caching(caching_lambda_name='', s3_bucket_url='s3://...', context_name='', async_push=True)
+
+
+def test_dead_letter(s3, no_context, monkeypatch):
+    monkeypatch.setattr(Cache, 'push', lambda self, cache_params, output, parent=None: 1 / 0)
+    event = {pp.CACHE_PARAM: {'a': 1}, pp.OUTPUT: 'out', pp.ASYNC: True, pp.DSDT_ONLY_ARGS: DSDT_ARGS}
+    # lambda retries the event, the dead letter is written once
+    for _ in range(2):
+        with pytest.raises(ZeroDivisionError):
+            Cache(DSDT_ARGS).cache_push_lean(event)
+    assert len(s3.keys()) == 1
+    key = s3.keys()[0]
+    assert key.startswith('ctxt/_dsdt_dead_letters/bd/')
+    assert json.load(s3.get_object(Bucket='bucket', Key=key)['Body'])['event'] == event
+
+
+@pytest.mark.parametrize('push', [True, False])
+def test_replay_dead_letters(s3, no_context, monkeypatch, push):
+    pushed = []
+    monkeypatch.setattr(Cache, 'lookup', lambda self, cache_params, pull_metadata=True:
+                        (cache_params == 'durable', None))
+    monkeypatch.setattr(Cache, 'push', lambda self, cache_params, output, parent=None: pushed.append(output))
+    for params in ['durable', 'lost']:
+        event = {pp.CACHE_PARAM: params, pp.OUTPUT: params, pp.ASYNC: True, pp.DSDT_ONLY_ARGS: DSDT_ARGS}
+        s3.put_object(Bucket='bucket', Key='ctxt/_dsdt_dead_letters/bd/{}.json'.format(params),
+                      Body=json.dumps({'event': event}).encode('utf-8'))
+    report = Cache.replay_dead_letters(dict(DSDT_ARGS, bundle_name=None), push=push)
+    assert report['durable'] == ['ctxt/_dsdt_dead_letters/bd/durable.json']
+    lost = ['ctxt/_dsdt_dead_letters/bd/lost.json']
+    assert (report['pushed'], report['missing']) == ((lost, []) if push else ([], lost))
+    assert pushed == (['lost'] if push else [])
+    assert s3.keys() == ([] if push else lost)
@@ -0,0 +1,75 @@
+import concurrent.futures
+import random
+import time
+
+import pytest
+from stepfunctions.steps import states
+
+from disdat_step_function import cache_lambda
+from disdat_step_function.cache_lambda import Cache, PathParam as pp
+from disdat_step_function.caching_wrapper import Caching, ExtensiveGraphVisitor
+
+
+caching = Caching(caching_lambda_name='',
+                  s3_bucket_url='s3://...',
+                  context_name='',
+                  verbose=True)
+
+
+def test_cache_batch_graph():
+    task_a = states.Task(state_id='task_a', input_path='$.a')
+    task_b = states.Task(state_id='task_b')
+    lookup, wrappers = caching.cache_batch([task_a, task_b], bundle_names=['bundle_a', None])
+    parallel = states.Parallel(state_id='parallel')
+    for w in wrappers:
+        parallel.add_branch(w)
+    graph = states.Chain([lookup, parallel])
+
+    visitor = ExtensiveGraphVisitor()
+    graph.accept(visitor)
+    assert 'cache_pull_task_a' not in visitor.states
+    assert visitor.states['cache_select_task_a']['Next'] == 'use_cache?_task_a'
+    assert visitor.states['cache_select_task_b']['Parameters'][pp.USE_CACHE + '.$'] == '$._dsdt_batch[1]._use_cache'
+
+    items = lookup.to_dict()['Parameters']['Payload'][pp.BATCH]
+    assert items['0']['bundle_name'] == 'bundle_a'
+    assert items['0'][pp.CACHE_PARAM_SUFFIX] == '$.a'
+    assert items['1']['bundle_name'] == 'task_b'
+    assert items['1'][pp.CACHE_PARAM_SUFFIX] == '$'
+
+
+@pytest.mark.parametrize('pointer_lookup', [True, False])
+def test_batch_pull_order(monkeypatch, no_context, pointer_lookup):
+
+    def lookup(self, cache_params, pull_metadata=True):
+        time.sleep(random.random() / 100)
+        return cache_params % 2 == 0, '{}_{}'.format(self.bundle_name, cache_params)
+
+    monkeypatch.setattr(Cache, 'lookup', lookup)
+    items = {str(i): {'bundle_name': 'bd_{}'.format(i), pp.CACHE_PARAM: i} for i in range(40)}
+    event = {pp.BATCH: items, pp.FULL_PARAM: {'foo': 'bar'},
+             pp.DSDT_ONLY_ARGS: {'context': 'ctxt', 's3_bucket_url': 's3://...', 'pointer_lookup': pointer_lookup}}
+    output = Cache.batch_pull(event)
+    assert output[pp.FULL_PARAM] == {'foo': 'bar'}
+    assert [r[pp.CACHE_DATA] for r in output[pp.BATCH]] == ['bd_{0}_{0}'.format(i) for i in range(40)]
+    assert [r[pp.USE_CACHE] for r in output[pp.BATCH]] == [i % 2 == 0 for i in range(40)]
+
+
+@pytest.mark.parametrize('factory, attribute', [('s3_client', '_S3_CLIENT'), ('sfn_client', '_SFN_CLIENT')])
+def test_client_created_once(monkeypatch, factory, attribute):
+    """
+    the lookup threads of a cold container share a single boto3 client
+    """
+    import boto3
+    created = []
+
+    def client(name):
+        created.append(name)
+        time.sleep(0.01)
+        return object()
+    monkeypatch.setattr(boto3, 'client', client)
+    monkeypatch.setattr(cache_lambda, attribute, None)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=16) as pool:
+        clients = list(pool.map(lambda _: getattr(cache_lambda, factory)(), range(16)))
+    assert len(created) == 1
+    assert all(c is clients[0] for c in clients)
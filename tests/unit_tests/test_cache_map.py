@@ -0,0 +1,84 @@
+import pytest
+from stepfunctions.steps import states
+
+from disdat_step_function.cache_lambda import Cache, PathParam as pp
+from disdat_step_function.caching_wrapper import Caching, ExtensiveGraphVisitor, PipelineCaching
+
+
+caching = Caching(caching_lambda_name='',
+                  s3_bucket_url='s3://...',
+                  context_name='',
+                  verbose=True)
+
+
+def test_map_pull_push(monkeypatch, no_context):
+    store = {i: 'cached_{}'.format(i) for i in range(0, 100, 3)}
+    monkeypatch.setattr(Cache, 'lookup', lambda self, p, pull_metadata=True: (p['id'] in store, store.get(p['id'])))
+    dsdt_args = {'context': 'ctxt', 's3_bucket_url': 's3://...', 'bundle_name': 'map', 'pointer_lookup': True}
+    full_params = {'other': 'field', 'nested': {'items': [{'id': i} for i in range(100)]}}
+
+    pulled = Cache.map_pull({pp.FULL_PARAM: full_params, pp.MAP: {'items_path': '$.nested.items'},
+                             pp.DSDT_ONLY_ARGS: dsdt_args})
+    missed = pulled[pp.FULL_PARAM]['nested']['items']
+    assert pulled[pp.FULL_PARAM]['other'] == 'field'
+    assert [item['id'] for item in missed] == [i for i in range(100) if i % 3 != 0]
+
+    # the Map state only runs over the missed items, and its iterations push their outputs
+    outputs = ['computed_{}'.format(item['id']) for item in missed]
+    merged = Cache.map_push(dict(pulled, **{pp.MAP_RESULTS: outputs, pp.DSDT_ONLY_ARGS: dsdt_args}))
+    assert merged == ['cached_{}'.format(i) if i % 3 == 0 else 'computed_{}'.format(i) for i in range(100)]
+
+
+def test_cache_map_graph():
+    mapper = states.Map(state_id='mapper', items_path='$.items')
+    mapper.attach_iterator(states.Task(state_id='task'))
+    chain = caching.cache_map(mapper)
+    assert [s.state_id for s in chain.steps] == ['cache_lookup_map_mapper', 'mapper', 'cache_merge_map_mapper']
+    assert mapper.to_dict()['InputPath'] == pp.FULL_PARAM_PREFIX
+    assert mapper.to_dict()['ResultPath'] == pp.MAP_RESULTS_PREFIX
+    assert chain.steps[0].to_dict()['Parameters']['Payload'][pp.MAP] == {'items_path': '$.items'}
+    # each iteration pushes the output of its item, the raw item is the cache params
+    visitor = ExtensiveGraphVisitor()
+    chain.accept(visitor)
+    assert visitor.states['param_pass_map_mapper']['Parameters'] == {pp.CACHE_PARAM_SUFFIX: '$'}
+    assert visitor.states['execute_map_mapper']['Next'] == 'cache_push_map_mapper'
+    assert visitor.states['cache_push_map_mapper']['Parameters']['Payload'][pp.FULL_PARAM_SUFFIX] == '$'
+    assert 'task' in visitor.states
+
+    with pytest.raises(AssertionError):
+        caching.cache_map(states.Map(state_id='mapper_2', result_path='$.out'))
+
+
+@pytest.mark.parametrize('parameters', [{'item.$': '$$.Map.Item.Value'},
+                                        {'id.$': '$$.Map.Item.Index', 'config.$': '$.config'}])
+def test_map_parameters(parameters):
+    """
+    items are cached on their raw value, Maps that select the iterator input with Parameters are not wrapped
+    """
+    def make_map():
+        mapper = states.Map(state_id='mapper', items_path='$.items', parameters=parameters)
+        mapper.attach_iterator(states.Task(state_id='task'))
+        return mapper
+
+    with pytest.raises(AssertionError):
+        caching.cache_map(make_map())
+
+    mapper = make_map()
+    PipelineCaching(mapper, caching, cache_maps=True).cache()
+    visitor = ExtensiveGraphVisitor()
+    states.Chain([mapper]).accept(visitor)
+    assert 'cache_lookup_map_mapper' not in visitor.states
+    assert mapper.to_dict()['Parameters'] == parameters
+    assert 'cache_pull_task' in visitor.states
+
+
+def test_map_iteration_push(monkeypatch, no_context):
+    """
+    the cache push at the end of an iteration receives the item and the output of the iterator
+    """
+    pushed = []
+    monkeypatch.setattr(Cache, 'push', lambda self, p, output, parent=None: pushed.append((p, output)) or output)
+    dsdt_args = {'context': 'ctxt', 's3_bucket_url': 's3://...', 'bundle_name': 'map'}
+    event = {pp.FULL_PARAM: [{pp.CACHE_PARAM: {'id': 1}}, 'computed_1']}
+    assert Cache(dsdt_args).cache_push(event) == 'computed_1'
+    assert pushed == [({'id': 1}, 'computed_1')]
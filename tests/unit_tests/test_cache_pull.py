@@ -83,3 +83,25 @@ def test_cache_pull(bd_name, data, params, force_rerun, should_use_cache):
     else:
         check_integrity(output, expected_data=None, expected_param=event[pp.CACHE_PARAM])
 
+
+"""
+Test caching pull with pointer lookup 
+"""
+
+@pytest.mark.parametrize('bd_name,data,params,force_rerun,should_use_cache', test_data)
+def test_cache_pull_pointer(bd_name, data, params, force_rerun, should_use_cache):
+    func_name = inspect.currentframe().f_code.co_name
+    event = generate_input_event(full_params=data, cache_params=params, bundle_name=func_name, force_run=force_rerun)
+    event[pp.DSDT_ONLY_ARGS]['pointer_lookup'] = True
+    # cache push writes the pointer along with the bundle
+    push_event = {pp.FULL_PARAM: [{pp.CACHE_PARAM: event[pp.CACHE_PARAM]}, data],
+                  pp.DSDT_ONLY_ARGS: event[pp.DSDT_ONLY_ARGS]}
+    Cache(event[pp.DSDT_ONLY_ARGS]).cache_push(push_event)
+    api.rm(CONTEXT, bundle_name=func_name, rm_all=True)
+
+    output = Cache(event[pp.DSDT_ONLY_ARGS]).cache_pull(event)
+    assert output[pp.USE_CACHE] == should_use_cache
+    if should_use_cache:
+        check_integrity(output, expected_data=data, expected_param=event[pp.CACHE_PARAM])
+    else:
+        check_integrity(output, expected_data=None, expected_param=event[pp.CACHE_PARAM])
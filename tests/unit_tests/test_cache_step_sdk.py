@@ -0,0 +1,32 @@
+import pytest
+from stepfunctions.steps import states
+
+from disdat_step_function.cache_lambda import PathParam as pp
+from disdat_step_function.caching_wrapper import Caching, ExtensiveGraphVisitor
+
+
+@pytest.mark.parametrize('force_rerun', [False, True])
+def test_cache_step_sdk_graph(force_rerun):
+    sdk_caching = Caching(caching_lambda_name='', s3_bucket_url='s3://bucket/prefix', context_name='ctxt')
+    task = states.Task(state_id='task', input_path='$.a')
+    graph = states.Chain([sdk_caching.cache_step_sdk(task, bundle_name='bd', force_rerun=force_rerun),
+                          states.Pass(state_id='after')])
+    visitor = ExtensiveGraphVisitor()
+    graph.accept(visitor)
+    key = visitor.states['cache_key_task']['Parameters']
+    assert key[pp.CACHE_PARAM_SUFFIX] == '$.a'
+    assert key[pp.HIT_KEY_SUFFIX].startswith("States.Format('prefix/ctxt/_dsdt_hits/bd/{}.json'")
+    assert visitor.states['cache_push_task']['Next'] == 'cache_done_task'
+    assert visitor.states['cache_done_task']['Next'] == 'after'
+    assert visitor.states['param_resolve_task']['InputPath'] == pp.FULL_PARAM_PREFIX
+    if force_rerun:
+        assert 'cache_check_task' not in visitor.states
+        assert visitor.states['cache_key_task']['Next'] == 'execute_task'
+    else:
+        check = visitor.states['cache_check_task']
+        assert check['Parameters'] == {'Bucket': 'bucket', 'Key.$': pp.HIT_KEY_PREFIX}
+        assert check['Catch'][0]['Next'] == 'execute_task'
+        # only a missing hit object is a miss, the role needs s3:ListBucket to get NoSuchKey instead of AccessDenied
+        assert check['Catch'][0]['ErrorEquals'] == ['S3.NoSuchKeyException']
+        assert check['Next'] == 'cache_hit_task'
+        assert visitor.states['cache_hit_task']['Next'] == 'cache_done_task'
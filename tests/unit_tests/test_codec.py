@@ -0,0 +1,48 @@
+import io
+import pytest
+from disdat_step_function.cache_lambda import Codec, CACHED_DATA_FILE
+
+
+test_data = [
+    {'foo': 'bar'},
+    {'dict': {'list': [1, 2, 3]}, 'int': 123, 'str': 'foobar'},
+    [0.5] * 1000,
+    'café',
+    None,
+]
+
+
+@pytest.mark.parametrize('codec', Codec.names())
+@pytest.mark.parametrize('data', test_data)
+def test_round_trip(codec, data):
+    if codec == Codec.ZSTD:
+        pytest.importorskip('zstandard')
+    assert Codec.decode(Codec.encode(data, codec), codec) == data
+
+
+def test_legacy_bundle():
+    # bundles written before compression have no codec param and a plain json file
+    assert Codec.file_name(None) == CACHED_DATA_FILE
+    assert Codec.decode(b'{"foo": "bar"}', None) == {'foo': 'bar'}
+
+
+def test_unknown_codec():
+    with pytest.raises(ValueError):
+        Codec.encode({}, 'lz4')
+
+
+@pytest.mark.parametrize('codec', Codec.names())
+@pytest.mark.parametrize('fmt', [Codec.JSON, Codec.NDJSON])
+def test_streaming_round_trip(codec, fmt):
+    if codec == Codec.ZSTD:
+        pytest.importorskip('zstandard')
+    data = [{'id': i, 'name': 'item_{}'.format(i)} for i in range(5000)]
+    buffer = io.BytesIO()
+    Codec.dump(data, buffer, codec, fmt, streaming=True)
+    buffer.seek(0)
+    assert list(Codec.iter_load(buffer, codec, fmt)) == data
+    assert Codec.decode(buffer.getvalue(), codec, fmt) == data
+
+
+def test_ndjson_file_name():
+    assert Codec.file_name(Codec.GZIP, Codec.NDJSON) == 'cached_data.ndjson.gz'
@@ -0,0 +1,79 @@
+import os
+import shutil
+import subprocess
+import sys
+
+import pytest
+from disdat_step_function import cache_lambda
+from disdat_step_function.cache_lambda import ColdStartProfile, LazyModule
+from disdat_step_function.caching_wrapper import LambdaGenerator
+
+# the handler imports cache_lambda as a top level module, as it does in the generated lambda
+HANDLER_DIR = os.path.dirname(cache_lambda.__file__)
+
+
+@pytest.fixture
+def profile(monkeypatch):
+    monkeypatch.setattr(ColdStartProfile, '_steps', ColdStartProfile._steps.__class__())
+    monkeypatch.setattr(ColdStartProfile, '_emitted', False)
+    return ColdStartProfile
+
+
+def test_emit_once(profile):
+    with profile.measure('init'):
+        pass
+    lazy = LazyModule('colorsys')
+    assert lazy.rgb_to_hsv(0, 0, 0) == (0, 0, 0)
+    steps = profile.emit()
+    assert list(steps) == ['init', 'import colorsys']
+    assert profile.emit() is None
+
+
+def test_disdat_not_imported():
+    code = 'import sys; import disdat_step_function.cache_lambda; print("disdat.api" in sys.modules)'
+    output = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True).stdout
+    assert output.strip() == 'False'
+
+
+def layer_with_disdat(tmp_path, config: str = None) -> str:
+    """
+    a layer with the config file of disdat, the one of the host unless config is set
+    """
+    import disdat.config
+    src = os.path.join(os.path.dirname(disdat.config.__file__), 'disdat', 'disdat.cfg')
+    dst = tmp_path / 'layer' / 'python' / 'disdat' / 'config' / 'disdat' / 'disdat.cfg'
+    dst.parent.mkdir(parents=True)
+    if config is None:
+        shutil.copyfile(src, str(dst))
+    else:
+        dst.write_text(config)
+    return str(tmp_path / 'layer')
+
+
+def test_baked_config(tmp_path):
+    config = LambdaGenerator.bake_config(layer_with_disdat(tmp_path))
+    assert os.stat(config).st_mode & 0o777 == 0o444
+    # a cold container with the baked config does not write a config under HOME
+    home = tmp_path / 'home'
+    code = '; '.join(['import lambda_for_user',
+                      'lambda_for_user.HOME = {!r}'.format(str(home)),
+                      'lambda_for_user.init_disdat()',
+                      'from disdat.common import DisdatConfig',
+                      'print(DisdatConfig.instance().parser.get("core", "ignore_code_version"))'])
+    env = dict(os.environ, DISDAT_BAKED_CONFIG_DIR=os.path.dirname(config),
+               PYTHONPATH=HANDLER_DIR)
+    output = subprocess.run([sys.executable, '-c', code], env=env, capture_output=True, text=True, check=True)
+    assert output.stdout.strip() == 'True'
+    assert not (home / '.config').exists()
+
+
+def test_baked_config_from_layer(tmp_path):
+    # the layer may install another disdat version than the host
+    config = LambdaGenerator.bake_config(layer_with_disdat(tmp_path, config='[core]\nlayer = True\n'))
+    with open(config) as fp:
+        assert 'layer = True' in fp.read()
+
+
+def test_baked_config_without_disdat(tmp_path):
+    with pytest.raises(FileNotFoundError):
+        LambdaGenerator.bake_config(str(tmp_path / 'layer'))
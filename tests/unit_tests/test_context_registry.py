@@ -0,0 +1,47 @@
+import pytest
+from disdat import api
+from disdat_step_function.cache_lambda import ContextRegistry
+
+
+@pytest.fixture
+def calls(monkeypatch):
+    """
+    record api.context/api.remote calls instead of creating contexts on disk
+    """
+    calls = []
+    monkeypatch.setattr(api, 'context', lambda context: calls.append(('context', context)))
+    monkeypatch.setattr(api, 'remote', lambda context, remote_context, remote_url:
+                        calls.append(('remote', context, remote_url)))
+    ContextRegistry.invalidate()
+    yield calls
+    ContextRegistry.invalidate()
+
+
+def test_warm_reuse(calls):
+    for _ in range(3):
+        ContextRegistry.bind('ctxt', 's3://bucket')
+    assert len(calls) == 2
+    assert ContextRegistry.stats() == {'ctxt@s3://bucket': 2}
+
+
+def test_rebind_new_url(calls):
+    ContextRegistry.bind('ctxt', 's3://bucket')
+    ContextRegistry.bind('ctxt', 's3://other')
+    assert calls[-1] == ('remote', 'ctxt', 's3://other')
+    assert ContextRegistry.stats() == {'ctxt@s3://other': 0}
+
+
+def test_invalidate(calls):
+    ContextRegistry.bind('ctxt_1', 's3://bucket')
+    ContextRegistry.bind('ctxt_2', 's3://bucket')
+    ContextRegistry.invalidate(context='ctxt_1')
+    assert list(ContextRegistry.stats()) == ['ctxt_2@s3://bucket']
+    ContextRegistry.bind('ctxt_1', 's3://bucket')
+    assert len(calls) == 6
+
+
+def test_config_change(calls, monkeypatch, tmp_path):
+    ContextRegistry.bind('ctxt', 's3://bucket')
+    monkeypatch.setenv('HOME', str(tmp_path))
+    ContextRegistry.bind('ctxt', 's3://bucket')
+    assert len(calls) == 4
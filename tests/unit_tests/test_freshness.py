@@ -0,0 +1,114 @@
+import json
+
+import pytest
+from stepfunctions.steps import states
+
+from disdat_step_function import cache_lambda
+from disdat_step_function.cache_lambda import Cache, PathParam as pp
+from disdat_step_function.caching_wrapper import Caching, ExtensiveGraphVisitor
+
+SM_ARN = 'arn:aws:states:us-east-1:123:stateMachine:sm'
+EXEC_ARN = 'arn:aws:states:us-east-1:123:execution:sm:{}'
+
+
+class FakeStepFunctions:
+    class exceptions:
+        class ExecutionAlreadyExists(Exception):
+            pass
+
+    def __init__(self):
+        self.started = []
+
+    def describe_execution(self, executionArn):
+        return {'input': json.dumps({'execution': executionArn})}
+
+    def start_execution(self, stateMachineArn, name, input):
+        if name in [started['name'] for started in self.started]:
+            raise self.exceptions.ExecutionAlreadyExists()
+        self.started.append({'name': name, 'input': input})
+
+
+@pytest.fixture
+def aws(monkeypatch, no_context, s3):
+    sfn, clock = FakeStepFunctions(), [10000.0]
+    monkeypatch.setattr(cache_lambda, 'sfn_client', lambda: sfn)
+    monkeypatch.setattr(cache_lambda.time, 'time', lambda: clock[0])
+    return s3, sfn
+
+
+def make_cache(execution: str, **kwargs):
+    return Cache(dict({'context': 'ctxt', 's3_bucket_url': 's3://bucket', 'bundle_name': 'bd',
+                       'execution_arn': EXEC_ARN.format(execution), 'state_machine_arn': SM_ARN,
+                       'max_age': 100, 'stale_while_revalidate': 50, 'replay_refresh': True}, **kwargs))
+
+
+test_data = [
+    # (age of the hit, used, refresh started)
+    (10, True, False),
+    (120, True, True),
+    (200, False, False),
+]
+
+
+@pytest.mark.parametrize('age, used, refreshed', test_data)
+def test_freshness(aws, age, used, refreshed):
+    s3, sfn = aws
+    assert make_cache('run_1').fresh_enough('f', 'proc', created=10000 - age) == used
+    assert len(sfn.started) == int(refreshed)
+
+
+def test_no_max_age(aws):
+    s3, sfn = aws
+    assert make_cache('run_1', max_age=None).fresh_enough('f', 'proc', created=0)
+    assert sfn.started == []
+
+
+def test_refresh(aws):
+    s3, sfn = aws
+    stale = 10000 - 120
+    make_cache('run_1').fresh_enough('f', 'proc_a', stale)
+    # another stale step of the same execution shares the refresh execution
+    make_cache('run_1').fresh_enough('f', 'proc_b', stale)
+    # proc_a is already being refreshed
+    make_cache('run_2').fresh_enough('f', 'proc_a', stale)
+    assert len(sfn.started) == 1
+    assert json.loads(sfn.started[0]['input']) == {'execution': EXEC_ARN.format('run_1')}
+
+    # the refresh execution recomputes the stale steps, and does not trigger another refresh
+    refresh = make_cache(sfn.started[0]['name'])
+    assert refresh.is_refresh()
+    assert not refresh.fresh_enough('f', 'proc_a', stale)
+    assert not refresh.fresh_enough('f', 'proc_b', stale)
+    assert refresh.fresh_enough('f', 'proc_c', stale)
+    assert len(sfn.started) == 1
+
+
+def test_no_replay(aws):
+    s3, sfn = aws
+    # the stale hit is used, the state machine is not replayed without the opt-in
+    assert make_cache('run_1', replay_refresh=False).fresh_enough('f', 'proc', created=10000 - 120)
+    assert sfn.started == []
+    assert s3.keys() == []
+
+
+def test_refresh_failure(aws, monkeypatch):
+    s3, sfn = aws
+    monkeypatch.setattr(sfn, 'describe_execution', lambda executionArn: 1 / 0)
+    assert make_cache('run_1').fresh_enough('f', 'proc', created=10000 - 120)
+
+
+def test_cache_step_args():
+    caching = Caching(caching_lambda_name='', s3_bucket_url='s3://...', context_name='')
+    visitor = ExtensiveGraphVisitor()
+    states.Chain([caching.cache_step(states.Task(state_id='fresh'), max_age=3600, stale_while_revalidate=600,
+                                     replay_refresh=True),
+                  caching.cache_step(states.Task(state_id='any_age'))]).accept(visitor)
+    args = visitor.states['cache_pull_fresh']['Parameters']['Payload'][pp.DSDT_ONLY_ARGS]
+    assert (args['max_age'], args['stale_while_revalidate'], args['replay_refresh']) == (3600, 600, True)
+    assert 'max_age' not in visitor.states['cache_pull_any_age']['Parameters']['Payload'][pp.DSDT_ONLY_ARGS]
+
+
+def test_replay_requires_window():
+    caching = Caching(caching_lambda_name='', s3_bucket_url='s3://...', context_name='')
+    with pytest.raises(AssertionError):
+        caching.cache_step(states.Task(state_id='task'), max_age=3600, replay_refresh=True)
@@ -0,0 +1,159 @@
+import importlib.util
+import os
+import shutil
+import sys
+
+import pytest
+from disdat_step_function import caching_wrapper
+from disdat_step_function.caching_wrapper import LambdaGenerator, LayerBuilder
+
+
+MODULE = '''"""
+module docstring
+"""
+from __future__ import annotations
+
+
+class A:
+    """class docstring"""
+
+    def f(self):
+        """
+        café
+        """
+        return 1 / 0
+'''
+
+
+@pytest.fixture
+def layer(tmp_path):
+    files = {'python/pkg/__init__.py': MODULE,
+             'python/pkg/tests/test_pkg.py': 'x = 1\n' * 1000,
+             'python/pkg/__pycache__/stale.cpython-38.pyc': 'x',
+             'python/pkg/README.md': 'readme',
+             'python/pkg-1.0.dist-info/METADATA': 'Name: pkg',
+             'python/pkg-1.0.dist-info/RECORD': 'pkg/__init__.py',
+             'python/other/__init__.py': 'y = 2\n',
+             'disdat_config/disdat.cfg': '[core]\n'}
+    for name, content in files.items():
+        path = tmp_path / 'layer' / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(content, encoding='utf-8')
+    return tmp_path / 'layer'
+
+
+def test_build(layer, tmp_path):
+    builder = LayerBuilder(python=sys.executable, strip_docstrings=['pkg'])
+    report = builder.build(str(layer), str(tmp_path / 'layer_zip'))
+    assert not (layer / 'python' / 'pkg' / 'tests').exists()
+    assert not (layer / 'python' / 'pkg' / 'README.md').exists()
+    assert not (layer / 'python' / 'pkg-1.0.dist-info' / 'RECORD').exists()
+    assert (layer / 'python' / 'pkg-1.0.dist-info' / 'METADATA').exists()
+    assert report['pruned'] > 6000
+    assert set(report['packages']) == {'pkg', 'pkg-1.0.dist-info', 'other', 'disdat_config'}
+    assert os.path.isfile(str(tmp_path / 'layer_zip.zip'))
+
+    pyc = importlib.util.cache_from_source(str(layer / 'python' / 'pkg' / '__init__.py'))
+    with open(pyc, 'rb') as fp:
+        header = fp.read(16)
+    # hash based pyc, the source is not checked
+    assert int.from_bytes(header[4:8], 'little') == 0b01
+
+    spec = importlib.util.spec_from_file_location('pkg', str(layer / 'python' / 'pkg' / '__init__.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    assert not module.__doc__ and not module.A.__doc__ and not module.A.f.__doc__
+    # line numbers are kept
+    with pytest.raises(ZeroDivisionError) as error:
+        module.A().f()
+    assert error.traceback[-1].lineno + 1 == 14
+
+
+def test_size_budget(layer, tmp_path):
+    builder = LayerBuilder(precompile=False, zip_budget=10)
+    with pytest.raises(RuntimeError, match='exceeds its size budget'):
+        builder.build(str(layer), str(tmp_path / 'layer_zip'))
+
+
+def test_layer_key():
+    key = LambdaGenerator.layer_key(['disdat==0.9', 'stepfunctions==2.2.0'], LayerBuilder())
+    assert key == LambdaGenerator.layer_key(['stepfunctions==2.2.0', 'disdat==0.9'], LayerBuilder())
+    assert key != LambdaGenerator.layer_key(['disdat==1.0', 'stepfunctions==2.2.0'], LayerBuilder())
+    assert key != LambdaGenerator.layer_key(['disdat==0.9', 'stepfunctions==2.2.0'], LayerBuilder(python_version='3.9'))
+    assert key != LambdaGenerator.layer_key(['disdat==0.9', 'stepfunctions==2.2.0'],
+                                            LayerBuilder(strip_docstrings=['disdat']))
+    # the budgets do not change the content of the layer
+    assert key == LambdaGenerator.layer_key(['disdat==0.9', 'stepfunctions==2.2.0'], LayerBuilder(zip_budget=1))
+
+
+def install_disdat(layer_dir):
+    """
+    the config file of the disdat installed in the layer, baked by install_dep
+    """
+    config = os.path.join(layer_dir, 'python', 'disdat', 'config', 'disdat', 'disdat.cfg')
+    os.makedirs(os.path.dirname(config))
+    with open(config, 'w') as fp:
+        fp.write('[core]\n')
+
+
+def test_install_dep_reuse(layer, tmp_path, monkeypatch):
+    monkeypatch.setattr(LambdaGenerator, 'CACHE_DIR', str(tmp_path / 'cache'))
+    docker = []
+
+    def fake_docker(cmd, check):
+        # the docker run fills the dependency folder
+        docker.append(cmd[1])
+        if cmd[1] == 'run':
+            # the previous build is removed inside the container, its files are owned by root
+            assert cmd[-1].startswith('find /lib/dependency -mindepth 1 -delete && ')
+            # the installed files belong to the current user, the layer builder prunes them on the host
+            assert cmd[3:5] == ['--user', '{}:{}'.format(os.getuid(), os.getgid())]
+            target = cmd[cmd.index('-v') + 1].split(':')[0]
+            shutil.rmtree(target)
+            shutil.copytree(str(layer), target)
+            install_disdat(target)
+    monkeypatch.setattr(caching_wrapper.subprocess, 'run', fake_docker)
+
+    builder = LayerBuilder(precompile=False)
+    root = tmp_path / 'generated'
+    key = LambdaGenerator.install_dep(root, builder=builder)
+    assert docker == ['build', 'run']
+    layer_zip = root / (LambdaGenerator.DISDAT_LAYER + '.zip')
+    built = layer_zip.read_bytes()
+    layer_zip.unlink()
+
+    assert LambdaGenerator.install_dep(root, builder=builder) == key
+    assert docker == ['build', 'run']
+    assert layer_zip.read_bytes() == built
+
+    LambdaGenerator.install_dep(root, builder=builder, requirements=['disdat==1.0'])
+    assert docker == ['build', 'run'] * 2
+    LambdaGenerator.install_dep(root, force_rerun=True, builder=builder)
+    assert docker == ['build', 'run'] * 3
+    assert len(list((tmp_path / 'cache' / 'layers').glob('*.zip'))) == 2
+
+
+def test_generate_requirements(tmp_path, monkeypatch):
+    installed = []
+    monkeypatch.setattr(LambdaGenerator, 'install_dep',
+                        classmethod(lambda cls, root, force_rerun, builder, requirements: installed.append(requirements)))
+    LambdaGenerator.generate(tmp_path, requirements=['disdat>=1.2', 'zstandard'])
+    assert installed == [['disdat>=1.2', 'zstandard']]
+
+
+def test_install_dep_quoting(layer, tmp_path, monkeypatch):
+    monkeypatch.setattr(LambdaGenerator, 'CACHE_DIR', str(tmp_path / 'cache'))
+    commands = []
+
+    def fake_docker(cmd, check):
+        commands.append(cmd)
+        if cmd[1] == 'run':
+            target = cmd[cmd.index('-v') + 1].split(':')[0]
+            shutil.rmtree(target)
+            shutil.copytree(str(layer), target)
+            install_disdat(target)
+    monkeypatch.setattr(caching_wrapper.subprocess, 'run', fake_docker)
+    LambdaGenerator.install_dep(tmp_path / 'generated', builder=LayerBuilder(precompile=False),
+                                requirements=['disdat>=1.2', 'stepfunctions==2.2.0'])
+    # a pinned requirement is not a shell redirect
+    assert "pip install 'disdat>=1.2' stepfunctions==2.2.0 -t ." in commands[1][-1]
@@ -0,0 +1,25 @@
+import pytest
+from stepfunctions.steps import states
+
+from disdat_step_function.cache_lambda import Cache, PathParam as pp
+from disdat_step_function.caching_wrapper import Caching, ExtensiveGraphVisitor
+
+
+def test_cache_step_lean_fallback():
+    lean_caching = Caching(caching_lambda_name='', s3_bucket_url='s3://...', context_name='', lean_wrapper=True)
+    lean = lean_caching.cache_step(states.Task(state_id='lean', input_path='$.a'))
+    full = lean_caching.cache_step(states.Task(state_id='full', result_path='$.b'))
+    visitor = ExtensiveGraphVisitor()
+    states.Chain([lean, full]).accept(visitor)
+    assert visitor.states['lean']['InputPath'] == '$._full_params.a'
+    assert visitor.states['lean']['ResultPath'] == '$._data'
+    assert visitor.states['cache_push_lean']['Parameters']['Payload'][pp.OUTPUT_SUFFIX] == '$._data'
+    assert 'execute_lean' not in visitor.states
+    assert visitor.states['execute_full']['Type'] == 'Parallel'
+
+
+def test_cache_push_lean(monkeypatch, no_context):
+    monkeypatch.setattr(Cache, 'push', lambda self, cache_params, output, parent=None: [cache_params, output])
+    cache = Cache({'context': 'ctxt', 's3_bucket_url': 's3://...', 'bundle_name': 'bd'})
+    output = cache.cache_push_lean({pp.CACHE_PARAM: 1, pp.OUTPUT: 2, pp.DSDT_ONLY_ARGS: {}})
+    assert output == {pp.CACHE_DATA: [1, 2]}
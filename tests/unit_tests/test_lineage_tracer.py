@@ -1,5 +1,6 @@
 import pytest
 from typing import Iterable
+from disdat_step_function import cache_lambda
 from disdat_step_function.cache_lambda import Cache
 import json
 
@@ -20,20 +21,20 @@ def log_loader(filepath: str, page_size: int = 100) -> Iterable:
 test_data = [
     # ['./tests/unit_tests/workflow_logs/simple_workflow.txt',
     #  [('task_0', None), ('task_1', 'task_0'), ('task_2', 'task_1')]],
-    #
-    # ['./tests/unit_tests/workflow_logs/parallel_workflow.txt',
-    #  [('pass_1', None), ('pass_2', None)]],
 
-    # ['./tests/unit_tests/workflow_logs/complex_workflow.txt',
-    #  [('cw_bd_4', None)]],
-# ('cw_bd_1', None), ('cw_bd_2', 'cw_bd_1'), ('cw_bd_3', 'cw_bd_1'),
+    ['./tests/unit_tests/workflow_logs/parallel_workflow.txt',
+     [('cw_bd_1', None), ('cw_bd_2', 'cw_bd_1'), ('cw_bd_3', 'cw_bd_1')]],
+
+    ['./tests/unit_tests/workflow_logs/complex_workflow.txt',
+     [('cw_bd_1', None), ('cw_bd_2', 'cw_bd_1'), ('cw_bd_3', 'cw_bd_1'), ('cw_bd_4', 'cw_bd_3')]],
 ]
 
 
+@pytest.mark.parametrize('page_size', [1, 7, 100])
 @pytest.mark.parametrize('file_path, dependency', test_data)
-def test_lineage_tracer(file_path: str, dependency: list):
+def test_lineage_tracer(file_path: str, dependency: list, page_size: int):
     for (child_name, parent_name) in dependency:
-        logs = log_loader(file_path, page_size=100)
+        logs = log_loader(file_path, page_size=page_size)
         event = Cache.lineage_tracer(logs, bundle_name=child_name)
         # print(child_name, event)
         if event is None:
@@ -41,3 +42,73 @@ def test_lineage_tracer(file_path: str, dependency: list):
         else:
             assert event.bundle_name == parent_name, 'lineage tracer identify a wrong parent for {}'.format(child_name)
 
+
+
+def test_lineage_tracer_stops_paging():
+    pages = list(log_loader('./tests/unit_tests/workflow_logs/complex_workflow.txt', page_size=10))
+    consumed = []
+
+    def logs():
+        for page in pages:
+            consumed.append(page)
+            yield page
+
+    event = Cache.lineage_tracer(logs(), bundle_name='cw_bd_4')
+    assert event.bundle_name == 'cw_bd_3'
+    assert len(consumed) < len(pages)
+
+
+class FakeStepFunctions:
+    """
+    records the stepfunctions calls of the lineage code
+    """
+    def __init__(self, history_pages: int = 3):
+        self.calls = []
+        self.history_pages = history_pages
+
+    def get_paginator(self, operation):
+        client = self
+
+        class Paginator:
+            def paginate(self):
+                for idx in range(3):
+                    client.calls.append(operation)
+                    yield {'stateMachines': [{'name': 'sm_{}'.format(idx), 'stateMachineArn': 'arn:sm_{}'.format(idx)}]}
+        return Paginator()
+
+    def list_executions(self, stateMachineArn, statusFilter):
+        self.calls.append(('list_executions', stateMachineArn))
+        return {'executions': [{'executionArn': 'arn:exec'}]}
+
+    def get_execution_history(self, executionArn, maxResults, reverseOrder, nextToken=0):
+        self.calls.append(('get_execution_history', executionArn, nextToken))
+        page = {'events': [{'id': nextToken}]}
+        if nextToken + 1 < self.history_pages:
+            page['nextToken'] = nextToken + 1
+        return page
+
+
+@pytest.fixture
+def sfn(monkeypatch, no_context):
+    client = FakeStepFunctions()
+    monkeypatch.setattr(cache_lambda, '_SFN_CLIENT', client)
+    cache_lambda.StateMachineRegistry.invalidate()
+    yield client
+    cache_lambda.StateMachineRegistry.invalidate()
+
+
+def lineage_cache(**dsdt_args):
+    return Cache(dict(context='ctxt', s3_bucket_url='s3://...', bundle_name='bd', **dsdt_args))
+
+
+def test_execution_arn_from_context(sfn):
+    pages = list(lineage_cache(execution_arn='arn:ctx')._get_execution_history())
+    assert [page[0]['id'] for page in pages] == [0, 1, 2]
+    assert sfn.calls == [('get_execution_history', 'arn:ctx', token) for token in [0, 1, 2]]
+
+
+def test_state_machine_arn_cached(sfn):
+    for _ in range(3):
+        assert lineage_cache(state_machine_name='sm_1')._get_execution_arn() == 'arn:exec'
+    assert sfn.calls.count('list_state_machines') == 2
+    assert ('list_executions', 'arn:sm_1') in sfn.calls
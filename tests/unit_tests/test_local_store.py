@@ -0,0 +1,73 @@
+import collections
+import os
+
+import pytest
+from disdat import api
+from disdat_step_function.cache_lambda import LocalBundleStore
+
+
+class FakeBundle:
+    """
+    data is written to the local context on api.pull(localize=True), like disdat does
+    """
+    def __init__(self, uuid: str, folder, size: int):
+        self.uuid = uuid
+        self.file = str(folder / uuid / 'cached_data.json')
+        self.size = size
+
+    @property
+    def data(self):
+        return self.file if os.path.isfile(self.file) else 's3://bucket/{}/cached_data.json'.format(self.uuid)
+
+
+@pytest.fixture
+def pulls(monkeypatch, tmp_path):
+    pulls, bundles = [], {}
+
+    def pull(context, bundle_name=None, uuid=None, localize=False):
+        pulls.append(uuid)
+        os.makedirs(os.path.dirname(bundles[uuid].file), exist_ok=True)
+        with open(bundles[uuid].file, 'w') as fp:
+            fp.write('x' * bundles[uuid].size)
+    monkeypatch.setattr(api, 'pull', pull)
+    monkeypatch.setattr(LocalBundleStore, '_entries', collections.OrderedDict())
+    monkeypatch.setattr(LocalBundleStore, '_stats', collections.Counter())
+
+    def make(uuid, size):
+        bundles[uuid] = FakeBundle(uuid, tmp_path, size)
+        return bundles[uuid]
+    return pulls, make
+
+
+def test_repeat_hits_stay_local(pulls):
+    calls, make = pulls
+    bundle = make('a', 10)
+    for _ in range(3):
+        assert LocalBundleStore.localize('ctxt', bundle) == bundle.file
+    assert calls == ['a']
+    assert LocalBundleStore.stats() == {'hits': 2, 'misses': 1, 'evictions': 0, 'bundles': 1, 'bytes': 10}
+
+
+def test_lru_eviction(pulls):
+    calls, make = pulls
+    a, b, c = make('a', 40), make('b', 40), make('c', 40)
+    LocalBundleStore.localize('ctxt', a, budget=100)
+    LocalBundleStore.localize('ctxt', b, budget=100)
+    # a is the most recently used bundle, b is evicted
+    LocalBundleStore.localize('ctxt', a, budget=100)
+    LocalBundleStore.localize('ctxt', c, budget=100)
+    assert os.path.isfile(a.file) and not os.path.isfile(b.file) and os.path.isfile(c.file)
+    assert LocalBundleStore.stats() == {'hits': 1, 'misses': 3, 'evictions': 1, 'bundles': 2, 'bytes': 80}
+
+    # evicted bundles are localized again
+    LocalBundleStore.localize('ctxt', b, budget=100)
+    assert calls == ['a', 'b', 'c', 'b']
+    assert not os.path.isfile(a.file)
+
+
+def test_oversized_bundle(pulls):
+    calls, make = pulls
+    bundle = make('a', 200)
+    LocalBundleStore.localize('ctxt', bundle, budget=100)
+    assert os.path.isfile(bundle.file)
+    assert LocalBundleStore.stats()['evictions'] == 0
@@ -0,0 +1,66 @@
+import pytest
+from disdat import api
+from disdat_step_function import cache_lambda
+from disdat_step_function.cache_lambda import MetadataSync
+
+
+def add(s3, uuid: str, ts: float):
+    """
+    a bundle of the remote context, its hyperframe and a frame
+    """
+    for name in ['hframe', 'frame']:
+        s3.add('bucket', 'context/ctxt/objects/{0}/{0}_{1}.pb'.format(uuid, name), b'', last_modified=ts)
+
+
+@pytest.fixture
+def remote(monkeypatch, s3):
+    pulls, clock = [], [1000.0]
+    s3.page_size = 2
+    monkeypatch.setattr(api, 'pull', lambda context, bundle_name=None, uuid=None, localize=False:
+                        pulls.append(bundle_name or uuid))
+    monkeypatch.setattr(cache_lambda.time, 'time', lambda: clock[0])
+    monkeypatch.setattr(MetadataSync, '_stats', MetadataSync._stats.__class__())
+    return s3, pulls, clock
+
+
+def test_sync(remote):
+    s3, pulls, clock = remote
+    entry = {'context': 'ctxt', 's3_bucket_url': 's3://bucket'}
+    add(s3, 'old', 500)
+    assert MetadataSync.sync(entry, 'bd', max_staleness=30) == 'full'
+    assert pulls == ['bd']
+
+    clock[0] = 1020
+    assert MetadataSync.sync(entry, 'bd', max_staleness=30) == 'skipped'
+    assert s3.calls['list_objects_v2'] == 0
+
+    # committed by another container since the last sync, or within the clock skew margin
+    add(s3, 'new', 1010)
+    add(s3, 'skewed', 990)
+    clock[0] = 1040
+    assert MetadataSync.sync(entry, 'bd', max_staleness=30) == 'incremental'
+    assert pulls == ['bd', 'new', 'skewed']
+
+    # the mark is kept per bundle name
+    assert MetadataSync.sync(entry, 'other', max_staleness=30) == 'full'
+    assert MetadataSync.stats() == {'full': 2, 'skipped': 1, 'incremental': 1, 'pulled': 2}
+
+
+def test_no_staleness(remote):
+    s3, pulls, clock = remote
+    entry = {'context': 'ctxt', 's3_bucket_url': 's3://bucket'}
+    add(s3, 'old', 500)
+    MetadataSync.sync(entry, 'bd', max_staleness=0)
+    assert MetadataSync.sync(entry, 'bd', max_staleness=0) == 'incremental'
+    assert pulls == ['bd']
+    assert s3.calls['list_objects_v2'] == 1
+
+
+def test_remote_layout(remote):
+    s3, pulls, clock = remote
+    add(s3, 'mine', 1010)
+    # bundles of another context, and objects outside of disdat's context dir
+    s3.add('bucket', 'context/other/objects/theirs/theirs_hframe.pb', b'', last_modified=1010)
+    s3.add('bucket', 'ctxt/objects/stray/stray_hframe.pb', b'', last_modified=1010)
+    assert MetadataSync.committed_since('s3://bucket', 'ctxt', since=1000) == ['mine']
+    assert MetadataSync.committed_since('s3://bucket/', 'ctxt', since=1000) == ['mine']
@@ -0,0 +1,95 @@
+import os
+import pytest
+from disdat import api
+from disdat_step_function.cache_lambda import Cache, Dependency, PathParam as pp, attach_lineage, split_lineage, \
+    is_reference, make_reference
+
+
+test_data = [
+    # (output, carries lineage)
+    ({'a': 1}, True),
+    (make_reference('s3://bucket/key', 'uuid', 10), True),
+    ([1, 2], False),
+    ('str', False),
+]
+
+
+@pytest.mark.parametrize('output, carries', test_data)
+def test_attach_split_lineage(output, carries):
+    deps = [Dependency('proc', 'uuid')]
+    attached = attach_lineage(output, deps)
+    data, found = split_lineage(attached)
+    assert data == output
+    assert found == (deps if carries else [])
+    assert is_reference(attached) == is_reference(output)
+
+
+def test_lookup_ignores_lineage(monkeypatch, no_context):
+    signatures = []
+
+    def search_pull(self, func_name, proc_name, signature):
+        signatures.append(signature)
+        return True, attach_lineage({'out': 1}, [Dependency(proc_name, 'hit_uuid')]), 0.0
+
+    monkeypatch.setattr(Cache, '_search_pull', search_pull)
+    cache = Cache({'context': 'ctxt', 's3_bucket_url': 's3://...', 'bundle_name': 'bd', 'payload_lineage': True})
+    cache.lookup({'a': 1})
+    use_cache, data = cache.lookup(attach_lineage({'a': 1}, [Dependency('up', 'up_uuid')]))
+    assert signatures[0] == signatures[1]
+    assert use_cache and data[pp.LINEAGE][0]['uuid'] == 'hit_uuid'
+
+
+def test_fan_in_lineage():
+    branches = [attach_lineage({'branch': idx}, [Dependency('proc_{}'.format(idx), 'uuid_{}'.format(idx))])
+                for idx in range(3)]
+    # a Map over Parallel outputs, with the same upstream bundle reached twice
+    joined = [branches, {'nested': branches[0]}]
+    data, found = split_lineage(joined)
+    assert data == [[{'branch': 0}, {'branch': 1}, {'branch': 2}], {'nested': {'branch': 0}}]
+    assert [dep.uuid for dep in found] == ['uuid_0', 'uuid_1', 'uuid_2']
+
+
+class FakeBundle:
+    """
+    in-memory api.Bundle that records add_dependencies calls
+    """
+    dependencies = []
+
+    def __init__(self, context, name, processing_name):
+        self.processing_name = processing_name
+        self.uuid = 'new_uuid'
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def get_file(self, name):
+        return os.path.join(self.tmp, name)
+
+    def get_remote_file(self, name):
+        return 's3://bucket/{}'.format(name)
+
+    def add_params(self, params):
+        pass
+
+    def add_data(self, file):
+        pass
+
+    def add_dependencies(self, bundles):
+        FakeBundle.dependencies.append(list(bundles))
+
+    calc_default_processing_name = api.Bundle.calc_default_processing_name
+
+
+def test_push_fan_in(monkeypatch, no_context, tmp_path):
+    FakeBundle.tmp, FakeBundle.dependencies = str(tmp_path), []
+    monkeypatch.setattr(api, 'Bundle', FakeBundle)
+    monkeypatch.setattr(api, 'commit', lambda *args, **kwargs: None)
+    monkeypatch.setattr(api, 'push', lambda *args, **kwargs: None)
+    cache = Cache({'context': 'ctxt', 's3_bucket_url': 's3://...', 'bundle_name': 'bd', 'payload_lineage': True})
+    branches = [attach_lineage({'branch': idx}, [Dependency('proc', 'uuid_{}'.format(idx))]) for idx in range(5)]
+    output = cache.push(branches, {'out': 1})
+    assert [[dep.uuid for dep in call] for call in FakeBundle.dependencies] == [['uuid_{}'.format(i) for i in range(5)]]
+    assert split_lineage(output) == ({'out': 1}, [Dependency(output[pp.LINEAGE][0]['processing_name'], 'new_uuid')])
@@ -7,6 +7,7 @@ from tests.unit_tests.uncached_workflow.complex_workflow import ComplexWorkflow
 from tests.unit_tests.uncached_workflow.long_workflow import LongWorkflow
 from tests.unit_tests.uncached_workflow.map_workflow import MapWorkflow
 from tests.unit_tests.uncached_workflow.parallel_choice_map_workflow import ParallelChoiceMapWorkflow
+from tests.unit_tests.uncached_workflow.map_level_workflow import MapLevelWorkflow
 
 from disdat_step_function.caching_wrapper import Caching, PipelineCaching,ExtensiveGraphVisitor
 
@@ -28,9 +29,27 @@ caching = Caching(caching_lambda_name='',
                   verbose=True)
 
 
-@pytest.mark.parametrize('raw_graph, expected', test_data)
-def test_pipeline_caching_graph(raw_graph, expected):
-    PipelineCaching(raw_graph, caching).cache()
+lean_caching = Caching(caching_lambda_name='',
+                       s3_bucket_url='s3://...',
+                       context_name='',
+                       verbose=True,
+                       lean_wrapper=True)
+
+
+lean_test_data = [
+    [SimpleWorkflow.get_workflow(), SimpleWorkflow.get_expected_def(lean_wrapper=True)],
+    [LongWorkflow.get_workflow(), LongWorkflow.get_expected_def(lean_wrapper=True)],
+]
+
+
+map_level_test_data = [
+    [MapLevelWorkflow.get_workflow(), MapLevelWorkflow.get_expected_def()],
+    # cache_maps does not change workflows without Map states
+    [SimpleWorkflow.get_workflow(), SimpleWorkflow.get_expected_def()],
+]
+
+
+def assert_same_graph(raw_graph, expected):
     visitor_test = ExtensiveGraphVisitor()
     visitor_expected = ExtensiveGraphVisitor()
     # traverse throughout the two pipelines, one generated by PipelineCaching,
@@ -46,3 +65,28 @@ def test_pipeline_caching_graph(raw_graph, expected):
             assert visitor_test.states[state_id][key] == visitor_expected.states[state_id][key]
 
 
+@pytest.mark.parametrize('raw_graph, expected', test_data)
+def test_pipeline_caching_graph(raw_graph, expected):
+    PipelineCaching(raw_graph, caching).cache()
+    assert_same_graph(raw_graph, expected)
+
+
+@pytest.mark.parametrize('raw_graph, expected', map_level_test_data)
+def test_pipeline_caching_map_level(raw_graph, expected):
+    PipelineCaching(raw_graph, caching, cache_maps=True).cache()
+    assert_same_graph(raw_graph, expected)
+
+
+
+
+@pytest.mark.parametrize('raw_graph, expected', lean_test_data)
+def test_pipeline_caching_lean(raw_graph, expected):
+    PipelineCaching(raw_graph, lean_caching).cache()
+    assert_same_graph(raw_graph, expected)
+    visitor = ExtensiveGraphVisitor()
+    raw_graph.accept(visitor)
+    assert not any(state['Type'] == 'Parallel' for state in visitor.states.values())
+    assert visitor.states['task_1']['InputPath'] == '$._full_params'
+    assert visitor.states['task_1']['Next'] == 'cache_push_task_1'
+    assert visitor.states['cache_push_task_1']['Next'] == 'cache_output_task_1'
+    assert visitor.states['cache_output_task_1']['Next'] == 'cache_pull_task_2'
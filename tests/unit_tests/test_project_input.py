@@ -0,0 +1,32 @@
+import pytest
+from stepfunctions.steps import states
+
+from disdat_step_function.cache_lambda import Cache, PathParam as pp
+from disdat_step_function.caching_wrapper import Caching, ExtensiveGraphVisitor
+
+
+@pytest.mark.parametrize('input_path, cache_params', [('$', '$._full_params'), ('$.a', '$.a')])
+def test_cache_step_projected(input_path, cache_params):
+    projected = Caching(caching_lambda_name='', s3_bucket_url='s3://...', context_name='',
+                        lean_wrapper=True, project_input=True)
+    task = states.Task(state_id='task', input_path=input_path)
+    visitor = ExtensiveGraphVisitor()
+    states.Chain([projected.cache_step(task), states.Pass(state_id='after')]).accept(visitor)
+    pull = visitor.states['cache_pull_task']
+    assert pull['Parameters']['Payload'][pp.CACHE_PARAM_SUFFIX] == cache_params
+    assert pp.FULL_PARAM_SUFFIX not in pull['Parameters']['Payload']
+    assert pull['ResultPath'] == pp.PULL_PREFIX
+    assert ('cache_input_task' in visitor.states) == (input_path == '$')
+    assert visitor.states['task']['InputPath'] == cache_params
+    assert visitor.states['cache_push_task']['Parameters']['Payload'][pp.CACHE_PARAM_SUFFIX] == cache_params
+    assert visitor.states['cache_push_task']['ResultPath'] == pp.PULL_PREFIX
+    assert visitor.states['cache_output_task']['OutputPath'] == '$._dsdt_pull.Payload._data'
+    assert visitor.states['cache_output_task']['Next'] == 'after'
+
+
+def test_cache_pull_projected(monkeypatch, no_context):
+    monkeypatch.setattr(Cache, 'lookup', lambda self, cache_params, pull_metadata=True: (True, cache_params * 2))
+    cache = Cache({'context': 'ctxt', 's3_bucket_url': 's3://...', 'bundle_name': 'bd'})
+    assert cache.cache_pull({pp.CACHE_PARAM: 2, pp.DSDT_ONLY_ARGS: {}}) == {pp.CACHE_DATA: 4, pp.USE_CACHE: True}
+    assert cache.cache_pull({pp.FULL_PARAM: {'a': 2}, pp.CACHE_PARAM: 2, pp.DSDT_ONLY_ARGS: {}}) == \
+        {pp.FULL_PARAM: {'a': 2}, pp.CACHE_PARAM: 2, pp.CACHE_DATA: 4, pp.USE_CACHE: True}
@@ -0,0 +1,39 @@
+import json
+
+import pytest
+from disdat_step_function import cache_lambda
+from disdat_step_function.cache_lambda import make_reference, is_reference, resolve_reference, iter_reference, Codec
+
+
+test_data = [
+    {'foo': 'bar'},
+    [1, 2, 3],
+    'string',
+    None,
+    {cache_lambda.PathParam.REFERENCE: {}, 'other': 1},
+]
+
+
+@pytest.mark.parametrize('data', test_data)
+def test_inline_data_passthrough(data):
+    assert not is_reference(data)
+    assert resolve_reference(data) == data
+
+
+def test_resolve_reference(s3):
+    data = {'dict': {'list': [1, 2, 3]}, 'int': 123}
+    s3.add('bucket', 'ctxt/objects/uuid/cached_data.json', json.dumps(data).encode())
+    ref = make_reference('s3://bucket/ctxt/objects/uuid/cached_data.json', uuid='uuid', size=10)
+    assert is_reference(ref)
+    assert ref[cache_lambda.PathParam.REFERENCE]['key'] == 'ctxt/objects/uuid/cached_data.json'
+    assert resolve_reference(ref) == data
+
+
+def test_iter_reference(s3):
+    data = [{'id': i} for i in range(1000)]
+    raw = Codec.encode(data, Codec.GZIP, Codec.NDJSON)
+    s3.add('bucket', 'key', raw)
+    ref = make_reference('s3://bucket/key', uuid='uuid', size=len(raw), codec=Codec.GZIP, fmt=Codec.NDJSON)
+    assert list(iter_reference(ref)) == data
+    assert resolve_reference(ref) == data
+    assert list(iter_reference(data)) == data
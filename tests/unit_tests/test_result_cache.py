@@ -0,0 +1,121 @@
+import collections
+import json
+
+import pytest
+from disdat import api
+from disdat_step_function import cache_lambda
+from disdat_step_function.cache_lambda import Cache, PathParam as pp, ResultCache, Signature
+
+
+@pytest.fixture
+def lookups(monkeypatch, no_context):
+    """
+    count the metadata pulls and searches of Cache.lookup, every search is a hit
+    """
+    calls = collections.Counter()
+    monkeypatch.setattr(api, 'pull', lambda *args, **kwargs: calls.update(['pull']))
+
+    def search_pull(self, func_name, proc_name, signature):
+        calls.update(['search'])
+        return True, {'out': signature}, 0.0
+    monkeypatch.setattr(Cache, '_search_pull', search_pull)
+    monkeypatch.setattr(ResultCache, '_entries', collections.OrderedDict())
+    monkeypatch.setattr(ResultCache, '_stats', collections.Counter())
+    return calls
+
+
+def make_cache(**kwargs):
+    return Cache(dict({'context': 'ctxt', 's3_bucket_url': 's3://...', 'bundle_name': 'bd', 'result_ttl': 60},
+                      **kwargs))
+
+
+def test_hits_in_memory(lookups):
+    cache = make_cache()
+    results = [cache.lookup({'a': 1}) for _ in range(5)]
+    assert all(result == results[0] for result in results)
+    assert lookups == {'pull': 1, 'search': 1}
+    assert ResultCache.stats() == {'hits': 4, 'misses': 1, 'expired': 0, 'evictions': 0, 'results': 1}
+
+
+def test_disabled(lookups):
+    cache = make_cache(result_ttl=None)
+    for _ in range(3):
+        cache.lookup({'a': 1})
+    assert lookups == {'pull': 3, 'search': 3}
+
+
+def test_ttl(lookups, monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr(cache_lambda.time, 'time', lambda: clock[0])
+    cache = make_cache()
+    cache.lookup({'a': 1})
+    clock[0] += 61
+    cache.lookup({'a': 1})
+    assert lookups['search'] == 2
+    assert ResultCache.stats()['expired'] == 1
+
+
+def test_size_cap(lookups):
+    cache = make_cache(result_cache_size=2)
+    for value in [1, 2, 3, 1]:
+        cache.lookup({'a': value})
+    assert lookups['search'] == 4
+    assert ResultCache.stats()['evictions'] == 2
+
+
+def test_invalidate(lookups):
+    cache = make_cache()
+    cache.lookup({'a': 1})
+    signature = Signature.candidates({'a': 1}, canonical=False)[0]
+    proc_name = api.Bundle.calc_default_processing_name('bd', signature, dep_proc_ids={})
+    assert list(ResultCache._entries) == [cache.result_key(proc_name)]
+    ResultCache.invalidate(cache.result_key(proc_name))
+    cache.lookup({'a': 1})
+    assert lookups['search'] == 2
+
+
+test_data = [
+    # (age of the bundle when the result is read from memory, searches, refresh triggered)
+    (50, 1, False),
+    (120, 1, True),
+    (200, 2, False),
+]
+
+
+@pytest.mark.parametrize('age, searches, refreshed', test_data)
+def test_max_age(lookups, monkeypatch, age, searches, refreshed):
+    """
+    the freshness policy applies to hits in memory, on the creation time of their bundle
+    """
+    clock, triggered = [1000.0], []
+    monkeypatch.setattr(cache_lambda.time, 'time', lambda: clock[0])
+    monkeypatch.setattr(Cache, 'trigger_refresh', lambda self, proc_name: triggered.append(proc_name))
+
+    def search_pull(self, func_name, proc_name, signature):
+        lookups.update(['search'])
+        return self.fresh_enough(func_name, proc_name, 1000.0), 'out', 1000.0
+    monkeypatch.setattr(Cache, '_search_pull', search_pull)
+    cache = make_cache(result_ttl=3600, max_age=100, stale_while_revalidate=50)
+    assert cache.lookup({'a': 1}) == (True, 'out')
+    clock[0] += age
+    use_cache, _ = cache.lookup({'a': 1})
+    assert use_cache == (age <= 150)
+    assert lookups['search'] == searches
+    assert bool(triggered) == refreshed
+    # an expired result is dropped from memory
+    assert len(ResultCache._entries) == int(age <= 150)
+
+
+def test_map_pull_created(lookups, monkeypatch):
+    """
+    map_pull shares one Cache between the lookup threads, each result keeps the creation time of its own bundle
+    """
+    monkeypatch.setattr(Cache, '_pointer_pull', lambda self, func_name, proc_name, signature:
+                        (True, signature, float(json.loads(signature['input_params'])['id'])))
+    items = [{'id': i} for i in range(64)]
+    Cache.map_pull({pp.FULL_PARAM: {'items': items}, pp.MAP: {'items_path': '$.items'},
+                    pp.DSDT_ONLY_ARGS: {'context': 'ctxt', 's3_bucket_url': 's3://...', 'bundle_name': 'bd',
+                                        'result_ttl': 60, 'pointer_lookup': True}})
+    assert len(ResultCache._entries) == 64
+    for entry in ResultCache._entries.values():
+        assert entry['bundle_created'] == json.loads(entry['data']['input_params'])['id']
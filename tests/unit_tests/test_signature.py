@@ -0,0 +1,39 @@
+import pytest
+from disdat_step_function.cache_lambda import Signature
+
+
+test_data = [
+    # (params a, params b, ignored fields, should share a signature)
+    ({'a': 1, 'b': 2}, {'b': 2, 'a': 1}, [], True),
+    ({'a': {'x': [1, 2], 'y': 'z'}}, {'a': {'y': 'z', 'x': [1, 2]}}, [], True),
+    ({'a': [1, 2]}, {'a': [2, 1]}, [], False),
+    ({'a': 1.0}, {'a': 1}, [], True),
+    ({'a': 0.1}, {'a': 0.10000000000000001}, [], True),
+    ({'a': 1.5}, {'a': 1}, [], False),
+    ({'name': 'caf\u00e9'}, {'name': 'cafe\u0301'}, [], True),
+    ({'a': 1, 'id': 'x'}, {'a': 1, 'id': 'y'}, ['id'], True),
+    ({'a': 1, 'meta': {'id': 'x'}}, {'a': 1, 'meta': {'id': 'y'}}, ['meta.id'], True),
+    ({'a': 1, 'meta': {'id': 'x'}}, {'a': 2, 'meta': {'id': 'y'}}, ['meta.id'], False),
+    ('123', '123', ['id'], True),
+]
+
+
+@pytest.mark.parametrize('params_a, params_b, ignore_fields, same', test_data)
+def test_canonical_signature(params_a, params_b, ignore_fields, same):
+    sig_a = Signature.canonical(params_a, ignore_fields)
+    sig_b = Signature.canonical(params_b, ignore_fields)
+    assert (sig_a == sig_b) == same
+
+
+def test_large_input_digest():
+    params = {'data': list(range(Signature.DIGEST_THRESHOLD))}
+    signature = Signature.canonical(params)
+    assert list(signature) == [Signature.DIGEST_KEY]
+    assert signature[Signature.DIGEST_KEY].startswith('sha256:')
+    assert signature == Signature.canonical(dict(reversed(list(params.items()))))
+
+
+def test_legacy_fallback():
+    params = {'b': 2, 'a': 1}
+    assert Signature.candidates(params, canonical=False) == [Signature.legacy(params)]
+    assert Signature.candidates(params, canonical=True)[-1] == Signature.legacy(params)
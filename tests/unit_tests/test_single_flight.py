@@ -0,0 +1,102 @@
+import json
+
+import pytest
+from botocore.exceptions import ClientError
+from disdat_step_function import cache_lambda
+from disdat_step_function.cache_lambda import Cache, PathParam as pp
+
+
+@pytest.fixture
+def remote(monkeypatch, no_context, s3):
+    """
+    the lookup is a hit once the bundle is pushed
+    """
+    pushed, clock = [], [1000.0]
+    monkeypatch.setattr(cache_lambda.time, 'time', lambda: clock[0])
+    monkeypatch.setattr(Cache, '_search_pull', lambda self, func_name, proc_name, signature:
+                        (True, 'output', 0.0) if pushed else (False, None, None))
+    return s3, pushed, clock
+
+
+def pull(execution: str, **kwargs):
+    cache = Cache(dict({'context': 'ctxt', 's3_bucket_url': 's3://bucket', 'bundle_name': 'bd',
+                        'execution_arn': execution, 'lease_ttl': 300, 'lease_wait': 30}, **kwargs))
+    data = cache.cache_pull({pp.CACHE_PARAM: {'a': 1}})
+    return data[pp.USE_CACHE], data[pp.CACHE_DATA]
+
+
+def holder(s3):
+    keys = s3.keys()
+    assert len(keys) <= 1
+    return json.load(s3.get_object(Bucket='bucket', Key=keys[0])['Body'])['owner'] if keys else None
+
+
+def test_wait_for_push(remote, monkeypatch):
+    s3, pushed, clock = remote
+    assert pull('first') == (False, None)
+    assert holder(s3) == 'first'
+
+    def push_after(seconds):
+        clock[0] += seconds
+        if clock[0] >= 1005:
+            pushed.append(True)
+            s3.objects.clear()
+    monkeypatch.setattr(cache_lambda.time, 'sleep', push_after)
+    assert pull('second') == (True, 'output')
+    assert clock[0] == 1005
+
+
+def test_deadline(remote, monkeypatch):
+    s3, pushed, clock = remote
+    monkeypatch.setattr(cache_lambda.time, 'sleep', lambda seconds: clock.__setitem__(0, clock[0] + seconds))
+    pull('first')
+    assert pull('second', lease_wait=3) == (False, None)
+    assert clock[0] == 1003
+    assert holder(s3) == 'first'
+
+
+def test_take_over_expired(remote):
+    s3, pushed, clock = remote
+    pull('first')
+    clock[0] += 301
+    assert pull('second') == (False, None)
+    assert holder(s3) == 'second'
+
+
+@pytest.mark.parametrize('error', ['NotImplemented', 'AccessDenied'])
+def test_fail_open(remote, error):
+    s3, pushed, clock = remote
+    s3.error = error
+    assert pull('first') == (False, None)
+    assert pull('second') == (False, None)
+
+
+def test_take_over_race(remote, monkeypatch):
+    s3, pushed, clock = remote
+    monkeypatch.setattr(cache_lambda.time, 'sleep', lambda seconds: clock.__setitem__(0, clock[0] + seconds))
+    pull('first')
+    clock[0] += 301
+    delete = s3.delete_object
+
+    def racing_delete(**kwargs):
+        # 'second' takes over the expired lease after 'third' read it, before 'third' deletes it
+        monkeypatch.setattr(s3, 'delete_object', delete)
+        assert pull('second') == (False, None)
+        return delete(**kwargs)
+    monkeypatch.setattr(s3, 'delete_object', racing_delete)
+    # 'third' does not delete the lease of 'second', it waits for its push
+    assert pull('third', lease_wait=3) == (False, None)
+    assert holder(s3) == 'second'
+    assert clock[0] == 1304
+
+
+def test_acquire_attempts(remote, monkeypatch):
+    s3, pushed, clock = remote
+
+    def put_object(**kwargs):
+        # the lease is always released before it is read
+        s3.calls['put_object'] += 1
+        raise ClientError({'Error': {'Code': 'PreconditionFailed'}}, 'PutObject')
+    monkeypatch.setattr(s3, 'put_object', put_object)
+    assert pull('first') == (False, None)
+    assert s3.calls['put_object'] == Cache.LEASE_ATTEMPTS
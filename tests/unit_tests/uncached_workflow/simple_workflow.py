@@ -15,11 +15,12 @@ class SimpleWorkflow:
         return states.Chain([start, exec])
 
     @classmethod
-    def get_expected_def(cls):
+    def get_expected_def(cls, lean_wrapper=False):
         caching = Caching(caching_lambda_name='',
                           s3_bucket_url='s3://...',
                           context_name='',
-                          verbose=True)
+                          verbose=True,
+                          lean_wrapper=lean_wrapper)
 
         start = states.Pass(state_id='start')
         task_1 = states.Task(state_id='task_1')